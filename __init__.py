@@ -1,8 +1,12 @@
-from .offload_recall import OffloadModel, RecallModel
-from .cache_any import CacheAny
-from .md5_hash import AnyToHash, AnyToHashMulti
+from .offload_recall import OffloadModel, RecallModel, PrefetchRecall, TransferStats
+from .cache_any import CacheAny, CacheStats, PrefetchCache
+from .md5_hash import AnyToHash, AnyToHashMulti, AnyToHashN
 from .wait import Wait, WaitMulti
 from .reroute_triggerable import RerouteTriggerable
+from .cache_warmer import register_cache_warmer
+
+# Read the CacheAny entries of the queued prompts in the background
+register_cache_warmer()
 
 # Blind ComfyUI needs to be told where to look for js code
 WEB_DIRECTORY = "./js"
@@ -12,9 +16,14 @@ WEB_DIRECTORY = "./js"
 NODE_CLASS_MAPPINGS = {
     "OffloadModelv2": OffloadModel,
     "RecallModelv2": RecallModel,
+    "PrefetchRecall": PrefetchRecall,
+    "TransferStats": TransferStats,
     "CacheAny": CacheAny,
+    "CacheStats": CacheStats,
+    "PrefetchCache": PrefetchCache,
     "AnyToHash": AnyToHash,
     "AnyToHashMulti": AnyToHashMulti,
+    "AnyToHashN": AnyToHashN,
     "Wait": Wait,
     "WaitMulti": WaitMulti,
     "RerouteTriggerable": RerouteTriggerable
@@ -23,9 +32,14 @@ NODE_CLASS_MAPPINGS = {
 NODE_DISPLAY_NAME_MAPPINGS = {
     "OffloadModelv2": "Model Offload",
     "RecallModelv2": "Model Recall",
+    "PrefetchRecall": "Model Recall (prefetch)",
+    "TransferStats": "Offload/recall stats",
     "CacheAny": "Cache any",
+    "CacheStats": "Cache stats",
+    "PrefetchCache": "Cache prefetch",
     "AnyToHash" : "any to hash",
     "AnyToHashMulti" : "any to hash x2",
+    "AnyToHashN" : "any to hash xN",
     "Wait": "Wait",
     "WaitMulti": "Wait xN",
     "RerouteTriggerable": "Reroute Triggerable"
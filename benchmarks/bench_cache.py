@@ -0,0 +1,311 @@
+"""
+CPU-only benchmarks of the hashing and CacheAny read/write paths.
+
+Runs without ComfyUI: folder_paths and comfy are replaced by minimal stand-ins,
+the cache folder is a temporary directory. Each case runs in its own process so that its peak RSS is meaningful.
+
+usage:
+    python benchmarks/bench_cache.py [--quick] [--cases hash,cache_miss,cache_hit] [--output results.json]
+    python benchmarks/bench_cache.py --startup  # import time of the package
+"""
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import platform
+import tempfile
+import importlib.util
+import multiprocessing
+from pathlib import Path
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent
+PACKAGE_NAME = "better_flow"
+
+
+def _install_stubs(output_directory):
+    '''
+    Minimal folder_paths and comfy modules, enough to import the node pack on CPU
+    '''
+    import torch
+
+    folder_paths = types.ModuleType("folder_paths")
+    folder_paths.output_directory = output_directory
+    folder_paths.get_temp_directory = lambda: os.path.join(output_directory, "temp")
+    sys.modules["folder_paths"] = folder_paths
+
+    class ModelPatcher:
+        def __init__(self, model, load_device, offload_device):
+            self.model = model
+            self.load_device = load_device
+            self.offload_device = offload_device
+
+    comfy = types.ModuleType("comfy")
+    model_patcher = types.ModuleType("comfy.model_patcher")
+    model_patcher.ModelPatcher = ModelPatcher
+    model_management = types.ModuleType("comfy.model_management")
+    model_management.unet_offload_device = lambda: torch.device("cpu")
+    model_management.get_torch_device = lambda: torch.device("cpu")
+    model_management.cleanup_models_gc = lambda: None
+    model_management.soft_empty_cache = lambda: None
+    comfy.model_patcher = model_patcher
+    comfy.model_management = model_management
+    sys.modules.update({"comfy": comfy, "comfy.model_patcher": model_patcher, "comfy.model_management": model_management})
+
+
+def _import_package():
+    spec = importlib.util.spec_from_file_location(PACKAGE_NAME, PACKAGE_DIR / "__init__.py",
+                                                  submodule_search_locations=[str(PACKAGE_DIR)])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = package
+    spec.loader.exec_module(package)
+    return package
+
+
+def _peak_rss_bytes():
+    '''
+    Peak resident memory of the process, None if it cannot be measured (RSS is then not reported)
+    '''
+    try:
+        import resource  # unix only
+    except ImportError:
+        resource = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macOS
+        return peak if platform.system() == "Darwin" else peak * 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    # peak working set on windows
+    return getattr(memory, "peak_wset", memory.rss)
+
+
+# --- synthetic payloads ---
+
+def make_payload(kind, size):
+    import torch
+    generator = torch.Generator().manual_seed(0)
+    if kind == "image":
+        # IMAGE: batch, height, width, channels
+        return torch.rand((size, 1024, 1024, 3), generator=generator)
+    elif kind == "latent":
+        return {"samples": torch.randn((size, 16, 128, 128), generator=generator)}
+    elif kind == "conditioning":
+        return [[torch.randn((1, 256 * size, 4096), generator=generator),
+                 {"pooled_output": torch.randn((1, 768), generator=generator), "guidance": 3.5}]]
+    elif kind == "string":
+        return "a photograph of an astronaut riding a horse, " * size
+    elif kind == "list":
+        return [f"prompt {i}" for i in range(1000 * size)]
+    raise ValueError(f"Unknown payload kind={kind}")
+
+
+def payload_nbytes(payload) -> int:
+    from better_flow.ram_cache import estimate_size
+    return estimate_size(payload)
+
+
+PAYLOADS = {
+    "full": [("image", 1), ("image", 8), ("image", 32), ("latent", 16), ("conditioning", 1), ("conditioning", 4),
+             ("string", 100), ("list", 10)],
+    "quick": [("image", 1), ("image", 4), ("latent", 4), ("conditioning", 1), ("string", 100), ("list", 1)],
+}
+
+
+# --- benchmark cases: each returns the latencies in seconds ---
+
+def bench_hash(payload, repeat, algorithm="md5", tree=False, mode="exact"):
+    from better_flow.common import get_hash_from_any, clear_hash_memo
+    latencies = []
+    for _ in range(repeat):
+        clear_hash_memo()  # measure the hashing, not the memo
+        start = time.perf_counter()
+        get_hash_from_any(payload, algorithm=algorithm, tree=tree, mode=mode)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_hash_list(payload, repeat, algorithm="md5"):
+    from better_flow.common import get_hash_from_list_any, clear_hash_memo
+    latencies = []
+    for _ in range(repeat):
+        clear_hash_memo()
+        start = time.perf_counter()
+        get_hash_from_list_any([payload, "key"], algorithm=algorithm)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_cache_miss(payload, repeat, **options):
+    from better_flow.cache_any import CacheAny
+    from better_flow.cache_writer import flush_cache_writes
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        CacheAny.run_caching(payload, f"miss-{i}-{time.time_ns()}", "bench_miss", False, False, keep_in_ram=False, **options)
+        latencies.append(time.perf_counter() - start)
+    flush_cache_writes()
+    return latencies
+
+
+def bench_cache_hit(payload, repeat, from_ram=False, **options):
+    from better_flow.cache_any import CacheAny
+    from better_flow.ram_cache import RAM_CACHE
+    key = f"hit-{time.time_ns()}"
+    CacheAny.run_caching(payload, key, "bench_hit", False, False, keep_in_ram=from_ram, **options)
+    latencies = []
+    for _ in range(repeat):
+        if not from_ram:
+            RAM_CACHE.clear()
+        start = time.perf_counter()
+        cached, _ = CacheAny.run_caching(None, key, "bench_hit", False, False, keep_in_ram=from_ram, **options)
+        _touch(cached)  # memory-mapped tensors are only read when used
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _touch(obj):
+    import torch
+    if isinstance(obj, torch.Tensor):
+        obj.sum()
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _touch(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _touch(value)
+
+
+CASES = {
+    "hash": lambda payload, repeat: bench_hash(payload, repeat),
+    "hash_blake2b": lambda payload, repeat: bench_hash(payload, repeat, algorithm="blake2b"),
+    "hash_tree": lambda payload, repeat: bench_hash(payload, repeat, tree=True),
+    "hash_sampled": lambda payload, repeat: bench_hash(payload, repeat, mode="sampled"),
+    "hash_list": lambda payload, repeat: bench_hash_list(payload, repeat),
+    "cache_miss": lambda payload, repeat: bench_cache_miss(payload, repeat),
+    "cache_miss_pickle": lambda payload, repeat: bench_cache_miss(payload, repeat, storage="pickle"),
+    "cache_hit": lambda payload, repeat: bench_cache_hit(payload, repeat),
+    "cache_hit_ram": lambda payload, repeat: bench_cache_hit(payload, repeat, from_ram=True),
+}
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_case(case, kind, size, repeat, output_directory):
+    '''
+    Run one case for one payload, meant to be run in a fresh process
+    '''
+    _install_stubs(output_directory)
+    _import_package()
+    payload = make_payload(kind, size)
+    nbytes = payload_nbytes(payload)
+    rss_before = _peak_rss_bytes()
+    latencies = CASES[case](payload, repeat)
+    median = _percentile(latencies, 50)
+    return {
+        "case": case,
+        "payload": kind,
+        "size": size,
+        "payload_bytes": nbytes,
+        "repeat": repeat,
+        "throughput_mb_s": nbytes / median / 1e6 if median > 0 else None,
+        "latency_s": {"min": min(latencies), "p50": median, "p90": _percentile(latencies, 90),
+                      "p99": _percentile(latencies, 99), "max": max(latencies)},
+        "peak_rss_bytes": _peak_rss_bytes(),
+        "peak_rss_before_case_bytes": rss_before,
+    }
+
+
+def run_startup(output_directory):
+    '''
+    Import time of the node pack in a fresh process, torch being already imported (as in ComfyUI),
+    then the deferred initialization paid by the first INPUT_TYPES calls
+    '''
+    import torch
+    import numpy
+    _install_stubs(output_directory)
+    start = time.perf_counter()
+    package = _import_package()
+    import_s = time.perf_counter() - start
+    cuda_initialized_by_import = torch.cuda.is_initialized()
+    start = time.perf_counter()
+    for node in package.NODE_CLASS_MAPPINGS.values():
+        node.INPUT_TYPES()
+    return {
+        "import_s": import_s,
+        "first_input_types_s": time.perf_counter() - start,
+        "cuda_initialized_by_import": cuda_initialized_by_import,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="smaller payloads")
+    parser.add_argument("--cases", default=",".join(CASES.keys()), help=f"comma separated, among {list(CASES.keys())}")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--startup", action="store_true", help="measure the import time of the package instead")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    if args.startup:
+        with tempfile.TemporaryDirectory() as output_directory:
+            runs = []
+            for _ in range(args.repeat):
+                with context.Pool(1) as pool:
+                    runs.append(pool.apply(run_startup, (output_directory,)))
+        report = {
+            "python": sys.version.split()[0],
+            "import_s": {"p50": _percentile([run["import_s"] for run in runs], 50),
+                         "max": max(run["import_s"] for run in runs)},
+            "first_input_types_s": {"p50": _percentile([run["first_input_types_s"] for run in runs], 50)},
+            "cuda_initialized_by_import": any(run["cuda_initialized_by_import"] for run in runs),
+        }
+        print(json.dumps(report, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+        return
+
+    cases = [case for case in args.cases.split(",") if case]
+    for case in cases:
+        if case not in CASES:
+            parser.error(f"Unknown case {case}")
+
+    results = []
+    with tempfile.TemporaryDirectory() as output_directory:
+        for case in cases:
+            for kind, size in PAYLOADS["quick" if args.quick else "full"]:
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_case, (case, kind, size, args.repeat, output_directory))
+                results.append(result)
+                print(f"{case:18s} {kind:12s} x{size:<4d} {result['payload_bytes'] / 1e6:10.1f} MB "
+                      f"p50={result['latency_s']['p50'] * 1e3:9.2f} ms "
+                      f"p90={result['latency_s']['p90'] * 1e3:9.2f} ms "
+                      f"{(result['throughput_mb_s'] or 0):10.1f} MB/s "
+                      + (f"peak_rss={result['peak_rss_bytes'] / 1e6:8.1f} MB" if result['peak_rss_bytes'] is not None else "peak_rss=n/a"),
+                      flush=True)
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
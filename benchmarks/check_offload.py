@@ -0,0 +1,724 @@
+"""
+CPU-only checks of the offload paths of the Offload/Recall nodes and of the CacheAny cache (hashing, file format,
+index and limits, deduplication, background writes, warming).
+
+Runs without ComfyUI or a GPU, with the same stand-ins as bench_cache.py, the temp folder is a temporary directory.
+Each check raises an AssertionError on failure, the script exits with 1 if any check failed.
+
+usage:
+    python benchmarks/check_offload.py [--checks disk,hash,index]
+"""
+import sys
+import argparse
+import tempfile
+import traceback
+
+from bench_cache import _install_stubs, _import_package
+
+
+def _state(module) -> dict:
+    return {name: tensor.detach().clone() for name, tensor in module.state_dict().items()}
+
+
+def _same_state(module, state) -> bool:
+    import torch
+    current = module.state_dict()
+    return current.keys() == state.keys() and all(torch.equal(current[name], state[name]) for name in state)
+
+
+# --- checks ---
+
+def check_disk(output_directory):
+    '''
+    Disk offload: round trip of the weights, reuse of the file of unchanged weights, no reuse for weights differing
+    outside the sample of a sampled hash
+    '''
+    import torch
+    from better_flow.common import get_hash_from_any
+    from better_flow.cache_format import load_entry
+    from better_flow.disk_offload import offload_to_disk, is_disk_offloaded, forget_disk_offload
+
+    torch.manual_seed(0)
+    module = torch.nn.Sequential(torch.nn.Linear(1024, 1024), torch.nn.LayerNorm(1024), torch.nn.Linear(1024, 16))
+    state = _state(module)
+    path = offload_to_disk(module)
+    assert is_disk_offloaded(module) and path.exists()
+    assert _same_state(module, state), "the memory-mapped weights differ from the offloaded ones"
+    assert offload_to_disk(module) == path, "unchanged weights were written again"
+
+    # the mapped tensors are copy-on-write: modifying the module does not modify the file
+    module[0].weight.data[0, 0] += 1
+    assert torch.equal(load_entry(path)["0.weight"], state["0.weight"]), "the file was modified through the module"
+    module[0].weight.data[0, 0] = state["0.weight"][0, 0]
+
+    # same shapes, one value changed in the middle of a tensor larger than the hash sample
+    other = torch.nn.Sequential(torch.nn.Linear(1024, 1024), torch.nn.LayerNorm(1024), torch.nn.Linear(1024, 16))
+    other.load_state_dict(state)
+    other[0].weight.data[512, 700] += 1
+    other_state = _state(other)
+    assert get_hash_from_any(other_state, mode="sampled") == get_hash_from_any(state, mode="sampled")
+    other_path = offload_to_disk(other)
+    assert other_path != path, "weights differing outside the hash sample reuse the same file"
+    assert _same_state(other, other_state) and _same_state(module, state)
+
+    # recall: the weights are read back from the file into memory
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        tensor.data = tensor.data.clone()
+    forget_disk_offload(module)
+    assert not is_disk_offloaded(module) and _same_state(module, state)
+
+
+def check_staging(output_directory):
+    '''
+    Staging buffers: one host buffer per tensor of a module, reused across cycles, replaced when the tensor changes
+    shape, never over the budget, and released with release()
+    '''
+    import torch
+    from better_flow.staging_buffers import StagingBufferPool
+
+    module = torch.nn.Linear(256, 256)
+    nbytes = 256 * 256 * 4
+    pool = StagingBufferPool(budget_bytes=nbytes + 1024)
+    buffer = pool.get(module, "weight", module.weight)
+    assert buffer is not None and buffer.shape == module.weight.shape and buffer.dtype == module.weight.dtype
+    assert pool.get(module, "weight", module.weight) is buffer, "the buffer was not reused"
+    assert pool.total_bytes() == nbytes
+    assert pool.get(module, "bias", module.bias) is not None and pool.total_bytes() == nbytes + 1024
+
+    other = torch.nn.Linear(256, 256)
+    assert pool.get(other, "weight", other.weight) is None, "a buffer was allocated over the budget"
+    smaller = torch.empty(128, 256)
+    replaced = pool.get(module, "weight", smaller)
+    assert replaced is not buffer and replaced.shape == smaller.shape
+    assert pool.total_bytes() == nbytes // 2 + 1024
+
+    assert pool.release(module) == nbytes // 2 + 1024 and pool.total_bytes() == 0
+    assert pool.get(other, "weight", other.weight) is not None and pool.release() == nbytes and pool.total_bytes() == 0
+
+
+def check_residency(output_directory):
+    '''
+    Residency manager with a fake device budget and clock: least recently used models are planned for eviction just
+    enough for the recalled model to fit
+    '''
+    import torch
+    from better_flow.residency import ResidencyManager
+
+    now = [0.0]
+    manager = ResidencyManager(budgets={"cuda:0": 250}, free_bytes_fn=None, clock=lambda: now[0])
+    a, b, c, d = (torch.nn.Linear(1, 1) for _ in range(4))
+    for name, model in (("a", a), ("b", b)):
+        now[0] += 1
+        manager.track(model, 100, "cuda:0", name=name)
+
+    plan = manager.plan(c, 100, "cuda:0")
+    assert plan.fits and plan.free_bytes == 50 and [r.name for r in plan.evict] == ["a"], plan.as_dict()
+    # used again, b becomes the least recently used
+    now[0] += 1
+    manager.track(a, 100, "cuda:0", name="a")
+    assert [r.name for r in manager.plan(c, 100, "cuda:0").evict] == ["b"]
+    # already on the device: nothing to evict
+    assert manager.plan(a, 100, "cuda:0").evict == []
+    assert not manager.plan(d, 1000, "cuda:0").fits
+
+    evicted = manager.apply(manager.plan(c, 100, "cuda:0"), lambda model: "cpu")
+    assert evicted == ["b"] and manager.used_bytes("cuda:0") == 100 and manager.used_bytes("cpu") == 100
+    manager.track(c, 100, "cuda:0", name="c")
+    assert manager.used_bytes("cuda:0") <= 250
+
+
+def check_partial(output_directory):
+    '''
+    Partial offload planning: blocks of the outermost ModuleList, last ones first, just enough to free the target bytes,
+    blocks already offloaded are not planned again
+    '''
+    import torch
+    from better_flow.partial_offload import offload_blocks, plan_partial_offload, partial_offload, offloaded_blocks
+    from better_flow.partial_offload import _nbytes
+    from better_flow.residency import device_key
+    from better_flow.device_ledger import get_ledger
+    from better_flow.offload_recall import offload_model_partially, get_model_info, ModelPatcher
+
+    class Model(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.embed = torch.nn.Linear(32, 32)
+            self.blocks = torch.nn.ModuleList(torch.nn.Sequential(torch.nn.Linear(32, 32), torch.nn.ModuleList([torch.nn.Linear(32, 32)]))
+                                              for _ in range(4))
+
+    module = Model()
+    block_bytes = 2 * (32 * 32 + 32) * 4
+    assert offload_blocks(module) == ["blocks.0", "blocks.1", "blocks.2", "blocks.3"], offload_blocks(module)
+    assert plan_partial_offload(module, "cpu", 0) == []
+    assert plan_partial_offload(module, "cpu", block_bytes) == ["blocks.3"]
+    assert plan_partial_offload(module, "cpu", block_bytes + 1) == ["blocks.3", "blocks.2"]
+    assert plan_partial_offload(module, "cpu", 100 * block_bytes) == ["blocks.3", "blocks.2", "blocks.1", "blocks.0"]
+    assert partial_offload(module, "cpu", "cpu", block_bytes) == []
+
+    # the meta device stands in for the offload device, no data is moved
+    assert partial_offload(module, "cpu", "meta", block_bytes + 1) == ["blocks.3", "blocks.2"]
+    assert offloaded_blocks(module) == {"blocks.3": "cpu", "blocks.2": "cpu"}
+    assert plan_partial_offload(module, "cpu", block_bytes + 1) == ["blocks.1", "blocks.0"]
+
+    # devices named with or without index are the same device for the planner and the ledger
+    assert device_key("cuda") == device_key("cuda:0") == device_key(torch.device("cuda", 0))
+    module = Model()
+    patcher = ModelPatcher(module, torch.device("cpu"), torch.device("meta"))
+    names = offload_model_partially(patcher, get_model_info(patcher, sync=True), "meta", fraction=0.5)
+    assert names and names[0] == "blocks.3", names
+    moved = len(names) * block_bytes
+    assert get_ledger(module).device_bytes() == {"cpu": _nbytes(module) - moved, "meta": moved}
+
+
+def check_compression(output_directory):
+    '''
+    Host compression: compress -> decompress restores the dtypes within the error bound of each mode (exactly for
+    lossless and for the excluded tensors), releases the staging buffers and restores a ModelPatcher (or a clone of it) loaded by ComfyUI
+    '''
+    import torch
+    from comfy.model_patcher import ModelPatcher
+    from better_flow.host_compression import compress_module, decompress_module, is_compressed
+    from better_flow.staging_buffers import STAGING_BUFFERS
+    from better_flow.offload_recall import compress_offloaded
+
+    # maximum relative RMS error of the lossy modes: rounding to 11 and 8 bits of mantissa, 8 bits per channel
+    rel_rms_bounds = {"fp16": 2 ** -11, "bf16": 2 ** -8, "int8": 2 ** -6, "lossless": 0.0}
+    torch.manual_seed(0)
+    for mode, bound in rel_rms_bounds.items():
+        module = torch.nn.Sequential(torch.nn.Linear(512, 512), torch.nn.LayerNorm(512), torch.nn.Linear(512, 64))
+        if mode == "lossless":
+            # trained weights have low entropy mantissas, random ones do not compress
+            module[0].weight.data = module[0].weight.data.to(torch.bfloat16).float()
+        state = _state(module)
+        report = compress_module(module, mode, measure_error=True)
+        assert report["tensors"] > 0 and report["saved_bytes"] > 0 and is_compressed(module), report
+        assert decompress_module(module) == report["tensors"] and not is_compressed(module)
+        restored = module.state_dict()
+        assert all(restored[name].dtype == tensor.dtype for name, tensor in state.items()), f"{mode}: dtype not restored"
+        for name, tensor in state.items():
+            error = (restored[name] - tensor).abs()
+            if mode == "lossless" or name.endswith("bias") or (mode == "int8" and tensor.dim() < 2):
+                assert torch.equal(restored[name], tensor), f"{mode}: {name} changed"
+            elif mode == "int8":
+                # half a quantization step of the channel
+                step = tensor.abs().amax(dim=1, keepdim=True) / 127
+                assert (error <= step / 2 + 1e-7).all(), f"int8: {name} error over half a step"
+        if mode != "lossless":
+            rel_rms = max(((restored[name] - tensor).square().sum() / tensor.square().sum()).sqrt().item()
+                          for name, tensor in state.items())
+            assert rel_rms <= bound and report["rel_rms_error"] <= bound, f"{mode}: relative RMS error {rel_rms} > {bound}"
+
+    class Patcher(ModelPatcher):
+        def clone(self):
+            # like ModelPatcher.clone: a new patcher sharing the module
+            return Patcher(self.model, self.load_device, self.offload_device)
+
+        def patch_model(self, *args, **kwargs):
+            return self.model
+
+    patcher = Patcher(torch.nn.Sequential(torch.nn.Linear(512, 512), torch.nn.Linear(512, 512)), "cpu", "cpu")
+    STAGING_BUFFERS.release()
+    STAGING_BUFFERS.get(patcher.model[0], "weight", patcher.model[0].weight)
+    report = compress_offloaded(patcher, "fp16", prefixes=["0"])
+    assert report["tensors"] == 1 and patcher.model[0].weight.dtype == torch.float16
+    assert STAGING_BUFFERS.total_bytes() == 0, "the staging buffers of the compressed block were not released"
+    # ComfyUI loading the compressed model on its own, or a clone of it (e.g. with a LoRA), restores its weights first
+    patcher.patch_model()
+    assert patcher.model[0].weight.dtype == torch.float32 and not is_compressed(patcher.model)
+    compress_offloaded(patcher, "int8")
+    clone = patcher.clone()
+    assert is_compressed(clone.model) and patcher.model[0].weight.dtype == torch.int8
+    clone.patch_model()
+    assert patcher.model[0].weight.dtype == torch.float32 and not is_compressed(patcher.model)
+
+
+def check_inference_hash(output_directory):
+    '''
+    Hashing tensors created under torch.inference_mode() (as ComfyUI runs the prompts): the hash nodes, the keys of
+    CacheAny and the fingerprint of offloaded weights hash their data, different tensors get different hashes
+    '''
+    import torch
+    from better_flow.common import get_hash_from_any, get_hash_from_list_any
+    from better_flow.md5_hash import AnyToHash, AnyToHashN
+    from better_flow.disk_offload import weights_fingerprint
+
+    with torch.inference_mode():
+        a, b = torch.rand(2, 1, 512, 512, 3)
+        a, b = a.clone(), b.clone()
+    assert a.is_inference() and b.is_inference()
+    for tree in (False, True):
+        for mode in ("exact", "sampled"):
+            digest = get_hash_from_any(a, tree=tree, mode=mode)
+            assert digest != get_hash_from_any(b, tree=tree, mode=mode), (tree, mode)
+            assert digest == get_hash_from_any(a, tree=tree, mode=mode) == get_hash_from_any(a.clone(), tree=tree, mode=mode)
+    assert get_hash_from_list_any([a, b]) != get_hash_from_list_any([b, a])
+
+    hash_a, = AnyToHash().to_md5_hash(a)
+    hash_b, = AnyToHash().to_md5_hash(b)
+    assert hash_a == get_hash_from_any(a) and hash_a != hash_b, (hash_a, hash_b)
+    assert AnyToHashN().to_hash_n(anything1=a, anything2=b)[0] == get_hash_from_list_any([a, b])
+    assert weights_fingerprint({"weight": a}) != weights_fingerprint({"weight": b})
+
+    # modified in place: the hash follows the data
+    with torch.inference_mode():
+        a.add_(1)
+    assert get_hash_from_any(a) != hash_a
+
+
+def check_warmer(output_directory):
+    '''
+    Cache warmer on a prompt shaped like the ones queued from the UI: any_key and the input of the hash node are links,
+    the hash published by the last execution of the hash node resolves the key of the next prompt of the queue
+    '''
+    import copy
+    import time
+    import torch
+    from better_flow.cache_any import CacheAny
+    from better_flow.md5_hash import AnyToHash
+    from better_flow.ram_cache import RAM_CACHE
+    from better_flow.cache_warmer import static_cache_paths, on_prompt
+
+    prompt = {
+        "1": {"class_type": "LoadImage", "inputs": {"image": "a.png", "upload": "image"}},
+        "2": {"class_type": "AnyToHash", "inputs": {"anything": ["1", 0], "algorithm": "md5", "tree_hash": False, "mode": "exact"}},
+        "3": {"class_type": "CacheAny", "inputs": {"any_to_cache": ["4", 0], "any_key": ["2", 0], "cache_name": "warm_check",
+                                                   "cleanup_on_mismatch": True, "force_recreate": False, "hash_algorithm": "md5",
+                                                   "tree_hash": False, "key_mode": "exact", "keep_in_ram": True}},
+        "4": {"class_type": "VAEDecode", "inputs": {"samples": ["1", 0], "vae": ["5", 0]}},
+        "5": {"class_type": "VAELoader", "inputs": {"vae_name": "ae.safetensors"}},
+    }
+    # widgets_values of the hash node are its options, as saved by the UI
+    extra_pnginfo = {"workflow": {"nodes": [{"id": 2, "type": "AnyToHash", "widgets_values": ["md5", False, "exact"]}]}}
+    assert static_cache_paths(copy.deepcopy(prompt), copy.deepcopy(extra_pnginfo)) == []
+
+    # execution of the first prompt
+    with torch.inference_mode():
+        image, decoded = torch.rand(1, 64, 64, 3), torch.rand(1, 64, 64, 3)
+    key, = AnyToHash().to_md5_hash(image, unique_id="2", prompt=prompt, extra_pnginfo=extra_pnginfo)
+    CacheAny.run_caching(decoded, key, "warm_check", True, False)
+    assert extra_pnginfo["workflow"]["nodes"][0]["widgets_values"] == ["md5", False, "exact"]
+    RAM_CACHE.clear()
+
+    # the same prompt queued again, as sent by the UI
+    paths = static_cache_paths(copy.deepcopy(prompt), {"workflow": {"nodes": [{"id": 2, "widgets_values": ["md5", False, "exact"]}]}})
+    assert len(paths) == 1 and paths[0][1].exists(), paths
+    on_prompt({"prompt": copy.deepcopy(prompt), "extra_data": {}})
+    deadline = time.monotonic() + 10
+    while str(paths[0][1]) not in RAM_CACHE and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert str(paths[0][1]) in RAM_CACHE, "the entry was not warmed"
+    in_ram, value = RAM_CACHE.get(paths[0][1])
+    assert in_ram and torch.equal(value, decoded)
+
+    # another input upstream of the hash node: unknown key, unless the saved workflow has the last hash
+    other = copy.deepcopy(prompt)
+    other["1"]["inputs"]["image"] = "b.png"
+    assert static_cache_paths(other, {"workflow": {"nodes": [{"id": 2, "widgets_values": ["md5", False, "exact"]}]}}) == []
+    assert static_cache_paths(other, extra_pnginfo) == paths
+
+
+def check_replace(output_directory):
+    '''
+    Replacing a CacheAny entry whose file is still memory-mapped by a previous read: the new entry goes to a new file,
+    the previous one is removed once it is not mapped anymore (simulated as on Windows, where a mapped file cannot be
+    replaced or removed)
+    '''
+    import os
+    import torch
+    import better_flow.cache_index as cache_index
+    from better_flow.cache_any import CacheAny
+    from better_flow.cache_format import load_entry
+    from better_flow.ram_cache import RAM_CACHE
+    from better_flow.common import get_cache_path
+
+    first, second = torch.zeros(4, 8), torch.ones(4, 8)
+    CacheAny.run_caching(first, "replace_key", "replace_check", True, False)
+    cache_path = get_cache_path("replace_key", "replace_check")
+    mapped = load_entry(cache_index.current_entry_file(cache_path))
+
+    remove = os.remove
+
+    def remove_unless_mapped(path, *args, **kwargs):
+        if os.path.basename(path) == cache_path.name:
+            raise PermissionError(f"{path} is memory-mapped")
+        return remove(path, *args, **kwargs)
+
+    cache_index.os.remove = remove_unless_mapped
+    try:
+        CacheAny.run_caching(second, "replace_key", "replace_check", True, True)
+        entry_file = cache_index.current_entry_file(cache_path)
+        assert entry_file is not None and entry_file != cache_path and cache_path.exists()
+        RAM_CACHE.clear()
+        cached, _ = CacheAny.run_caching(None, "replace_key", "replace_check", True, False)
+        assert torch.equal(cached, second) and torch.equal(mapped, first)
+    finally:
+        cache_index.os.remove = remove
+    index = cache_index.get_cache_index()
+    index.remove_stale_files()  # also retried by the janitor
+    assert not cache_path.exists()
+    assert cache_index.split_cache_filename(entry_file.name) == cache_index.split_cache_filename(cache_path.name)
+
+
+def check_background_write(output_directory):
+    '''
+    Background CacheAny write: modifying the node output in place after it is queued, or the value read from the
+    pending write, changes neither the written file nor the later reads
+    '''
+    import threading
+    import torch
+    import better_flow.cache_writer as cache_writer
+    from better_flow.cache_any import CacheAny
+    from better_flow.cache_format import load_entry
+    from better_flow.cache_index import current_entry_file
+    from better_flow.common import get_cache_path
+
+    release = threading.Event()
+    dump_entry = cache_writer.dump_entry
+
+    def held_dump_entry(*args, **kwargs):
+        release.wait(10)
+        return dump_entry(*args, **kwargs)
+
+    value = torch.zeros(4, 8)
+    cache_writer.dump_entry = held_dump_entry
+    try:
+        CacheAny.run_caching(value, "background_key", "background_check", False, False, keep_in_ram=False, write_mode="background")
+        value.add_(1)
+        cached, _ = CacheAny.run_caching(None, "background_key", "background_check", False, False, keep_in_ram=False)
+        assert torch.equal(cached, torch.zeros(4, 8))
+        cached.add_(2)
+        cached, _ = CacheAny.run_caching(None, "background_key", "background_check", False, False, keep_in_ram=False)
+        assert torch.equal(cached, torch.zeros(4, 8))
+    finally:
+        release.set()
+        cache_writer.dump_entry = dump_entry
+    cache_writer.flush_cache_writes()
+    entry_file = current_entry_file(get_cache_path("background_key", "background_check"))
+    assert entry_file is not None and torch.equal(load_entry(entry_file), torch.zeros(4, 8))
+
+
+def check_dedup(output_directory):
+    '''
+    Deduplicated CacheAny entries: blobs are shared and counted, collected with their last entry; an entry whose blobs
+    are collected before it is indexed, or deleted afterwards, is dropped and recomputed instead of failing the node
+    '''
+    import os
+    import torch
+    import better_flow.cache_index as cache_index
+    from better_flow.cache_any import CacheAny
+    from better_flow.cache_blobs import blob_path
+    from better_flow.cache_index import get_cache_index, current_entry_file, split_cache_filename
+    from better_flow.ram_cache import RAM_CACHE
+    from better_flow.common import get_cache_path
+
+    index = get_cache_index()
+    frames = torch.rand(4, 256, 256)  # one blob per frame
+
+    def run(value, key, **kwargs):
+        return CacheAny.run_caching(value, key, "dedup_check", False, False, storage="dedup", keep_in_ram=False, **kwargs)[0]
+
+    def refcounts():
+        return dict(index._execute("SELECT digest, refcount FROM blobs"))
+
+    run(frames, "first")
+    run(frames[:2].clone(), "second")
+    counts = refcounts()
+    assert sorted(counts.values()) == [1, 1, 2, 2], counts
+    first = get_cache_path("first", "dedup_check")
+    index.remove("dedup_check", split_cache_filename(first.name)[1], current_entry_file(first).name)
+    assert sorted(refcounts().values()) == [1, 1]
+    assert all(blob_path(index.blob_dir, digest).exists() for digest in refcounts())
+    assert torch.equal(run(None, "second"), frames[:2])
+
+    # the janitor collects the blobs of the removed entry while the same data is written again
+    record = cache_index.CacheIndex.record
+
+    def record_after_collect(self, cache_name, key_hash, filename, size, fmt=None, blobs=None):
+        for digest, _ in blobs or []:
+            if digest not in refcounts():
+                os.remove(blob_path(self.blob_dir, digest))
+        return record(self, cache_name, key_hash, filename, size, fmt, blobs)
+
+    cache_index.CacheIndex.record = record_after_collect
+    try:
+        assert torch.equal(run(frames, "first"), frames)
+    finally:
+        cache_index.CacheIndex.record = record
+    assert current_entry_file(first) is None
+    assert not CacheAny.entry_valid(first, "first", "dedup_check", "md5", False, "exact")
+    assert torch.equal(run(frames, "first"), frames)
+    assert current_entry_file(first) is not None
+
+    # a blob deleted behind the index: the entry is not valid anymore, its read is a miss
+    def delete_own_blob():
+        os.remove(blob_path(index.blob_dir, next(digest for digest, count in refcounts().items() if count == 1)))
+        RAM_CACHE.clear()
+
+    delete_own_blob()
+    assert torch.equal(run(frames, "first"), frames)
+    assert torch.equal(run(None, "first"), frames)
+    delete_own_blob()
+    assert not CacheAny.entry_valid(first, "first", "dedup_check", "md5", False, "exact")
+    assert current_entry_file(first) is None and index.lookup(*split_cache_filename(first.name)) is None
+
+
+def check_hash(output_directory):
+    '''
+    Key hashing: digests pinned across runs, independent of the order of dict items and of the memory layout of tensors,
+    the same with and without the tree hash whatever the number of workers of the tree hash, sampled hashes follow
+    the sampled data only
+    '''
+    import torch
+    import better_flow.common as common
+    from better_flow.common import get_hash_from_any, get_hash_from_list_any, combine_digests, clear_hash_memo, _digest_any, _hash_options
+
+    pinned = {"b": [1, 2.5, None], "a": ("x", True), "t": torch.arange(12, dtype=torch.float32).reshape(3, 4)}
+    assert get_hash_from_any(pinned) == "2e53a7890e5bda80235ec7f106c8ea02"
+    assert get_hash_from_any(pinned, algorithm="blake2b") == "05603ccc4b78388419021211bd900073"
+
+    torch.manual_seed(0)
+    cond, pooled = torch.rand(1, 77, 768), torch.rand(1, 1280)
+    conditioning = [[cond, {"pooled_output": pooled, "strength": 1.0}]]
+    same = [[cond.clone(), {"strength": 1.0, "pooled_output": pooled.clone()}]]
+    for algorithm in common.HASH_ALGORITHMS:
+        for mode in ("exact", "sampled"):
+            digest = get_hash_from_any(conditioning, algorithm=algorithm, mode=mode)
+            assert digest == get_hash_from_any(same, algorithm=algorithm, mode=mode), (algorithm, mode)
+            assert digest != get_hash_from_any([[cond, {"pooled_output": pooled, "strength": 0.5}]], algorithm=algorithm, mode=mode)
+            assert digest != get_hash_from_any([[cond.half(), {"pooled_output": pooled, "strength": 1.0}]], algorithm=algorithm, mode=mode)
+
+    matrix = torch.rand(64, 32)
+    assert get_hash_from_any(matrix.t()) == get_hash_from_any(matrix.t().contiguous())
+    assert get_hash_from_any(matrix) != get_hash_from_any(matrix.view(torch.int32))
+
+    # tree hash: several chunks, the result depends neither on the number of workers nor on the scheduling
+    latent = torch.rand(3, 1024, 1024)
+    tree_digest = get_hash_from_any(latent, tree=True)
+    assert tree_digest != get_hash_from_any(latent, tree=False)
+    workers, pool = common.TREE_HASH_WORKERS, common._TREE_HASH_POOL
+    common.TREE_HASH_WORKERS, common._TREE_HASH_POOL = 1, None
+    clear_hash_memo()
+    try:
+        assert get_hash_from_any(latent, tree=True) == tree_digest
+    finally:
+        common._TREE_HASH_POOL.shutdown()
+        common.TREE_HASH_WORKERS, common._TREE_HASH_POOL = workers, pool
+
+    # sampled: a change between the sampled pages goes unnoticed, a change of the first page does not
+    changed = latent.clone()
+    changed.view(-1)[latent.numel() // 2 + 1] += 1
+    assert get_hash_from_any(changed, mode="sampled") == get_hash_from_any(latent, mode="sampled")
+    assert get_hash_from_any(changed) != get_hash_from_any(latent)
+    changed.view(-1)[0] += 1
+    assert get_hash_from_any(changed, mode="sampled") != get_hash_from_any(latent, mode="sampled")
+    assert get_hash_from_any(latent, mode="sampled") == get_hash_from_any(latent, mode="sampled+verify")
+
+    # inputs of the multi input nodes: hashed apart (in parallel), combined in order
+    items = [conditioning, latent, "text", None]
+    options = _hash_options()
+    assert get_hash_from_list_any(items) == combine_digests([_digest_any(item, options) for item in items])
+    assert get_hash_from_list_any(items) != get_hash_from_list_any(items[::-1])
+    assert get_hash_from_list_any([latent]) == combine_digests([_digest_any(latent, options)])
+
+
+def check_format(output_directory):
+    '''
+    Cache file round trip for every storage and codec: tensors of any dtype, layout and size, numpy arrays and python
+    objects; large segments, the pickle stream included, are compressed in several chunks; legacy pickle files load
+    '''
+    import os
+    import pickle
+    import numpy as np
+    import torch
+    from better_flow.cache_format import STORAGE_FORMATS, CODECS, COMPRESSION_CHUNK_SIZE, dump_entry, load_entry, read_entry_header
+
+    torch.manual_seed(0)
+    big = torch.zeros(3 * COMPRESSION_CHUNK_SIZE // 4)
+    big[::7] = 1
+    obj = {
+        "image": torch.rand(2, 16, 16, 3),
+        "half": torch.rand(5, 3).half(),
+        "bf16": torch.rand(4).bfloat16(),
+        "int8": torch.randint(-128, 127, (33,), dtype=torch.int8),
+        "transposed": torch.rand(8, 4).t(),
+        "scalar": torch.tensor(3.5),
+        "empty": torch.empty(0, 4),
+        "big": big,
+        "array": np.arange(10, dtype=np.int16),
+        "text": [f"{i:08d}" * 10 for i in range(COMPRESSION_CHUNK_SIZE // 50)],
+        "value": (1, None, 2.5),
+    }
+
+    def same(a, b):
+        if isinstance(a, torch.Tensor):
+            return a.dtype == b.dtype and a.shape == b.shape and torch.equal(a, b)
+        if isinstance(a, np.ndarray):
+            return a.dtype == b.dtype and np.array_equal(a, b)
+        if isinstance(a, dict):
+            return a.keys() == b.keys() and all(same(a[key], b[key]) for key in a)
+        return a == b
+
+    for storage in STORAGE_FORMATS:
+        for codec in CODECS:
+            path = os.path.join(output_directory, f"format_check+{storage}-{codec}.pkl")
+            size = dump_entry(obj, path, storage=storage, codec=codec, meta={"key_digest": "abc"})
+            assert size == os.path.getsize(path)
+            assert same(load_entry(path), obj), (storage, codec)
+            header = read_entry_header(path)
+            assert header["format"] == storage and header["meta"] == {"key_digest": "abc"}
+            if codec != "none":
+                # the pickle stream of the list of strings spans several compression chunks
+                assert header["compressed"][0] is not None and len(header["compressed"][0][1]) > 1, (storage, codec)
+
+    legacy = os.path.join(output_directory, "format_check+legacy.pkl")
+    with open(legacy, "wb") as f:
+        pickle.dump(obj["value"], f)
+    assert load_entry(legacy) == obj["value"]
+
+
+def check_index(output_directory):
+    '''
+    Cache index: a new index registers the files of the cache folder (the newest file of a replaced entry, the blobs of
+    deduplicated entries), drops the entries whose file is gone and the blobs nobody references
+    '''
+    import os
+    import time
+    import torch
+    from better_flow.cache_index import CacheIndex
+    from better_flow.cache_format import dump_entry
+    from better_flow.cache_blobs import get_blob_dir
+
+    cache_dir = os.path.join(output_directory, "index_check")
+    os.makedirs(cache_dir)
+    value = torch.rand(2, 256, 256)
+    dump_entry(value, os.path.join(cache_dir, "a+k1.pkl"))
+    time.sleep(0.01)
+    dump_entry(value + 1, os.path.join(cache_dir, "a+k1.0badc0de.pkl"))
+    dump_entry(value, os.path.join(cache_dir, "a+k2.pkl"), storage="dedup")
+    dump_entry(value, os.path.join(cache_dir, "b+k1.pkl"), storage="dedup")
+    dump_entry(torch.rand(2, 256, 256), os.path.join(cache_dir, "c+orphan.pkl"), storage="dedup")
+    os.remove(os.path.join(cache_dir, "c+orphan.pkl"))
+    with open(os.path.join(cache_dir, "not_an_entry.txt"), "w") as f:
+        f.write("ignored")
+
+    index = CacheIndex(cache_dir)
+    assert index.lookup("a", "k1")["filename"] == "a+k1.0badc0de.pkl"
+    assert not os.path.exists(os.path.join(cache_dir, "a+k1.pkl"))
+    assert {name for name, _ in index._execute("SELECT cache_name, key_hash FROM entries")} == {"a", "b"}
+    assert sorted(count for _, count in index._execute("SELECT digest, refcount FROM blobs")) == [2, 2]
+    blobs = sorted(path.name for path in get_blob_dir(cache_dir).glob("*/*"))
+    assert blobs == sorted(digest for digest, in index._execute("SELECT digest FROM blobs")), blobs
+    assert index.total_size() == sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith(".pkl")) + \
+        sum(size for size, in index._execute("SELECT size FROM blobs"))
+
+    os.remove(os.path.join(cache_dir, "a+k2.pkl"))
+    index.reconcile()
+    assert index.lookup("a", "k2") is None and index.lookup("b", "k1") is not None
+    index._conn.close()
+
+
+def check_limits(output_directory):
+    '''
+    Cache limits: entries not accessed within the time to live are removed, then the least recently used ones over a
+    cache_name quota and over the disk budget; cleanup_on_mismatch removes the entries of a cache_name with another key
+    '''
+    import os
+    import time
+    import torch
+    from better_flow.cache_any import CacheAny
+    from better_flow.cache_index import CacheIndex, get_cache_index, current_entry_file
+    from better_flow.cache_format import dump_entry
+    from better_flow.common import get_cache_path
+
+    cache_dir = os.path.join(output_directory, "limits_check")
+    index = CacheIndex(cache_dir)
+
+    def write(cache_name, key_hash, age_s):
+        filename = f"{cache_name}+{key_hash}.pkl"
+        size = dump_entry(torch.zeros(64 * 1024), os.path.join(cache_dir, filename))
+        index.record(cache_name, key_hash, filename, size)
+        index._execute("UPDATE entries SET last_access=? WHERE cache_name=? AND key_hash=?", (time.time() - age_s, cache_name, key_hash))
+        return size
+
+    def keys(cache_name):
+        return sorted(key for key, in index._execute("SELECT key_hash FROM entries WHERE cache_name=?", (cache_name,)))
+
+    size = write("ttl", "old", 7200)
+    write("ttl", "new", 60)
+    index.ttl_seconds = 3600
+    assert index.enforce_limits() == 1 and keys("ttl") == ["new"]
+    assert not os.path.exists(os.path.join(cache_dir, "ttl+old.pkl"))
+    index.ttl_seconds = 0
+
+    for age, key in enumerate(["k4", "k3", "k2", "k1"]):
+        write("quota", key, age)
+    index.set_quota("quota", 2 * size)
+    assert index.enforce_limits() == 2 and keys("quota") == ["k3", "k4"]
+    assert index.total_size("quota") == 2 * size
+    index.touch("quota", "k3")
+    index.set_quota("quota", size)
+    assert index.enforce_limits() == 1 and keys("quota") == ["k3"]
+    index.set_quota("quota", 0)
+
+    write("budget", "k1", 7200)
+    index.disk_budget_bytes = index.total_size() - 1
+    assert index.enforce_limits() == 1 and keys("budget") == [] and keys("ttl") == ["new"] and keys("quota") == ["k3"]
+    index.disk_budget_bytes = 0
+    index._conn.close()
+
+    # cleanup_on_mismatch
+    get_cache_index()
+    for key in ("first", "second"):
+        CacheAny.run_caching(torch.zeros(4), key, "mismatch_check", False, False)
+    CacheAny.run_caching(torch.ones(4), "third", "mismatch_check", True, False)
+    assert [current_entry_file(get_cache_path(key, "mismatch_check")) is not None for key in ("first", "second", "third")] == [False, False, True]
+    CacheAny.run_caching(torch.ones(4), "fourth", "mismatch_check", False, False)
+    assert current_entry_file(get_cache_path("third", "mismatch_check")) is not None
+
+
+CHECKS = {
+    "disk": check_disk,
+    "staging": check_staging,
+    "residency": check_residency,
+    "partial": check_partial,
+    "compression": check_compression,
+    "inference_hash": check_inference_hash,
+    "warmer": check_warmer,
+    "replace": check_replace,
+    "background_write": check_background_write,
+    "dedup": check_dedup,
+    "hash": check_hash,
+    "format": check_format,
+    "index": check_index,
+    "limits": check_limits,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checks", default=",".join(CHECKS), help="comma separated list of " + ",".join(CHECKS))
+    args = parser.parse_args()
+    checks = [name.strip() for name in args.checks.split(",") if name.strip()]
+    unknown = [name for name in checks if name not in CHECKS]
+    if unknown:
+        parser.error(f"unknown checks {unknown}, expected some of {list(CHECKS)}")
+
+    failed = []
+    with tempfile.TemporaryDirectory() as output_directory:
+        _install_stubs(output_directory)
+        _import_package()
+        for name in checks:
+            try:
+                CHECKS[name](output_directory)
+                print(f"{name:16s} ok", flush=True)
+            except Exception:
+                failed.append(name)
+                print(f"{name:16s} FAILED", flush=True)
+                traceback.print_exc()
+    if failed:
+        print(f"{len(failed)} check(s) failed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
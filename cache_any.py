@@ -2,8 +2,16 @@ import pickle
 import hashlib
 from pathlib import Path
 import os
-import re
-from .common import any_type, c_R, c_Y, c_B, c_G, c_P, c_0, CACHE_DIR, get_cache_path
+from .common import any_type, c_R, c_Y, c_B, c_G, c_P, c_0, get_cache_dir, HASH_ALGORITHMS, HASH_MODES, get_cache_path, get_key_hash
+from .common import record_cache_event, record_cache_timing, cache_timer, get_cache_stats
+import json
+import time
+from .ram_cache import RAM_CACHE
+from .cache_format import STORAGE_FORMATS, CODECS, dump_entry, load_entry, entry_blobs, read_entry_header
+from .cache_index import get_cache_index, split_cache_filename, wake_janitor, current_entry_file, replacement_path, MissingBlobsError
+from .cache_writer import CACHE_WRITER
+from .prefetch import prefetch
+from .cache_warmer import CACHE_WARMER
 import numpy as np
 
 
@@ -20,6 +28,17 @@ class CacheAny:
                 "cleanup_on_mismatch": ("BOOLEAN", {"default": True}),
                 "force_recreate": ("BOOLEAN", {"default": False}),
             },
+            "optional": {
+                "hash_algorithm": (HASH_ALGORITHMS, {"default": "md5", "tooltip": "Digest used to hash any_key. Changing it invalidates the existing cache files."}),
+                "tree_hash": ("BOOLEAN", {"default": False, "tooltip": "Hash large tensors of any_key in chunks on all cores (also enabled globally by BETTER_FLOW_TREE_HASH=1). Changing it invalidates the existing cache files."}),
+                "key_mode": (HASH_MODES, {"default": "exact", "tooltip": "exact: all the data of any_key is hashed. sampled: large tensors of any_key are identified by a fixed-size sample of their data (much faster, a collision is unlikely but possible). sampled+verify: sampled lookup, the exact hash is stored in the cache file and checked on a hit."}),
+                "storage": (STORAGE_FORMATS, {"default": "tensor", "tooltip": "tensor: tensors and arrays are stored raw and memory-mapped on load, the rest is pickled. pickle: the whole object is pickled. dedup: like tensor, but the data is stored by content and shared between entries (e.g. identical frames)."}),
+                "compression": (CODECS, {"default": "none", "tooltip": "Compress the cache file (lz4: fast, zstd: smaller). Data that does not compress well is stored raw. Reads detect the codec automatically."}),
+                "compression_level": ("INT", {"default": 3, "min": 0, "max": 22, "tooltip": "Compression level (zstd: 1-22, lz4: 0-16)"}),
+                "keep_in_ram": ("BOOLEAN", {"default": True, "tooltip": "Keep the cached value in RAM (shared LRU, budget set by BETTER_FLOW_RAM_CACHE_MB) so later hits skip reading the file."}),
+                "write_mode": (["sync", "background"], {"default": "sync", "tooltip": "background: on a cache miss the value is returned immediately and written to disk by a background thread."}),
+                "quota_mb": ("INT", {"default": 0, "min": 0, "max": 1 << 30, "tooltip": "Maximum disk size of the files of this cache_name, least recently used ones are removed first. 0 = no quota."}),
+            },
         }
 
     # MODIFIED: Added IMAGE passthrough
@@ -28,29 +47,93 @@ class CacheAny:
     FUNCTION = "run_caching"
     CATEGORY = "workflow"
 
+    @staticmethod
+    def entry_exists(cache_path) -> bool:
+        # entries queued for a background write count as existing
+        return current_entry_file(cache_path) is not None or CACHE_WRITER.is_pending(cache_path)
+
+    @staticmethod
+    def key_verified(cache_path, exact_hash) -> bool:
+        '''
+        sampled+verify: compare the exact hash of the key to the one stored with the entry
+        '''
+        meta = CACHE_WRITER.pending_meta(cache_path)
+        if meta is None:
+            entry_file = current_entry_file(cache_path)
+            header = read_entry_header(entry_file) if entry_file is not None else None
+            meta = header["meta"] if header is not None else {}
+        # entries written without verification are named after the exact hash of their key
+        _, key_hash = split_cache_filename(cache_path.name)
+        return meta.get("key_digest", key_hash) == exact_hash
+
+    @staticmethod
+    def read_entry(cache_path, cache_name, keep_in_ram=True):
+        '''
+        Value of an existing entry, from RAM if it is there, else from its file
+        '''
+        in_ram, cached_data = RAM_CACHE.get(cache_path)
+        if in_ram:
+            print(f"{CLASS_STR}-{cache_name} {c_G}read from RAM{c_0}")
+            record_cache_event(cache_name, "hits_ram")
+            if CACHE_WARMER.consumed(cache_path):
+                record_cache_event(cache_name, "hits_warmed")
+            return cached_data
+        entry_file = current_entry_file(cache_path)
+        if entry_file is None:
+            raise FileNotFoundError(f"No cache entry {cache_path.name}")
+        with cache_timer(cache_name, "deserialize"):
+            cached_data = load_entry(entry_file)
+        record_cache_event(cache_name, "bytes_read", entry_file.stat().st_size)
+        if keep_in_ram:
+            RAM_CACHE.put(cache_path, cached_data)
+        return cached_data
+
+    @staticmethod
+    def entry_intact(cache_path, cache_name) -> bool:
+        '''
+        False if blobs of a deduplicated entry are missing, the entry is then removed
+        '''
+        _, key_hash = split_cache_filename(cache_path.name)
+        index = get_cache_index()
+        missing = index.missing_blobs(cache_name, key_hash)
+        if missing:
+            print(f"{CLASS_STR}-{cache_name} {c_R}{missing} blobs of {cache_path.name} are missing, removing the entry{c_0}")
+            entry_file = current_entry_file(cache_path)
+            index.remove(cache_name, key_hash, entry_file.name if entry_file is not None else cache_path.name)
+        return not missing
+
     @classmethod
-    def IS_CHANGED(cls, any_to_cache, any_key, cache_name, force_recreate, *args, **kwargs):
+    def entry_valid(cls, cache_path, any_key, cache_name, hash_algorithm, tree_hash, key_mode) -> bool:
+        if not cls.entry_exists(cache_path) or not cls.entry_intact(cache_path, cache_name):
+            return False
+        if key_mode != "sampled+verify":
+            return True
+        exact_hash = get_key_hash(any_key, cache_name, ignore_errors=True, algorithm=hash_algorithm, tree=tree_hash or None)
+        return exact_hash is not None and cls.key_verified(cache_path, exact_hash)
+
+    @classmethod
+    def IS_CHANGED(cls, any_to_cache, any_key, cache_name, force_recreate, hash_algorithm="md5", tree_hash=False, key_mode="exact", *args, **kwargs):
         if force_recreate:
             return float("NaN")
-        cache_path = get_cache_path(any_key, cache_name, ignore_errors=True)
-        if cache_path is None or not cache_path.exists():
+        cache_path = get_cache_path(any_key, cache_name, ignore_errors=True, algorithm=hash_algorithm, tree=tree_hash or None, mode=key_mode)
+        if cache_path is None or not cls.entry_valid(cache_path, any_key, cache_name, hash_algorithm, tree_hash, key_mode):
             return float("NaN")
         print(f"{CLASS_STR}-{cache_name} is_changed={cache_path}")
         return str(cache_path)
 
     @classmethod
-    def check_lazy_status(cls, any_to_cache, any_key, cache_name, force_recreate, *args, **kwargs):
+    def check_lazy_status(cls, any_to_cache, any_key, cache_name, force_recreate, hash_algorithm="md5", tree_hash=False, key_mode="exact", *args, **kwargs):
         if any_key is None:
             print(f"{CLASS_STR}-{cache_name} {c_R}Error, the any_key input is required but given as None.{c_0}")
-        cache_path = get_cache_path(any_key, cache_name)   
-        if cache_path.exists() and not force_recreate:
+        cache_path = get_cache_path(any_key, cache_name, algorithm=hash_algorithm, tree=tree_hash or None, mode=key_mode)   
+        if not force_recreate and cls.entry_valid(cache_path, any_key, cache_name, hash_algorithm, tree_hash, key_mode):
             print(f"{CLASS_STR}-{cache_name} check_lazy_status {c_G}discards evaluation{c_0} of any_to_cache input.")
             return None
         print(f"{CLASS_STR}-{cache_name} check_lazy_status {c_Y}requests evaluation{c_0} of any_to_cache input.")
         return ["any_to_cache"]
 
     @classmethod
-    def run_caching(cls, any_to_cache, any_key, cache_name, cleanup_on_mismatch, force_recreate, *args, **kwargs):
+    def run_caching(cls, any_to_cache, any_key, cache_name, cleanup_on_mismatch, force_recreate, hash_algorithm="md5", tree_hash=False, key_mode="exact", storage="tensor", compression="none", compression_level=3, keep_in_ram=True, write_mode="sync", quota_mb=0, *args, **kwargs):
         if any_key is None:
             raise TypeError(f"Nonetype error for any_key input")
         if cache_name is None:
@@ -62,35 +145,158 @@ class CacheAny:
         if cache_name.find("+") >= 0:
             raise ValueError(f"Please do not use the character '+' in they cache_name={cache_name}")
         
-        os.makedirs(CACHE_DIR, exist_ok=True)
-        cache_path = get_cache_path(any_key, cache_name, verbose=True)
+        os.makedirs(get_cache_dir(), exist_ok=True)
+        cache_path = get_cache_path(any_key, cache_name, verbose=True, algorithm=hash_algorithm, tree=tree_hash or None, mode=key_mode)
 
-        current_hash = re.match(rf'{re.escape(cache_name)}+([a-fA-F0-9]{{32}})\.pkl$',str(cache_path))
-        parent_folder = cache_path.parent
+        index = get_cache_index()
+        index.set_quota(cache_name, quota_mb * 1024 * 1024)
+        _, key_hash = split_cache_filename(cache_path.name)
         if cleanup_on_mismatch:
-            # Search for other files with same key but different hash
-            other_versions = []
-            for file in parent_folder.glob(f"{cache_name}+*.pkl"):
-                file_match = re.match(rf"{re.escape(cache_name)}+([a-fA-F0-9]{{32}})\.pkl", file.name)
-                if file_match:
-                    file_hash = file_match.group(1)
-                    if file_hash != current_hash:
-                        other_versions.append(file)
-            print(f"Found {len(other_versions)} other cache files with the same key, cleaning up...")
-            for fn in other_versions:
-                os.remove(fn)
-
-        if cache_path.exists() and not force_recreate:
-            with open(cache_path, 'rb') as f:
-                cached_data = pickle.load(f)
-            # Passthrough inputs
+            with cache_timer(cache_name, "cleanup"):
+                # Entries with the same cache name but a different key hash
+                other_versions = index.other_versions(cache_name, key_hash)
+                print(f"Found {len(other_versions)} other cache files with the same key, cleaning up...")
+                for other_hash, filename in other_versions:
+                    index.remove(cache_name, other_hash, filename)
+
+        if force_recreate:
+            record_cache_event(cache_name, "forced_recreates")
+
+        meta = None
+        if key_mode == "sampled+verify":
+            exact_hash = get_key_hash(any_key, cache_name, algorithm=hash_algorithm, tree=tree_hash or None)
+            meta = {"key_digest": exact_hash}
+            if not force_recreate and cls.entry_exists(cache_path) and not cls.key_verified(cache_path, exact_hash):
+                # same sampled fingerprint, different key: the entry is replaced
+                print(f"{CLASS_STR}-{cache_name} {c_R}the exact hash of the key does not match the entry, recreating it{c_0}")
+                record_cache_event(cache_name, "verify_mismatches")
+                force_recreate = True
+
+        being_written, cached_data = CACHE_WRITER.pending(cache_path)
+        if being_written and not force_recreate:
+            print(f"{CLASS_STR}-{cache_name} {c_G}read from the pending background write{c_0}")
+            record_cache_event(cache_name, "hits")
+            record_cache_event(cache_name, "hits_pending_write")
             return (cached_data, any_key,)
 
-        with open(cache_path, 'wb') as f:
-            pickle.dump(any_to_cache, f)
+        entry_file = current_entry_file(cache_path)
+        if entry_file is not None and not force_recreate:
+            # the file on disk is the reference, the RAM tier only spares reading it
+            try:
+                cached_data = cls.read_entry(cache_path, cache_name, keep_in_ram)
+            except (OSError, ValueError) as e:
+                entry = index.lookup(cache_name, key_hash)
+                if entry is None or entry["format"] != "dedup":
+                    raise
+                # blobs deleted or damaged: the entry is removed and recomputed
+                print(f"{CLASS_STR}-{cache_name} {c_R}could not read {entry_file.name} ({e}), removing the entry{c_0}")
+                index.remove(cache_name, key_hash, entry_file.name)
+                entry_file = None
+                if any_to_cache is None:
+                    raise RuntimeError(f"The entry {cache_path.name} was unreadable and removed, queue the prompt again to recompute it") from e
+            else:
+                record_cache_event(cache_name, "hits")
+                if not index.touch(cache_name, key_hash):
+                    # file written before the index existed
+                    index.record(cache_name, key_hash, entry_file.name, entry_file.stat().st_size)
+                # Passthrough inputs
+                return (cached_data, any_key,)
 
+        record_cache_event(cache_name, "misses")
+        # an entry being replaced is written to a new file, the current one can still be memory-mapped by its readers
+        target = replacement_path(cache_path) if entry_file is not None or cache_path.exists() else cache_path
 
+        def on_written(size, elapsed_s):
+            record_cache_timing(cache_name, "serialize", elapsed_s)
+            record_cache_event(cache_name, "bytes_written", size)
+            blobs = entry_blobs(target) if storage == "dedup" else None
+            try:
+                index.record(cache_name, key_hash, target.name, size, storage, blobs=blobs)
+            except MissingBlobsError as e:
+                # blobs shared with a removed entry were collected before this one referenced them
+                print(f"{CLASS_STR}-{cache_name} {c_R}{e}, the entry is not cached{c_0}")
+            wake_janitor()
+
+        if write_mode == "background":
+            print(f"{CLASS_STR}-{cache_name} {c_Y}queued for a background write{c_0}")
+            CACHE_WRITER.submit(cache_path, any_to_cache, on_done=on_written, file_path=target,
+                                storage=storage, codec=compression, level=compression_level, meta=meta)
+        else:
+            start = time.perf_counter()
+            size = dump_entry(any_to_cache, target, storage=storage, codec=compression, level=compression_level, meta=meta)
+            on_written(size, time.perf_counter() - start)
+        if keep_in_ram:
+            RAM_CACHE.put(cache_path, any_to_cache)
+        else:
+            RAM_CACHE.discard(cache_path)
 
-        
         # Passthrough inputs
-        return (any_to_cache, any_key,)
\ No newline at end of file
+        return (any_to_cache, any_key,)
+
+
+class PrefetchCache:
+    @classmethod
+    def INPUT_TYPES(cls):
+        cache_inputs = CacheAny.INPUT_TYPES()
+        return {
+            "required": {
+                "any_key": (any_type, ),
+                "cache_name": ("STRING", {"default": "output"}),
+            },
+            "optional": {name: cache_inputs["optional"][name] for name in ("hash_algorithm", "tree_hash", "key_mode")},
+        }
+
+    RETURN_TYPES = (any_type, any_type,)
+    RETURN_NAMES = ("cached_handle", "key_passthrough",)
+    OUTPUT_TOOLTIPS = ("Connect to the main input of a Wait / Wait xN node, which outputs the cached value (None if there is no entry). Other nodes receive the handle, not the value.", "any_key, unchanged",)
+    FUNCTION = "prefetch_cache"
+    CATEGORY = "workflow"
+
+    @classmethod
+    def read_cached(cls, any_key, cache_name, hash_algorithm="md5", tree_hash=False, key_mode="exact"):
+        '''
+        Value of the CacheAny entry of any_key, kept in RAM so that the CacheAny node with the same key reads it from there.
+        None on a miss: the prompt goes on, the CacheAny node with the same key computes the value.
+        '''
+        cache_path = get_cache_path(any_key, cache_name, algorithm=hash_algorithm, tree=tree_hash or None, mode=key_mode)
+        if not CacheAny.entry_valid(cache_path, any_key, cache_name, hash_algorithm, tree_hash, key_mode):
+            print(f"{CLASS_STR}-{cache_name} {c_Y}nothing to prefetch, no entry {cache_path.name}{c_0}")
+            record_cache_event(cache_name, "prefetch_misses")
+            return None
+        being_written, cached_data = CACHE_WRITER.pending(cache_path)
+        if being_written:
+            return cached_data
+        record_cache_event(cache_name, "prefetches")
+        return CacheAny.read_entry(cache_path, cache_name, keep_in_ram=True)
+
+    def prefetch_cache(self, any_key, cache_name, hash_algorithm="md5", tree_hash=False, key_mode="exact"):
+        # the key is hashed and the entry read on the prefetch thread
+        print(f"{CLASS_STR}-{cache_name} {c_Y}prefetching in the background{c_0}")
+        handle = prefetch(self.read_cached, any_key, cache_name, hash_algorithm, tree_hash, key_mode,
+                          description=f"cache read of {cache_name}")
+        return (handle, any_key,)
+
+
+class CacheStats:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {},
+            "optional": {
+                "trigger_value": (any_type, ),
+                "cache_name": ("STRING", {"default": "", "tooltip": "Statistics of this cache name only, all of them if empty."}),
+            },
+        }
+
+    RETURN_TYPES = ("STRING", any_type,)
+    RETURN_NAMES = ("stats_json", "trigger_passthrough",)
+    FUNCTION = "get_stats"
+    CATEGORY = "workflow"
+
+    @classmethod
+    def IS_CHANGED(cls, *args, **kwargs):
+        return float("NaN")
+
+    def get_stats(self, trigger_value=None, cache_name=""):
+        stats = get_cache_stats(cache_name if cache_name else None)
+        return (json.dumps(stats, indent=2), trigger_value,)
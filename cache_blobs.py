@@ -0,0 +1,85 @@
+import os
+import mmap
+import hashlib
+import threading
+from pathlib import Path
+from .common import _iter_tensor_chunks
+
+# Content-addressed store of the data of deduplicated CacheAny entries (storage=dedup).
+# Tensors are cut in chunks following their first dimension (one chunk per frame of an IMAGE batch, frames
+# smaller than DEDUP_MIN_CHUNK are grouped, larger than DEDUP_MAX_CHUNK are split), each chunk is stored once
+# in CACHE_DIR/blobs/<digest[:2]>/<digest>, whatever the entry referencing it.
+# The index (cache_index) counts the references to each blob and deletes the unreferenced ones.
+
+BLOB_DIR_NAME = "blobs"
+DEDUP_MIN_CHUNK = 256 * 1024
+DEDUP_MAX_CHUNK = 16 * 1024 * 1024
+
+
+def get_blob_dir(cache_dir) -> Path:
+    return Path(cache_dir) / BLOB_DIR_NAME
+
+
+def blob_path(blob_dir, digest) -> Path:
+    return Path(blob_dir) / digest[:2] / digest
+
+
+def blob_digest(data) -> str:
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def iter_dedup_chunks(tensor):
+    '''
+    Yield the raw memory of a tensor in chunks aligned on its first dimension
+    '''
+    n_bytes = tensor.element_size() * tensor.numel()
+    if tensor.dim() == 0 or tensor.shape[0] == 0 or n_bytes == 0:
+        yield from _iter_tensor_chunks(tensor, DEDUP_MAX_CHUNK)
+        return
+    frame_bytes = n_bytes // tensor.shape[0]
+    if frame_bytes <= DEDUP_MAX_CHUNK:
+        frames_per_chunk = max(1, DEDUP_MIN_CHUNK // max(1, frame_bytes))
+        yield from _iter_tensor_chunks(tensor, frame_bytes * frames_per_chunk)
+    else:
+        for frame in tensor:
+            yield from _iter_tensor_chunks(frame, DEDUP_MAX_CHUNK)
+
+
+def split_buffer(buffer):
+    return [buffer[start:start + DEDUP_MAX_CHUNK] for start in range(0, len(buffer), DEDUP_MAX_CHUNK)]
+
+
+def write_blob(blob_dir, data) -> list:
+    '''
+    Store a chunk unless a blob with the same content exists, returns [digest, size]
+    '''
+    digest = blob_digest(data)
+    path = blob_path(blob_dir, digest)
+    if not path.exists():
+        os.makedirs(path.parent, exist_ok=True)
+        tmp_path = path.with_name(f"{digest}.{os.getpid()}-{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                os.remove(tmp_path)
+    return [digest, len(data)]
+
+
+def read_blobs(blob_dir, blobs) -> memoryview:
+    '''
+    Data of a segment stored as blobs, a single blob is memory-mapped (copy-on-write), several are read and joined
+    '''
+    if len(blobs) == 1 and blobs[0][1] > 0:
+        with open(blob_path(blob_dir, blobs[0][0]), 'rb') as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+    out = bytearray(sum(size for _, size in blobs))
+    view = memoryview(out)
+    offset = 0
+    for digest, size in blobs:
+        with open(blob_path(blob_dir, digest), 'rb') as f:
+            f.readinto(view[offset:offset + size])
+        offset += size
+    return view
@@ -0,0 +1,319 @@
+import io
+import os
+import json
+import mmap
+import pickle
+import struct
+import threading
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from .common import _iter_tensor_chunks
+from .cache_blobs import get_blob_dir, iter_dedup_chunks, split_buffer, write_blob, read_blobs
+
+try:
+    import lz4.frame
+    LZ4_AVAILABLE = True
+except ImportError:
+    LZ4_AVAILABLE = False
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+# File format of the CacheAny entries
+#
+#   MAGIC (8 bytes) | header length (8 bytes, little endian) | json header | segments
+#
+# Each segment starts at a multiple of ALIGNMENT, offsets in the header are relative to the first segment.
+# Tensors and numpy arrays are stored as raw segments, the rest of the object goes in a pickle (protocol 5)
+# segment referencing them. Loading maps the file in memory (copy-on-write) so tensors are not read until used.
+# Files without MAGIC are plain pickles written by previous versions.
+#
+# Segments can be compressed (codec in the header): they are cut in chunks compressed in parallel,
+# segments which compress poorly (judged on a sample) are stored raw.
+#
+# With storage=dedup, tensors and buffers are not in the file: they are stored as content-addressed blobs
+# (see cache_blobs) listed in the header.
+
+MAGIC = b"BFCACHE1"
+ALIGNMENT = 64
+_HEADER_LEN = struct.Struct("<Q")
+
+
+class _TensorPickler(pickle.Pickler):
+    '''
+    Pickler storing tensors apart from the pickle stream, referenced by their index
+    '''
+
+    def __init__(self, file, tensors, buffers):
+        super().__init__(file, protocol=5, buffer_callback=self._keep_buffer)
+        self._tensors = tensors
+        self._buffers = buffers
+
+    def persistent_id(self, obj):
+        if type(obj) is torch.Tensor and obj.layout == torch.strided:
+            self._tensors.append(obj)
+            return ("tensor", len(self._tensors) - 1)
+        return None
+
+    def _keep_buffer(self, buffer):
+        # out-of-band buffers (numpy arrays), returning False keeps them out of the stream
+        self._buffers.append(buffer)
+        return False
+
+
+class _TensorUnpickler(pickle.Unpickler):
+    def __init__(self, file, tensors, buffers):
+        super().__init__(file, buffers=buffers)
+        self._tensors = tensors
+
+    def persistent_load(self, pid):
+        kind, index = pid
+        if kind != "tensor":
+            raise pickle.UnpicklingError(f"Unknown persistent id {pid}")
+        return self._tensors[index]
+
+
+def _serialize_tensor(obj):
+    tensors, buffers = [], []
+    stream = io.BytesIO()
+    _TensorPickler(stream, tensors, buffers).dump(obj)
+    return stream.getbuffer(), tensors, buffers
+
+
+def _serialize_pickle(obj):
+    return memoryview(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)), [], []
+
+
+# Storage backends: serialize an object to (pickle stream, tensors stored apart, out-of-band buffers)
+STORAGE_BACKENDS = {
+    "tensor": _serialize_tensor,
+    "pickle": _serialize_pickle,
+    "dedup": _serialize_tensor,
+}
+STORAGE_FORMATS = list(STORAGE_BACKENDS.keys())
+
+
+# Compression codecs, lz4 and zstd are optional (pip install lz4 zstandard)
+CODECS = ["none"]
+if LZ4_AVAILABLE:
+    CODECS.append("lz4")
+if ZSTD_AVAILABLE:
+    CODECS.append("zstd")
+
+COMPRESSION_CHUNK_SIZE = 4 * 1024 * 1024
+COMPRESSION_SAMPLE_SIZE = 256 * 1024
+# segments compressing to more than this fraction of their size (judged on a sample) are stored raw
+COMPRESSION_MAX_RATIO = 0.9
+_COMPRESSION_MIN_SIZE = 1024
+
+_CODEC_POOL = None
+_CODEC_POOL_LOCK = threading.Lock()
+
+
+def _get_codec_pool() -> ThreadPoolExecutor:
+    # lz4 and zstd release the GIL, chunks are (de)compressed on all cores
+    global _CODEC_POOL
+    with _CODEC_POOL_LOCK:
+        if _CODEC_POOL is None:
+            _CODEC_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="CacheAny-codec")
+    return _CODEC_POOL
+
+
+def _compress(data, codec, level) -> bytes:
+    if codec == "lz4":
+        return lz4.frame.compress(data, compression_level=min(level, 16))
+    elif codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"Unknown or unavailable codec={codec}, expected one of {CODECS}")
+
+
+def _decompress(data, codec, raw_size) -> bytes:
+    if codec == "lz4":
+        return lz4.frame.decompress(data)
+    elif codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=raw_size)
+    raise ValueError(f"Cannot decompress codec={codec}, install it first (pip install lz4 zstandard)")
+
+
+def _compress_segment(chunks, size, codec, level):
+    '''
+    Returns the list of compressed chunks, or None when the segment should be stored raw
+    '''
+    if size < _COMPRESSION_MIN_SIZE:
+        return None
+    sample = chunks[0][:COMPRESSION_SAMPLE_SIZE]
+    if len(_compress(sample, codec, level)) > COMPRESSION_MAX_RATIO * len(sample):
+        return None
+    return list(_get_codec_pool().map(partial(_compress, codec=codec, level=level), chunks))
+
+
+def _decompress_segment(segment, info, codec) -> memoryview:
+    raw_size, chunk_sizes = info
+    pieces = []
+    offset = 0
+    for chunk_size in chunk_sizes:
+        pieces.append(segment[offset:offset + chunk_size])
+        offset += chunk_size
+    out = bytearray(raw_size)
+    offset = 0
+    for piece in _get_codec_pool().map(partial(_decompress, codec=codec, raw_size=raw_size), pieces):
+        out[offset:offset + len(piece)] = piece
+        offset += len(piece)
+    return memoryview(out)
+
+
+def _split(buffer, chunk_size=COMPRESSION_CHUNK_SIZE):
+    return [buffer[start:start + chunk_size] for start in range(0, len(buffer), chunk_size)]
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _tensor_nbytes(tensor) -> int:
+    return tensor.element_size() * tensor.numel()
+
+
+def dump_entry(obj, path, storage="tensor", codec="none", level=3, meta=None) -> int:
+    '''
+    Write obj to path with the given storage backend, segments are compressed with codec (none, lz4, zstd).
+    The file is written next to path then renamed, readers see either the previous file or the complete new one.
+    Returns the size of the file in bytes.
+    '''
+    if storage not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage={storage}, expected one of {STORAGE_FORMATS}")
+    stream, tensors, buffers = STORAGE_BACKENDS[storage](obj)
+
+    path = Path(path)
+    # segment 0 is the pickle stream, then tensors, then out-of-band buffers
+    raw_sizes = [len(stream)] + [_tensor_nbytes(t) for t in tensors] + [buffer.raw().nbytes for buffer in buffers]
+    # the pickle stream is cut in chunks like the buffers: a pickled object is compressed on all cores too
+    chunks = [_split(memoryview(stream))] + [_iter_tensor_chunks(t, COMPRESSION_CHUNK_SIZE) for t in tensors] + [_split(buffer.raw()) for buffer in buffers]
+    blobs = [None] * len(raw_sizes)
+    if storage == "dedup":
+        blob_dir = get_blob_dir(path.parent)
+        data_chunks = [iter_dedup_chunks(t) for t in tensors] + [split_buffer(buffer.raw()) for buffer in buffers]
+        for i, segment_chunks in enumerate(data_chunks, start=1):
+            # hashing (blake2b releases the GIL) and writing chunks in parallel
+            blobs[i] = list(_get_codec_pool().map(partial(write_blob, blob_dir), segment_chunks))
+            chunks[i] = []
+            raw_sizes[i] = 0
+    compressed = [None] * len(raw_sizes)
+    if codec != "none":
+        for i, size in enumerate(raw_sizes):
+            chunks[i] = list(chunks[i])
+            compressed_chunks = _compress_segment(chunks[i], size, codec, level)
+            if compressed_chunks is not None:
+                chunks[i] = compressed_chunks
+                compressed[i] = [size, [len(c) for c in compressed_chunks]]
+
+    segments = []
+    offset = 0
+    for size, info in zip(raw_sizes, compressed):
+        stored_size = size if info is None else sum(info[1])
+        segments.append([offset, stored_size])
+        offset = _align(offset + stored_size)
+
+    header = {
+        "format": storage,
+        "meta": meta or {},
+        "codec": {"name": codec, "level": level},
+        "compressed": compressed,
+        "blobs": blobs,
+        "segments": segments,
+        "tensors": [{"segment": 1 + i,
+                     "dtype": str(t.dtype).replace("torch.", ""),
+                     "shape": list(t.shape),
+                     "device": str(t.device)} for i, t in enumerate(tensors)],
+        "buffers": [1 + len(tensors) + i for i in range(len(buffers))],
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _align(len(MAGIC) + _HEADER_LEN.size + len(header_bytes))
+
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(_HEADER_LEN.pack(len(header_bytes)))
+            f.write(header_bytes)
+            for (offset, _), segment_chunks in zip(segments, chunks):
+                f.seek(data_start + offset)
+                for chunk in segment_chunks:
+                    f.write(chunk)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            os.remove(tmp_path)
+    return size
+
+
+def read_entry_header(path) -> dict:
+    '''
+    Read the header of an entry without loading it, returns None for legacy pickle files
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        header_len, = _HEADER_LEN.unpack(f.read(_HEADER_LEN.size))
+        return json.loads(f.read(header_len).decode("utf-8"))
+
+
+def entry_blobs(path) -> list:
+    '''
+    The [digest, size] of the blobs referenced by an entry (one item per reference), empty if not deduplicated
+    '''
+    header = read_entry_header(path)
+    if header is None:
+        return []
+    return [blob for segment_blobs in header.get("blobs", []) if segment_blobs for blob in segment_blobs]
+
+
+def load_entry(path, map_location=None):
+    '''
+    Load an entry written by dump_entry, or a legacy pickle file.
+    Tensors and numpy arrays are backed by a copy-on-write memory map of the file (unless compressed).
+    map_location: device of the loaded tensors, by default the device they were on when written (if available)
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+        header_len, = _HEADER_LEN.unpack(f.read(_HEADER_LEN.size))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+
+    data_start = _align(len(MAGIC) + _HEADER_LEN.size + header_len)
+    segments = [data[data_start + offset:data_start + offset + size] for offset, size in header["segments"]]
+    return _load_segments(header, segments, blob_dir=get_blob_dir(Path(path).parent), map_location=map_location)
+
+
+def _load_segments(header, segments, blob_dir=None, map_location=None):
+    for i, segment_blobs in enumerate(header.get("blobs", [])):
+        if segment_blobs is not None:
+            segments[i] = read_blobs(blob_dir, segment_blobs)
+
+    codec = header.get("codec", {}).get("name", "none")
+    for i, info in enumerate(header.get("compressed", [])):
+        if info is not None:
+            segments[i] = _decompress_segment(segments[i], info, codec)
+
+    tensors = []
+    for info in header["tensors"]:
+        dtype = getattr(torch, info["dtype"])
+        segment = segments[info["segment"]]
+        if len(segment) == 0:
+            tensor = torch.empty(info["shape"], dtype=dtype)
+        else:
+            tensor = torch.frombuffer(segment, dtype=dtype).reshape(info["shape"])
+        device = torch.device(info["device"] if map_location is None else map_location)
+        if device.type == "cuda" and torch.cuda.is_available():
+            tensor = tensor.to(device)
+        tensors.append(tensor)
+    buffers = [segments[i] for i in header["buffers"]]
+    return _TensorUnpickler(io.BytesIO(segments[0]), tensors, buffers).load()
@@ -0,0 +1,416 @@
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from .common import get_cache_dir, record_cache_event
+from .ram_cache import RAM_CACHE
+from .cache_blobs import get_blob_dir, blob_path
+from .cache_format import entry_blobs
+
+# Index of the CacheAny entries, stored next to them in CACHE_DIR/index.sqlite
+# Limits, set with environment variables (0 = no limit) or configure_cache_limits():
+# - BETTER_FLOW_CACHE_DISK_MB: total size of the cache files
+# - BETTER_FLOW_CACHE_TTL_HOURS: entries not accessed for longer are removed
+CACHE_DISK_BUDGET_MB = int(os.environ.get("BETTER_FLOW_CACHE_DISK_MB", "0"))
+CACHE_TTL_HOURS = float(os.environ.get("BETTER_FLOW_CACHE_TTL_HOURS", "0"))
+JANITOR_INTERVAL_S = 60.0
+
+INDEX_FILENAME = "index.sqlite"
+
+logger = logging.getLogger(__name__)
+
+
+def split_cache_filename(filename: str):
+    '''
+    Returns (cache_name, key_hash) from a cache file name "{cache_name}+{key_hash}.pkl", or None.
+    Replaced entries are written to "{cache_name}+{key_hash}.{generation}.pkl" (see replacement_path).
+    '''
+    stem, ext = os.path.splitext(filename)
+    if ext != ".pkl" or "+" not in stem:
+        return None
+    cache_name, key_hash = stem.split("+", 1)
+    return cache_name, key_hash.split(".", 1)[0]
+
+
+def replacement_path(cache_path) -> Path:
+    '''
+    New file for the entry of cache_path when its current file is replaced: the current file can still be memory-mapped
+    by the tensors of a previous read, it cannot be overwritten (or removed) on Windows until they are released
+    '''
+    cache_path = Path(cache_path)
+    return cache_path.with_name(f"{cache_path.stem}.{uuid.uuid4().hex[:8]}{cache_path.suffix}")
+
+
+class MissingBlobsError(FileNotFoundError):
+    '''
+    Blobs of a deduplicated entry were deleted between the write of the entry and its record in the index
+    '''
+
+
+class CacheIndex:
+    '''
+    Persistent index of the cache files: name, key hash, size, creation and last access time, format.
+    Lookups and cleanup query the index instead of listing the cache folder.
+    It also counts the references of deduplicated entries to their blobs, blobs without references are deleted.
+    Files that could not be removed (still memory-mapped on Windows) are kept in a list of stale files, removed later.
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        index_path = self.cache_dir / INDEX_FILENAME
+        is_new = not index_path.exists()
+        self.blob_dir = get_blob_dir(self.cache_dir)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(index_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                           "cache_name TEXT NOT NULL, key_hash TEXT NOT NULL, filename TEXT NOT NULL, "
+                           "size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL, format TEXT, "
+                           "blob_size INTEGER NOT NULL DEFAULT 0, "
+                           "PRIMARY KEY (cache_name, key_hash))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS blobs ("
+                           "digest TEXT PRIMARY KEY, size INTEGER NOT NULL, refcount INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entry_blobs ("
+                           "cache_name TEXT NOT NULL, key_hash TEXT NOT NULL, digest TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entry_blobs_entry ON entry_blobs (cache_name, key_hash)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS stale_files (filename TEXT PRIMARY KEY)")
+        self.disk_budget_bytes = CACHE_DISK_BUDGET_MB * 1024 * 1024
+        self.ttl_seconds = CACHE_TTL_HOURS * 3600
+        self.quotas = {}  # cache_name -> bytes
+        if is_new:
+            # first start with an index: register the files written before it existed
+            self.reconcile()
+
+    def _execute(self, query, params=()):
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def record(self, cache_name, key_hash, filename, size, fmt=None, blobs=None):
+        '''
+        Add or replace an entry, blobs lists the [digest, size] of the blobs it references (storage=dedup)
+        '''
+        blobs = blobs or []
+        now = time.time()
+        with self._lock:
+            previous = self._conn.execute("SELECT filename FROM entries WHERE cache_name=? AND key_hash=?",
+                                          (cache_name, key_hash)).fetchall()
+            self._conn.execute("BEGIN")
+            try:
+                self._release_blobs(cache_name, key_hash)
+                self._conn.execute("DELETE FROM stale_files WHERE filename=?", (filename,))
+                self._conn.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                                   "ON CONFLICT (cache_name, key_hash) DO UPDATE SET "
+                                   "filename=excluded.filename, size=excluded.size, created=excluded.created, "
+                                   "last_access=excluded.last_access, format=excluded.format, blob_size=excluded.blob_size",
+                                   (cache_name, key_hash, filename, size, now, now, fmt, sum(size for _, size in blobs)))
+                for digest, blob_size in blobs:
+                    self._conn.execute("INSERT INTO blobs VALUES (?, ?, 1) "
+                                       "ON CONFLICT (digest) DO UPDATE SET refcount=refcount+1", (digest, blob_size))
+                    self._conn.execute("INSERT INTO entry_blobs VALUES (?, ?, ?)", (cache_name, key_hash, digest))
+                # a blob deleted after the entry was written but before it was referenced here
+                missing = [digest for digest, _ in blobs if not blob_path(self.blob_dir, digest).exists()]
+                if missing:
+                    raise MissingBlobsError(f"CacheAny: {len(missing)} blobs of {filename} were deleted before being indexed")
+                self._conn.execute("COMMIT")
+            except BaseException as e:
+                self._conn.execute("ROLLBACK")
+                if isinstance(e, MissingBlobsError):
+                    # the file is unreadable without its blobs: it is dropped, the entry is a miss on the next run
+                    if previous and previous[0][0] == filename:
+                        self.remove(cache_name, key_hash, filename)
+                    else:
+                        self._remove_file(filename)
+                raise
+            if previous and previous[0][0] != filename:
+                # the entry was written to a new file (replacement_path)
+                self._remove_file(previous[0][0])
+            self._collect_blobs()
+
+    def _remove_file(self, filename) -> bool:
+        '''
+        Delete a file of the cache folder, remembered as stale if it cannot be removed yet
+        '''
+        try:
+            os.remove(self.cache_dir / filename)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # e.g. still memory-mapped on Windows, retried by the janitor
+            logger.warning(f"CacheAny: could not remove {filename} yet: {e}")
+            with self._lock:
+                self._conn.execute("INSERT OR IGNORE INTO stale_files VALUES (?)", (filename,))
+            return False
+        with self._lock:
+            self._conn.execute("DELETE FROM stale_files WHERE filename=?", (filename,))
+        return True
+
+    def remove_stale_files(self) -> int:
+        '''
+        Retry the removal of the stale files, returns the number removed
+        '''
+        return sum(self._remove_file(filename) for filename, in self._execute("SELECT filename FROM stale_files"))
+
+    def entry_path(self, cache_path):
+        '''
+        Current file of the entry of cache_path (cache_path itself unless the entry was replaced), None if that file is
+        stale
+        '''
+        cache_path = Path(cache_path)
+        parsed = split_cache_filename(cache_path.name)
+        if parsed is not None:
+            entry = self.lookup(*parsed)
+            if entry is not None:
+                return self.cache_dir / entry["filename"]
+        if self._execute("SELECT 1 FROM stale_files WHERE filename=?", (cache_path.name,)):
+            return None
+        return cache_path
+
+    def _release_blobs(self, cache_name, key_hash):
+        # decrement the reference count of the blobs of an entry, called within a transaction
+        for digest, in self._conn.execute("SELECT digest FROM entry_blobs WHERE cache_name=? AND key_hash=?",
+                                          (cache_name, key_hash)).fetchall():
+            self._conn.execute("UPDATE blobs SET refcount=refcount-1 WHERE digest=?", (digest,))
+        self._conn.execute("DELETE FROM entry_blobs WHERE cache_name=? AND key_hash=?", (cache_name, key_hash))
+
+    def _collect_blobs(self) -> int:
+        '''
+        Delete the blobs without references, returns the number of bytes freed
+        '''
+        freed = 0
+        with self._lock:
+            for digest, size in self._conn.execute("SELECT digest, size FROM blobs WHERE refcount<=0").fetchall():
+                try:
+                    os.remove(blob_path(self.blob_dir, digest))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"CacheAny: could not remove blob {digest}: {e}")
+                    continue
+                self._conn.execute("DELETE FROM blobs WHERE digest=?", (digest,))
+                freed += size
+        return freed
+
+    def missing_blobs(self, cache_name, key_hash) -> int:
+        '''
+        Number of the blobs referenced by an entry that are not on disk anymore
+        '''
+        rows = self._execute("SELECT digest FROM entry_blobs WHERE cache_name=? AND key_hash=?", (cache_name, key_hash))
+        return sum(not blob_path(self.blob_dir, digest).exists() for digest, in rows)
+
+    def touch(self, cache_name, key_hash) -> bool:
+        with self._lock:
+            cursor = self._conn.execute("UPDATE entries SET last_access=? WHERE cache_name=? AND key_hash=?",
+                                        (time.time(), cache_name, key_hash))
+            return cursor.rowcount > 0
+
+    def lookup(self, cache_name, key_hash):
+        rows = self._execute("SELECT filename, size, created, last_access, format FROM entries "
+                             "WHERE cache_name=? AND key_hash=?", (cache_name, key_hash))
+        if not rows:
+            return None
+        filename, size, created, last_access, fmt = rows[0]
+        return {"filename": filename, "size": size, "created": created, "last_access": last_access, "format": fmt}
+
+    def other_versions(self, cache_name, key_hash):
+        '''
+        Returns the (key_hash, filename) of the entries of cache_name with a different key
+        '''
+        return self._execute("SELECT key_hash, filename FROM entries WHERE cache_name=? AND key_hash!=?",
+                             (cache_name, key_hash))
+
+    def total_size(self, cache_name=None) -> int:
+        '''
+        Disk usage of all the cache (entries and blobs),
+        or of one cache_name (its entries and the blobs they reference, shared blobs are counted for each entry)
+        '''
+        if cache_name is None:
+            rows = self._execute("SELECT (SELECT COALESCE(SUM(size), 0) FROM entries) + "
+                                 "(SELECT COALESCE(SUM(size), 0) FROM blobs)")
+        else:
+            rows = self._execute("SELECT COALESCE(SUM(size + blob_size), 0) FROM entries WHERE cache_name=?", (cache_name,))
+        return rows[0][0]
+
+    def remove(self, cache_name, key_hash, filename):
+        '''
+        Delete an entry file, its index row and the blobs only it referenced.
+        Returns the number of bytes freed on disk, None if the file could not be removed: the entry is dropped anyway,
+        its file is removed later (stale).
+        '''
+        parsed = split_cache_filename(filename)
+        RAM_CACHE.discard(self.cache_dir / (f"{parsed[0]}+{parsed[1]}.pkl" if parsed is not None else filename))
+        with self._lock:
+            removed = self._remove_file(filename)
+            rows = self._conn.execute("SELECT size FROM entries WHERE cache_name=? AND key_hash=?",
+                                      (cache_name, key_hash)).fetchall()
+            self._conn.execute("BEGIN")
+            self._release_blobs(cache_name, key_hash)
+            self._conn.execute("DELETE FROM entries WHERE cache_name=? AND key_hash=?", (cache_name, key_hash))
+            self._conn.execute("COMMIT")
+            freed = (rows[0][0] if rows and removed else 0) + self._collect_blobs()
+        if not removed:
+            return None
+        record_cache_event(cache_name, "files_removed")
+        return freed
+
+    def reconcile(self):
+        '''
+        Synchronize the index with the content of the cache folder (one listing of the folder)
+        '''
+        self.remove_stale_files()
+        on_disk = {}  # (cache_name, key_hash) -> files, oldest first
+        for entry in sorted((entry for entry in os.scandir(self.cache_dir) if entry.is_file()), key=lambda entry: entry.stat().st_mtime):
+            parsed = split_cache_filename(entry.name)
+            if parsed is not None:
+                on_disk.setdefault(parsed, []).append(entry)
+        indexed = {(name, key): filename for name, key, filename in
+                   self._execute("SELECT cache_name, key_hash, filename FROM entries")}
+        for (cache_name, key_hash), filename in list(indexed.items()):
+            if filename not in [entry.name for entry in on_disk.get((cache_name, key_hash), [])]:
+                self._execute("DELETE FROM entries WHERE cache_name=? AND key_hash=?", (cache_name, key_hash))
+                del indexed[(cache_name, key_hash)]
+        stale = {filename for filename, in self._execute("SELECT filename FROM stale_files")}
+        for (cache_name, key_hash), entries in on_disk.items():
+            current = indexed.get((cache_name, key_hash))
+            if current is None:
+                # the newest file not known to be stale
+                candidates = [entry for entry in entries if entry.name not in stale]
+                if candidates:
+                    try:
+                        self.record(cache_name, key_hash, candidates[-1].name, candidates[-1].stat().st_size,
+                                    blobs=entry_blobs(candidates[-1].path))
+                        current = candidates[-1].name
+                    except (OSError, ValueError) as e:
+                        logger.warning(f"CacheAny: could not index {candidates[-1].name}: {e}")
+            for entry in entries:
+                if current is not None and entry.name != current:
+                    # previous files of replaced entries
+                    self._remove_file(entry.name)
+
+        # blobs left by entries which do not exist anymore
+        if self.blob_dir.exists():
+            referenced = {digest for digest, in self._execute("SELECT digest FROM blobs")}
+            for path in self.blob_dir.glob("*/*"):
+                if path.name not in referenced and not path.name.endswith(".tmp"):
+                    os.remove(path)
+
+    def set_quota(self, cache_name, quota_bytes):
+        if quota_bytes and quota_bytes > 0:
+            self.quotas[cache_name] = quota_bytes
+        else:
+            self.quotas.pop(cache_name, None)
+
+    def enforce_limits(self) -> int:
+        '''
+        Remove expired entries, then least recently used entries exceeding the per cache_name quotas and the disk budget.
+        Returns the number of removed entries.
+        '''
+        self.remove_stale_files()
+        removed = 0
+        if self.ttl_seconds > 0:
+            for cache_name, key_hash, filename in self._execute(
+                    "SELECT cache_name, key_hash, filename FROM entries WHERE last_access<?",
+                    (time.time() - self.ttl_seconds,)):
+                removed += self.remove(cache_name, key_hash, filename) is not None
+
+        for cache_name, quota in list(self.quotas.items()):
+            removed += self._evict_lru(quota, cache_name)
+
+        if self.disk_budget_bytes > 0:
+            removed += self._evict_lru(self.disk_budget_bytes)
+        return removed
+
+    def _evict_lru(self, budget_bytes, cache_name=None) -> int:
+        excess = self.total_size(cache_name) - budget_bytes
+        if excess <= 0:
+            return 0
+        if cache_name is None:
+            rows = self._execute("SELECT cache_name, key_hash, filename, size + blob_size FROM entries ORDER BY last_access")
+        else:
+            rows = self._execute("SELECT cache_name, key_hash, filename, size + blob_size FROM entries "
+                                 "WHERE cache_name=? ORDER BY last_access", (cache_name,))
+        removed = 0
+        for name, key_hash, filename, entry_size in rows:
+            if excess <= 0:
+                break
+            freed = self.remove(name, key_hash, filename)
+            if freed is not None:
+                # the disk budget counts the freed bytes, a quota counts the size of the entry
+                excess -= freed if cache_name is None else entry_size
+                removed += 1
+        return removed
+
+
+class _Janitor(threading.Thread):
+    '''
+    Background thread enforcing the cache limits periodically, or when woken up after a write
+    '''
+
+    def __init__(self, index: CacheIndex, interval_s: float):
+        super().__init__(name="CacheAny-janitor", daemon=True)
+        self.index = index
+        self.interval_s = interval_s
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            self._wake.wait(self.interval_s)
+            self._wake.clear()
+            try:
+                removed = self.index.enforce_limits()
+                if removed:
+                    logger.info(f"CacheAny janitor: removed {removed} cache entries")
+            except Exception as e:
+                logger.error(f"CacheAny janitor: {e}")
+
+
+_INDEX = None
+_JANITOR = None
+_INIT_LOCK = threading.Lock()
+
+
+def get_cache_index() -> CacheIndex:
+    '''
+    The index of CACHE_DIR, opened (and its janitor started) on first use
+    '''
+    global _INDEX, _JANITOR
+    with _INIT_LOCK:
+        if _INDEX is None:
+            _INDEX = CacheIndex(get_cache_dir())
+            _JANITOR = _Janitor(_INDEX, JANITOR_INTERVAL_S)
+            _JANITOR.start()
+    return _INDEX
+
+
+def current_entry_file(cache_path):
+    '''
+    Existing file holding the entry of cache_path (see CacheIndex.entry_path), None if there is none
+    '''
+    path = get_cache_index().entry_path(cache_path)
+    return path if path is not None and path.exists() else None
+
+
+def wake_janitor():
+    if _JANITOR is not None:
+        _JANITOR.wake()
+
+
+def configure_cache_limits(disk_budget_mb=None, ttl_hours=None, quotas_mb=None):
+    '''
+    Set the disk budget (MiB), the time to live of unused entries (hours) and quotas per cache_name (MiB), 0 means no limit
+    '''
+    index = get_cache_index()
+    if disk_budget_mb is not None:
+        index.disk_budget_bytes = int(disk_budget_mb * 1024 * 1024)
+    if ttl_hours is not None:
+        index.ttl_seconds = ttl_hours * 3600
+    for cache_name, quota_mb in (quotas_mb or {}).items():
+        index.set_quota(cache_name, int(quota_mb * 1024 * 1024))
+    wake_janitor()
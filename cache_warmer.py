@@ -0,0 +1,225 @@
+import os
+import re
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .common import get_cache_path, get_hash_from_any, get_hash_from_list_any, record_cache_event, cache_timer
+from .cache_format import load_entry
+from .cache_writer import CACHE_WRITER
+from .cache_index import current_entry_file
+from .ram_cache import RAM_CACHE
+from .md5_hash import _is_link, published_hash
+
+try:
+    from server import PromptServer
+except ImportError:
+    PromptServer = None
+
+# Queue-time warming of the CacheAny entries: when a prompt is queued, the CacheAny nodes whose key is known before
+# execution are resolved, and their entries read into the RAM tier by background threads, so that executing the node
+# is a RAM hit. A key is known when any_key is
+#   - a constant of the prompt (prompts sent to the API, any_key has no widget in the UI)
+#   - the output of an AnyToHash / x2 / xN node with constant inputs (hashed the same way)
+#   - the output of an AnyToHash / x2 / xN node that already ran with the same inputs upstream (published_hash), e.g. the
+#     previous prompt of a queue
+#   - the output of an AnyToHash node whose last hash is stored as a property in the workflow (extra_pnginfo)
+# Warmed entries not consumed yet are capped by BETTER_FLOW_CACHE_WARM_MB (their file size, 0 disables the warmer),
+# within the budget of the RAM tier.
+CACHE_WARM_BUDGET_MB = int(os.environ.get("BETTER_FLOW_CACHE_WARM_MB", "1024"))
+CACHE_WARM_THREADS = int(os.environ.get("BETTER_FLOW_CACHE_WARM_THREADS", "2"))
+
+HASH_NODES = {"AnyToHash", "AnyToHashMulti", "AnyToHashN"}
+_HEX_DIGEST = re.compile(r"^[0-9a-f]{16,128}$")
+
+logger = logging.getLogger(__name__)
+
+
+def _stored_hash(workflow_node):
+    # AnyToHash stores its last hash as the last_hash property of the node in the saved workflow
+    if workflow_node is None:
+        return None
+    value = (workflow_node.get("properties") or {}).get("last_hash")
+    if isinstance(value, str) and _HEX_DIGEST.match(value):
+        return value
+    return None
+
+
+def _hash_node_output(prompt: dict, node_id, workflow_node=None):
+    '''
+    Output of an AnyToHash / x2 / xN node of the prompt if it is known before execution, else None
+    '''
+    node = prompt[node_id]
+    inputs = node.get("inputs", {})
+    algorithm, tree_hash, mode = inputs.get("algorithm", "md5"), inputs.get("tree_hash", False), inputs.get("mode", "exact")
+    if node["class_type"] == "AnyToHash":
+        names = ["anything"]
+    elif node["class_type"] == "AnyToHashMulti":
+        names = ["anything1", "anything2"]
+    else:
+        names = sorted((k for k in inputs if k.startswith("anything") and k[len("anything"):].isdigit()),
+                       key=lambda k: int(k[len("anything"):]))
+    values = [inputs.get(name) for name in names]
+    if any(_is_link(value) for value in values + [algorithm, tree_hash, mode]) or None in values or not values:
+        return published_hash(prompt, node_id) or _stored_hash(workflow_node)
+    if node["class_type"] == "AnyToHash":
+        return str(get_hash_from_any(values[0], algorithm=algorithm, tree=tree_hash or None, mode=mode))
+    return str(get_hash_from_list_any(values, algorithm=algorithm, tree=tree_hash or None, mode=mode))
+
+
+def static_cache_paths(prompt: dict, extra_pnginfo: dict = None) -> list:
+    '''
+    (cache_name, cache path) of the CacheAny nodes of a prompt whose key is known before execution
+    '''
+    workflow = (extra_pnginfo or {}).get("workflow") or {}
+    workflow_nodes = {str(node.get("id")): node for node in workflow.get("nodes", [])}
+    paths = []
+    for node in prompt.values():
+        if not isinstance(node, dict) or node.get("class_type") != "CacheAny":
+            continue
+        inputs = node.get("inputs", {})
+        options = [inputs.get("cache_name"), inputs.get("hash_algorithm", "md5"), inputs.get("tree_hash", False),
+                   inputs.get("key_mode", "exact")]
+        if inputs.get("force_recreate", False) is not False or any(_is_link(value) for value in options):
+            continue
+        cache_name, algorithm, tree_hash, key_mode = options
+        any_key = inputs.get("any_key")
+        if _is_link(any_key):
+            source = prompt.get(any_key[0])
+            if not isinstance(source, dict) or source.get("class_type") not in HASH_NODES:
+                continue
+            any_key = _hash_node_output(prompt, any_key[0], workflow_nodes.get(str(any_key[0])))
+        if any_key is None or not cache_name:
+            continue
+        cache_path = get_cache_path(any_key, cache_name, ignore_errors=True, algorithm=algorithm, tree=tree_hash or None, mode=key_mode)
+        if cache_path is not None and (cache_name, cache_path) not in paths:
+            paths.append((cache_name, cache_path))
+    return paths
+
+
+def _advise_willneed(path):
+    # start reading the whole file into the page cache, the memory-mapped tensors of the entry are then hot
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+class CacheWarmer:
+    '''
+    Reads CacheAny entries into the RAM tier in the background, within a ceiling of bytes warmed and not yet read
+    '''
+
+    def __init__(self, budget_bytes, num_threads=CACHE_WARM_THREADS):
+        self.budget_bytes = budget_bytes
+        self.num_threads = num_threads
+        self._warmed = {}  # path -> bytes, warmed and not consumed yet
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=max(1, self.num_threads), thread_name_prefix="CacheAny-warm")
+        return self._pool
+
+    def _used_bytes(self) -> int:
+        # entries evicted from the RAM tier (or being read) do not count anymore
+        for path in [path for path in self._warmed if path not in RAM_CACHE and path not in self._inflight]:
+            del self._warmed[path]
+        return sum(self._warmed.values())
+
+    def used_bytes(self) -> int:
+        with self._lock:
+            return self._used_bytes()
+
+    def submit_prompt(self, prompt: dict, extra_pnginfo: dict = None):
+        '''
+        Warm the entries of the statically known keys of a prompt, keys are resolved on the pool
+        '''
+        if self.budget_bytes > 0:
+            self._get_pool().submit(self._warm_prompt, prompt, extra_pnginfo)
+
+    def _warm_prompt(self, prompt, extra_pnginfo):
+        try:
+            for cache_name, cache_path in static_cache_paths(prompt, extra_pnginfo):
+                self._get_pool().submit(self.warm, cache_path, cache_name)
+        except Exception as e:
+            logger.warning(f"Cache warmer: could not resolve the keys of the prompt: {e}")
+
+    def warm(self, cache_path, cache_name) -> bool:
+        '''
+        Read an entry into the RAM tier, returns False if it is missing, already there or over the ceiling
+        '''
+        key = str(cache_path)
+        if key in RAM_CACHE or CACHE_WRITER.is_pending(cache_path):
+            return False
+        entry_file = current_entry_file(cache_path)
+        if entry_file is None:
+            return False
+        nbytes = entry_file.stat().st_size
+        with self._lock:
+            if key in self._inflight or key in RAM_CACHE:
+                return False
+            if self._used_bytes() + nbytes > self.budget_bytes:
+                record_cache_event(cache_name, "warm_skipped")
+                return False
+            self._inflight.add(key)
+            self._warmed[key] = nbytes
+        try:
+            _advise_willneed(entry_file)
+            with cache_timer(cache_name, "warm"):
+                value = load_entry(entry_file)
+            if not RAM_CACHE.put(cache_path, value):
+                raise MemoryError(f"{nbytes / 1024 ** 2:.1f} MiB do not fit in the RAM tier")
+            record_cache_event(cache_name, "warmed")
+            record_cache_event(cache_name, "bytes_warmed", nbytes)
+            return True
+        except Exception as e:
+            logger.warning(f"Cache warmer: could not read {cache_path.name}: {e}")
+            with self._lock:
+                self._warmed.pop(key, None)
+            return False
+        finally:
+            with self._lock:
+                self._inflight.discard(key)
+
+    def consumed(self, cache_path) -> bool:
+        '''
+        To call when the node reads an entry from the RAM tier, returns True if it had been warmed
+        '''
+        with self._lock:
+            return self._warmed.pop(str(cache_path), None) is not None
+
+    def set_budget(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+
+
+CACHE_WARMER = CacheWarmer(CACHE_WARM_BUDGET_MB * 1024 * 1024)
+
+
+def on_prompt(json_data: dict) -> dict:
+    '''
+    Prompt handler of the ComfyUI server, must return the prompt request unchanged
+    '''
+    try:
+        prompt = json_data.get("prompt")
+        if isinstance(prompt, dict):
+            extra_pnginfo = (json_data.get("extra_data") or {}).get("extra_pnginfo")
+            CACHE_WARMER.submit_prompt(prompt, extra_pnginfo)
+    except Exception as e:
+        logger.warning(f"Cache warmer: {e}")
+    return json_data
+
+
+def register_cache_warmer() -> bool:
+    '''
+    Warm the cache of the prompts queued on the ComfyUI server, False without a server (e.g. scripts, benchmarks)
+    '''
+    if PromptServer is None or getattr(PromptServer, "instance", None) is None:
+        return False
+    PromptServer.instance.add_on_prompt_handler(on_prompt)
+    return True
@@ -0,0 +1,110 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from .cache_format import dump_entry
+from .ram_cache import host_copy
+
+# Write-behind of CacheAny entries: the node returns immediately and the entry is written by background threads.
+# The queue is bounded (BETTER_FLOW_CACHE_WRITE_QUEUE entries), submitting to a full queue waits for a slot.
+WRITE_QUEUE_SIZE = int(os.environ.get("BETTER_FLOW_CACHE_WRITE_QUEUE", "4"))
+WRITE_THREADS = 2
+
+logger = logging.getLogger(__name__)
+
+
+class CacheWriter:
+    '''
+    Background writer, entries being written stay readable from memory until their file is complete.
+    The queued objects are host copies taken at submit: the node output keeps being used by the prompt, a node modifying
+    it in place changes neither the file being written nor the values read from the pending write.
+    '''
+
+    def __init__(self, num_threads=WRITE_THREADS, queue_size=WRITE_QUEUE_SIZE):
+        self.num_threads = num_threads
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._pending = {}  # path -> (object being written, dump_entry arguments)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, path, obj, on_done=None, file_path=None, **dump_kwargs):
+        '''
+        Queue obj to be written to path (or to file_path, e.g. the new file of a replaced entry) with
+        dump_entry(**dump_kwargs), blocks while the queue is full.
+        on_done(size, elapsed_s) is called from the writer thread once the file is complete.
+        '''
+        self._start()
+        obj = host_copy(obj)
+        with self._lock:
+            self._pending[str(path)] = (obj, dump_kwargs)
+        self._queue.put((path, obj, on_done, file_path, dump_kwargs))
+
+    def pending(self, path):
+        '''
+        Returns (True, copy of obj) if obj is queued or being written to path, (False, None) otherwise
+        '''
+        with self._lock:
+            if str(path) not in self._pending:
+                return False, None
+            obj = self._pending[str(path)][0]
+        return True, host_copy(obj)
+
+    def is_pending(self, path):
+        '''
+        True if an entry is queued or being written to path
+        '''
+        with self._lock:
+            return str(path) in self._pending
+
+    def pending_meta(self, path):
+        '''
+        meta of the entry queued or being written to path, None if there is none
+        '''
+        with self._lock:
+            if str(path) in self._pending:
+                return self._pending[str(path)][1].get("meta") or {}
+        return None
+
+    def flush(self):
+        '''
+        Wait until all queued entries are written
+        '''
+        if self._threads:
+            self._queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.num_threads):
+                thread = threading.Thread(target=self._work, name=f"CacheAny-writer-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            path, obj, on_done, file_path, dump_kwargs = self._queue.get()
+            try:
+                start = time.perf_counter()
+                size = dump_entry(obj, file_path or path, **dump_kwargs)
+                if on_done is not None:
+                    on_done(size, time.perf_counter() - start)
+            except Exception as e:
+                logger.error(f"CacheAny: could not write {path}: {e}")
+            finally:
+                with self._lock:
+                    # a newer submission to the same path keeps its own pending object
+                    if self._pending.get(str(path), (None,))[0] is obj:
+                        del self._pending[str(path)]
+                self._queue.task_done()
+
+
+CACHE_WRITER = CacheWriter()
+# entries still in the queue are written before the interpreter exits
+atexit.register(CACHE_WRITER.flush)
+
+
+def flush_cache_writes():
+    CACHE_WRITER.flush()
@@ -1,14 +1,42 @@
-import folder_paths
 from pathlib import Path
 import pickle
 import hashlib
 import os
+import json
+import time
+import dataclasses
+import threading
+import weakref
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import numpy as np
 
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except ImportError:
+    XXHASH_AVAILABLE = False
+    xxhash = None
+
 # Contains common utilities and constants used by multiple nodes.
 
-CACHE_DIR = Path(folder_paths.output_directory) / "cached_outputs"
+@lru_cache(maxsize=None)
+def get_cache_dir() -> Path:
+    '''
+    Folder of the CacheAny files, resolved on first use (importing the package does not need ComfyUI's folders)
+    '''
+    import folder_paths
+    return Path(folder_paths.output_directory) / "cached_outputs"
+
+
+def __getattr__(name):
+    # CACHE_DIR of previous versions, resolved lazily
+    if name == "CACHE_DIR":
+        return get_cache_dir()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class AlwaysEqualProxy(str):
@@ -30,48 +58,523 @@ c_B = "\033[34m"
 c_P = "\033[35m"
 c_0 = "\033[0m"
 
-def _to_bytes(obj):
+# Hashing: tensors are streamed to the digest by chunks of this size (bytes)
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Selectable digests, all of them produce 32 hex characters (128 bits)
+HASH_ALGORITHMS = ["md5", "blake2b"]
+if XXHASH_AVAILABLE:
+    HASH_ALGORITHMS.append("xxh3_128")
+
+
+def _new_hasher(algorithm="md5"):
+    if algorithm == "md5":
+        return hashlib.md5()
+    elif algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    elif algorithm == "xxh3_128":
+        if not XXHASH_AVAILABLE:
+            raise ValueError("Hash algorithm xxh3_128 requires the optional xxhash package (pip install xxhash)")
+        return xxhash.xxh3_128()
+    raise ValueError(f"Unknown hash algorithm={algorithm}, expected one of {HASH_ALGORITHMS}")
+
+
+def _iter_tensor_chunks(tensor, chunk_size=HASH_CHUNK_SIZE):
+    '''
+    Yield the raw memory of a tensor as memoryviews of at most chunk_size bytes.
+    Host tensors are read in place, device tensors are moved to the host chunk by chunk.
+    '''
+    t = tensor.detach()
+    if not t.is_contiguous():
+        t = t.contiguous()
+    flat = t.reshape(-1).view(torch.uint8)
+    n_bytes = flat.numel()
+    if flat.device.type == "cpu":
+        buffer = memoryview(flat.numpy())
+        for start in range(0, n_bytes, chunk_size):
+            yield buffer[start:start + chunk_size]
+    else:
+        for start in range(0, n_bytes, chunk_size):
+            yield memoryview(flat[start:start + chunk_size].cpu().numpy())
+
+
+class _HashMemo:
+    '''
+    Bounded LRU memo of data digests, keyed by object identity.
+    Entries hold a weak reference to the object (they never keep it alive) and are dropped when it is garbage collected.
+    Tensors are validated by their version counter (bumped by in-place operations), numpy arrays are only memoized when read-only.
+    Inference tensors (created under torch.inference_mode(), as in ComfyUI) have no version counter and are not memoized.
+    '''
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (id(obj), variant) -> (weakref, version, digest)
+        # reentrant: the weakref callback (_discard) can run on a thread already holding the lock, when a collection
+        # is triggered inside get/put
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _version(obj):
+        if isinstance(obj, torch.Tensor):
+            if obj.is_inference():
+                return None
+            return obj._version
+        if isinstance(obj, np.ndarray) and not obj.flags.writeable:
+            return 0
+        return None
+
+    def get(self, obj, variant):
+        key = (id(obj), variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            ref, version, digest = entry
+            if ref() is not obj or version != self._version(obj):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return digest
+
+    def put(self, obj, variant, digest):
+        version = self._version(obj)
+        if version is None:
+            return
+        key = (id(obj), variant)
+        try:
+            ref = weakref.ref(obj, partial(self._discard, key))
+        except TypeError:
+            return
+        with self._lock:
+            self._entries[key] = (ref, version, digest)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _discard(self, key, ref):
+        # weakref callback: the object was garbage collected
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_HASH_MEMO = _HashMemo()
+
+
+def clear_hash_memo():
+    _HASH_MEMO.clear()
+
+
+# Tree hashing: tensor data is cut in chunks of this size hashed in parallel, then the ordered chunk digests are hashed.
+# The result does not depend on the number of threads. Enabled per call, or globally with
+# set_tree_hash(True) or the environment variable BETTER_FLOW_TREE_HASH=1
+TREE_HASH_CHUNK_SIZE = 4 * 1024 * 1024
+_TREE_HASH_DEFAULT = os.environ.get("BETTER_FLOW_TREE_HASH", "0") == "1"
+
+
+def set_tree_hash(enabled: bool):
+    global _TREE_HASH_DEFAULT
+    _TREE_HASH_DEFAULT = bool(enabled)
+
+
+# Hash modes of tensors and numpy arrays:
+# - exact: all the data is hashed
+# - sampled: fingerprint of HASH_SAMPLE_BUDGET bytes, pages of HASH_SAMPLE_PAGE bytes at fixed positions
+#   (the first and last pages included), cost independent of the size. Data smaller than the budget is hashed exactly.
+# - sampled+verify: the sampled fingerprint is the key, the exact hash is stored in the cache entry and checked on a hit
+HASH_MODES = ["exact", "sampled", "sampled+verify"]
+HASH_SAMPLE_PAGE = 4096
+HASH_SAMPLE_BUDGET = 1024 * 1024
+
+
+@dataclasses.dataclass(frozen=True)
+class HashOptions:
+    algorithm: str = "md5"
+    tree: bool = False
+    sampled: bool = False
+
+
+def _hash_options(algorithm="md5", tree=None, mode="exact") -> HashOptions:
+    if mode not in HASH_MODES:
+        raise ValueError(f"Unknown hash mode={mode}, expected one of {HASH_MODES}")
+    return HashOptions(algorithm=algorithm, tree=_TREE_HASH_DEFAULT if tree is None else bool(tree),
+                       sampled=mode != "exact")
+
+
+TREE_HASH_WORKERS = os.cpu_count() or 4
+_TREE_HASH_POOL = None
+_TREE_HASH_POOL_LOCK = threading.Lock()
+
+def _get_tree_hash_pool() -> ThreadPoolExecutor:
+    # separate from the input pool: an input hashed in the input pool waits for its chunks
+    global _TREE_HASH_POOL
+    with _TREE_HASH_POOL_LOCK:
+        if _TREE_HASH_POOL is None:
+            _TREE_HASH_POOL = ThreadPoolExecutor(max_workers=TREE_HASH_WORKERS, thread_name_prefix="hash-tree")
+    return _TREE_HASH_POOL
+
+
+def _chunk_digest(chunk, algorithm) -> bytes:
+    hasher = _new_hasher(algorithm)
+    hasher.update(chunk)
+    return hasher.digest()
+
+
+def _tree_digest(chunks, algorithm) -> bytes:
+    '''
+    Hash the chunks in parallel then the ordered chunk digests.
+    A bounded number of chunks is in flight (device tensors are copied to the host chunk by chunk).
+    '''
+    pool = _get_tree_hash_pool()
+    max_in_flight = 2 * TREE_HASH_WORKERS
+    in_flight = deque()
+    root = _new_hasher(algorithm)
+    root.update(_sized(b"H", str(TREE_HASH_CHUNK_SIZE).encode()))
+    for chunk in chunks:
+        in_flight.append(pool.submit(_chunk_digest, chunk, algorithm))
+        if len(in_flight) >= max_in_flight:
+            root.update(in_flight.popleft().result())
+    while in_flight:
+        root.update(in_flight.popleft().result())
+    return root.digest()
+
+
+def _data_digest(chunks, options: HashOptions) -> bytes:
+    if options.tree:
+        return _tree_digest(chunks, options.algorithm)
+    hasher = _new_hasher(options.algorithm)
+    for chunk in chunks:
+        hasher.update(chunk)
+    return hasher.digest()
+
+
+def _iter_ndarray_chunks(array, chunk_size=HASH_CHUNK_SIZE):
+    data = np.ascontiguousarray(array)
+    if data.nbytes > 0:
+        buffer = memoryview(data.reshape(-1).view(np.uint8))
+        for start in range(0, len(buffer), chunk_size):
+            yield buffer[start:start + chunk_size]
+
+
+def _sample_indices(numel, element_size):
+    '''
+    Flat indices of the sampled elements: pages evenly spread from the first to the last element
+    '''
+    page_elems = max(1, HASH_SAMPLE_PAGE // element_size)
+    num_pages = max(2, HASH_SAMPLE_BUDGET // (page_elems * element_size))
+    last_start = numel - page_elems
+    starts = [i * last_start // (num_pages - 1) for i in range(num_pages)]
+    return np.add.outer(np.asarray(starts, dtype=np.int64), np.arange(page_elems, dtype=np.int64)).reshape(-1)
+
+
+def _sampled_digest(sample: bytes, nbytes: int, algorithm) -> bytes:
+    hasher = _new_hasher(algorithm)
+    hasher.update(_sized(b"Z", f"{nbytes}:{HASH_SAMPLE_PAGE}:{HASH_SAMPLE_BUDGET}".encode()))
+    hasher.update(sample)
+    return hasher.digest()
+
+
+def _tensor_digest(tensor, options: HashOptions) -> bytes:
     '''
-    Convert to bytes, using Pickle and solving Tensor variability issues.
-    No deep search for Tensor variables in obj
+    Digest of the raw data of a tensor, streamed chunk by chunk (or sampled).
+    Memoized until the tensor is modified in place or garbage collected.
     '''
-    if isinstance(obj, torch.Tensor):
-        return obj.cpu().numpy().tobytes()
+    nbytes = tensor.numel() * tensor.element_size()
+    if options.sampled and nbytes <= HASH_SAMPLE_BUDGET:
+        options = dataclasses.replace(options, sampled=False)
+    digest = _HASH_MEMO.get(tensor, options)
+    if digest is not None:
+        return digest
+    if options.sampled:
+        # only the sampled elements are gathered (on their device), whatever the strides of the tensor
+        indices = torch.from_numpy(_sample_indices(tensor.numel(), tensor.element_size())).to(tensor.device)
+        sample = torch.take(tensor.detach(), indices).view(torch.uint8).cpu().numpy().tobytes()
+        digest = _sampled_digest(sample, nbytes, options.algorithm)
     else:
-        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
-    
-def get_hash_from_any(any):
-    obj_bytes = _to_bytes(any)
-    return hashlib.md5(obj_bytes).hexdigest()
+        chunk_size = TREE_HASH_CHUNK_SIZE if options.tree else HASH_CHUNK_SIZE
+        digest = _data_digest(_iter_tensor_chunks(tensor, chunk_size), options)
+    _HASH_MEMO.put(tensor, options, digest)
+    return digest
 
-def get_hash_from_list_any(list_of_any):
+
+def _ndarray_digest(array, options: HashOptions) -> bytes:
+    if options.sampled and array.nbytes <= HASH_SAMPLE_BUDGET:
+        options = dataclasses.replace(options, sampled=False)
+    digest = _HASH_MEMO.get(array, options)
+    if digest is not None:
+        return digest
+    if options.sampled:
+        sample = np.ascontiguousarray(array.take(_sample_indices(array.size, array.itemsize))).tobytes()
+        digest = _sampled_digest(sample, array.nbytes, options.algorithm)
+    else:
+        chunk_size = TREE_HASH_CHUNK_SIZE if options.tree else HASH_CHUNK_SIZE
+        digest = _data_digest(_iter_ndarray_chunks(array, chunk_size), options)
+    _HASH_MEMO.put(array, options, digest)
+    return digest
+
+
+def _sized(tag: bytes, data: bytes) -> bytes:
+    # the length prefix prevents two different sequences from producing the same stream
+    return tag + str(len(data)).encode() + b":" + data
+
+
+def _update_hash(hasher, obj, options: HashOptions, _stack=None):
+    '''
+    Feed obj to the hasher by walking its structure.
+    Containers (list, tuple, dict, set, dataclass) are walked recursively, dicts and sets independently of their order.
+    Tensors and numpy arrays are hashed by dtype, shape and raw data, they are never pickled.
+    Other objects are pickled.
+    '''
+    if _stack is None:
+        _stack = []
+
+    if obj is None:
+        hasher.update(b"N")
+    elif isinstance(obj, bool):
+        hasher.update(b"B1" if obj else b"B0")
+    elif isinstance(obj, int):
+        hasher.update(_sized(b"I", str(obj).encode()))
+    elif isinstance(obj, float):
+        hasher.update(_sized(b"F", obj.hex().encode()))
+    elif isinstance(obj, str):
+        hasher.update(_sized(b"S", obj.encode("utf-8", "surrogatepass")))
+    elif isinstance(obj, (bytes, bytearray)):
+        hasher.update(_sized(b"Y", bytes(obj)))
+    elif isinstance(obj, torch.Tensor) and obj.layout == torch.strided:
+        header = f"{obj.dtype}{tuple(obj.shape)}".encode()
+        hasher.update(_sized(b"T", header) + _tensor_digest(obj, options))
+    elif isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        header = f"{obj.dtype.str}{obj.shape}".encode()
+        hasher.update(_sized(b"A", header) + _ndarray_digest(obj, options))
+    elif isinstance(obj, np.generic) and not isinstance(obj, np.object_):
+        hasher.update(_sized(b"G", obj.dtype.str.encode()) + obj.tobytes())
+    elif id(obj) in _stack:
+        # self-referencing container, refer to its depth in the walk
+        hasher.update(_sized(b"R", str(_stack.index(id(obj))).encode()))
+    elif isinstance(obj, (list, tuple, dict, set, frozenset, np.ndarray)) or (dataclasses.is_dataclass(obj) and not isinstance(obj, type)):
+        _stack.append(id(obj))
+        try:
+            _update_hash_container(hasher, obj, options, _stack)
+        finally:
+            _stack.pop()
+    else:
+        hasher.update(_sized(b"P", pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)))
+
+
+def _update_hash_container(hasher, obj, options: HashOptions, _stack):
+    if type(obj) not in (list, tuple, dict, set, frozenset):
+        # subclasses (e.g. named tuples) and dataclasses are distinguished by their type
+        hasher.update(_sized(b"C", f"{type(obj).__module__}.{type(obj).__qualname__}".encode()))
+
+    if isinstance(obj, np.ndarray):
+        # numpy array of python objects
+        hasher.update(_sized(b"O", f"{obj.shape}".encode()))
+        for item in obj.reshape(-1).tolist():
+            _update_hash(hasher, item, options, _stack)
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(_sized(b"L" if isinstance(obj, list) else b"U", str(len(obj)).encode()))
+        for item in obj:
+            _update_hash(hasher, item, options, _stack)
+    elif isinstance(obj, dict):
+        hasher.update(_sized(b"D", str(len(obj)).encode()))
+        # order the items by the digest of their key so that insertion order does not matter
+        items = []
+        for key, value in obj.items():
+            key_hasher = _new_hasher(options.algorithm)
+            _update_hash(key_hasher, key, options, _stack)
+            items.append((key_hasher.digest(), value))
+        for key_digest, value in sorted(items, key=lambda item: item[0]):
+            hasher.update(key_digest)
+            _update_hash(hasher, value, options, _stack)
+    elif isinstance(obj, (set, frozenset)):
+        hasher.update(_sized(b"E", str(len(obj)).encode()))
+        digests = []
+        for item in obj:
+            item_hasher = _new_hasher(options.algorithm)
+            _update_hash(item_hasher, item, options, _stack)
+            digests.append(item_hasher.digest())
+        for digest in sorted(digests):
+            hasher.update(digest)
+    else:
+        # dataclass instance
+        fields = dataclasses.fields(obj)
+        hasher.update(_sized(b"K", str(len(fields)).encode()))
+        for field in fields:
+            _update_hash(hasher, field.name, options, _stack)
+            _update_hash(hasher, getattr(obj, field.name), options, _stack)
+
+
+def _digest_any(any, options: HashOptions) -> bytes:
+    hasher = _new_hasher(options.algorithm)
+    _update_hash(hasher, any, options)
+    return hasher.digest()
+
+def get_hash_from_any(any, algorithm="md5", tree=None, mode="exact"):
+    '''
+    tree: hash large tensors with the parallel tree hash, None uses the global setting (set_tree_hash)
+    mode: one of HASH_MODES, sampled and sampled+verify give the same (sampled) hash
+    '''
+    return _digest_any(any, _hash_options(algorithm, tree, mode)).hex()
+
+
+_INPUT_HASH_POOL = None
+_INPUT_HASH_POOL_LOCK = threading.Lock()
+
+def _get_input_hash_pool() -> ThreadPoolExecutor:
+    # hashlib and torch copies release the GIL, inputs are hashed in parallel
+    global _INPUT_HASH_POOL
+    with _INPUT_HASH_POOL_LOCK:
+        if _INPUT_HASH_POOL is None:
+            _INPUT_HASH_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 4), thread_name_prefix="hash-input")
+    return _INPUT_HASH_POOL
+
+def combine_digests(digests, algorithm="md5") -> str:
+    '''
+    Merkle-style combination: hash of the number of digests followed by the ordered digests
+    '''
+    hasher = _new_hasher(algorithm)
+    hasher.update(_sized(b"M", str(len(digests)).encode()))
+    for digest in digests:
+        hasher.update(digest)
+    return hasher.hexdigest()
+
+def get_hash_from_list_any(list_of_any, algorithm="md5", tree=None, mode="exact"):
     if not isinstance(list_of_any, list):
         raise TypeError(f'list_of_any should be a list, got {type(list_of_any)}')
-    # directly hash each item in the list  individually to prevent manipulating massive blobs of data
-    list_obj_bytes = [get_hash_from_any(item) for item in list_of_any]
-    # re-hash the list
-    return get_hash_from_any(list_obj_bytes)
+    options = _hash_options(algorithm, tree, mode)
+    # directly hash each item in the list individually (in parallel) to prevent manipulating massive blobs of data
+    if len(list_of_any) > 1:
+        digests = list(_get_input_hash_pool().map(partial(_digest_any, options=options), list_of_any))
+    else:
+        digests = [_digest_any(item, options) for item in list_of_any]
+    # combine the digests
+    return combine_digests(digests, algorithm=algorithm)
+
+
+# Cache metrics: counters and timing histograms per cache_name
+TIMING_BUCKETS_S = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float("inf"))
+
 
+class _CacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(lambda: defaultdict(int))  # cache_name -> counter -> value
+        self._timings = defaultdict(dict)  # cache_name -> phase -> histogram
 
-def get_cache_path(any_key, cache_name, verbose=False, ignore_errors=False) -> Path:
+    def count(self, cache_name, counter, n=1):
+        with self._lock:
+            self._counters[cache_name][counter] += n
 
+    def observe(self, cache_name, phase, seconds):
+        with self._lock:
+            histogram = self._timings[cache_name].get(phase)
+            if histogram is None:
+                histogram = {"count": 0, "total_s": 0.0, "max_s": 0.0, "buckets": [0] * len(TIMING_BUCKETS_S)}
+                self._timings[cache_name][phase] = histogram
+            histogram["count"] += 1
+            histogram["total_s"] += seconds
+            histogram["max_s"] = max(histogram["max_s"], seconds)
+            histogram["buckets"][next(i for i, bound in enumerate(TIMING_BUCKETS_S) if seconds <= bound)] += 1
+
+    def snapshot(self, cache_name=None) -> dict:
+        with self._lock:
+            names = set(self._counters) | set(self._timings) if cache_name is None else {cache_name}
+            stats = {}
+            for name in sorted(names):
+                timings = {}
+                for phase, histogram in self._timings.get(name, {}).items():
+                    timings[phase] = dict(histogram, buckets=dict(zip([str(b) for b in TIMING_BUCKETS_S], histogram["buckets"])))
+                stats[name] = {"counters": dict(self._counters.get(name, {})), "timings": timings}
+            return stats
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+CACHE_STATS = _CacheStats()
+
+
+def record_cache_event(cache_name, event, n=1):
+    '''
+    Increment a counter of cache_name (e.g. hits, misses, bytes_written)
+    '''
+    CACHE_STATS.count(cache_name, event, n)
+
+
+def record_cache_timing(cache_name, phase, seconds):
+    CACHE_STATS.observe(cache_name, phase, seconds)
+
+
+@contextmanager
+def cache_timer(cache_name, phase):
+    '''
+    Time the enclosed block in the histogram of phase (e.g. hash, serialize, deserialize, cleanup)
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        CACHE_STATS.observe(cache_name, phase, time.perf_counter() - start)
+
+
+def get_cache_stats(cache_name=None) -> dict:
+    '''
+    Counters and timing histograms per cache_name, for one cache_name or all of them
+    '''
+    return CACHE_STATS.snapshot(cache_name)
+
+
+def dump_cache_stats(path=None) -> str:
+    '''
+    Cache statistics as JSON, also written to path if given
+    '''
+    stats_json = json.dumps(get_cache_stats(), indent=2)
+    if path is not None:
+        with open(path, "w") as f:
+            f.write(stats_json)
+    return stats_json
+
+
+def reset_cache_stats():
+    CACHE_STATS.reset()
+
+
+def get_key_hash(any_key, cache_name, ignore_errors=False, algorithm="md5", tree=None, mode="exact"):
+    '''
+    Hash of a cache key, the items of a list are hashed individually
+    '''
     if isinstance(any_key, list):
         valid_keys = [item for item in any_key if item is not None]
         if len(valid_keys) < len(any_key):
             if ignore_errors:
                 return None
             raise ValueError(f'Found a None value in the list of input keys, Cache name={cache_name}')
-        md5_hash = get_hash_from_list_any(any_key)
+        with cache_timer(cache_name, "hash"):
+            return get_hash_from_list_any(any_key, algorithm=algorithm, tree=tree, mode=mode)
     else:
         if any_key is None:
             if ignore_errors:
                 return None
             raise ValueError(f'Cannot provide a cache file for an input key=None. Cache name={cache_name}')
-        md5_hash = get_hash_from_any(any_key)
+        with cache_timer(cache_name, "hash"):
+            return get_hash_from_any(any_key, algorithm=algorithm, tree=tree, mode=mode)
+
+
+def get_cache_path(any_key, cache_name, verbose=False, ignore_errors=False, algorithm="md5", tree=None, mode="exact") -> Path:
+    key_hash = get_key_hash(any_key, cache_name, ignore_errors=ignore_errors, algorithm=algorithm, tree=tree, mode=mode)
+    if key_hash is None:
+        return None
 
-    # compose the file name from the cache name and the md5 hash
-    filename = f"{cache_name}+{md5_hash}.pkl"
-    filepath = Path(CACHE_DIR) / filename
+    # compose the file name from the cache name and the hash
+    filename = f"{cache_name}+{key_hash}.pkl"
+    filepath = get_cache_dir() / filename
     if verbose:
-        print(f"cache+md5={filename}")
+        print(f"cache+{algorithm}{'' if mode == 'exact' else '+' + mode}={filename}")
     return filepath
@@ -0,0 +1,104 @@
+import weakref
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict
+import torch
+from .residency import device_key
+
+# Residency ledger of the modules handled by the offload/recall nodes: the device and size of each parameter and
+# buffer, with the bytes per device. It is synchronized with the module by a scan at the start of a node execution
+# (models may have been moved by ComfyUI in between), then updated with each move the nodes perform and checked
+# against the module after them.
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceLedger:
+    def __init__(self, module: torch.nn.Module):
+        self._module = weakref.ref(module)
+        self._entries = {}  # tensor name -> [device, nbytes]
+        self._totals = defaultdict(int)  # device -> bytes
+        self._lock = threading.Lock()
+        self.sync()
+
+    @staticmethod
+    def _scan(module) -> dict:
+        entries = {}
+        for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+            entries[name] = [device_key(tensor.device), tensor.numel() * tensor.element_size()]
+        return entries
+
+    def sync(self):
+        '''
+        Read the actual device of every tensor of the module
+        '''
+        module = self._module()
+        if module is None:
+            return
+        entries = self._scan(module)
+        with self._lock:
+            self._entries = entries
+            self._totals = defaultdict(int)
+            for device, nbytes in entries.values():
+                self._totals[device] += nbytes
+
+    def record_move(self, device, prefix: str = None):
+        '''
+        Record that the tensors of the module (or of its submodule prefix) were moved to device
+        '''
+        device = device_key(device)
+        with self._lock:
+            for name, entry in self._entries.items():
+                if prefix is None or name.startswith(prefix + "."):
+                    self._totals[entry[0]] -= entry[1]
+                    entry[0] = device
+                    self._totals[device] += entry[1]
+
+    def device_bytes(self) -> Dict[str, int]:
+        with self._lock:
+            return {device: nbytes for device, nbytes in self._totals.items() if nbytes > 0}
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(nbytes for _, nbytes in self._entries.values())
+
+    def fully_on(self, device) -> bool:
+        device_bytes = self.device_bytes()
+        return set(device_bytes) <= {device_key(device)}
+
+    def main_device(self):
+        '''
+        Device holding most of the bytes of the module, None if it has no tensor
+        '''
+        device_bytes = self.device_bytes()
+        return torch.device(max(device_bytes, key=device_bytes.get)) if device_bytes else None
+
+    def verify(self) -> Dict[str, tuple]:
+        '''
+        Compare the recorded bytes per device to the module, returns {device: (recorded, actual)} for the devices that
+        differ and synchronizes the ledger
+        '''
+        recorded = self.device_bytes()
+        self.sync()
+        actual = self.device_bytes()
+        return {device: (recorded.get(device, 0), actual.get(device, 0))
+                for device in set(recorded) | set(actual) if recorded.get(device, 0) != actual.get(device, 0)}
+
+
+_LEDGERS = weakref.WeakKeyDictionary()  # module -> DeviceLedger
+_LEDGERS_LOCK = threading.Lock()
+
+
+def get_ledger(module: torch.nn.Module, sync=False) -> DeviceLedger:
+    '''
+    Ledger of a module, created by a scan on first use. sync=True rescans an existing one.
+    '''
+    with _LEDGERS_LOCK:
+        ledger = _LEDGERS.get(module)
+        if ledger is None:
+            ledger = _LEDGERS[module] = DeviceLedger(module)
+            return ledger
+    if sync:
+        ledger.sync()
+    return ledger
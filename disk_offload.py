@@ -0,0 +1,85 @@
+import os
+import weakref
+import logging
+from pathlib import Path
+import torch
+from .common import get_hash_from_any
+from .cache_format import dump_entry, load_entry
+
+# Disk offload target of OffloadModel.
+# The parameters and buffers of a module are written to a tensor container (cache_format) in the temp folder of
+# ComfyUI, then replaced by copy-on-write memory-mapped tensors of that file: host RAM only holds the pages in use,
+# recalling the module to a device reads them back.
+# Files are named after an exact digest of the weights (tree hash, chunks hashed on all cores): offloading unchanged
+# weights again reuses the file, weights differing anywhere get their own file.
+
+OFFLOAD_DIR_NAME = "offloaded_models"
+DISK_DEVICE = "disk"
+
+logger = logging.getLogger(__name__)
+
+_OFFLOADED = weakref.WeakKeyDictionary()  # module -> path of the file backing its weights
+
+
+def get_offload_dir() -> Path:
+    import folder_paths
+    return Path(folder_paths.get_temp_directory()) / OFFLOAD_DIR_NAME
+
+
+def _named_tensors(module: torch.nn.Module):
+    yield from module.named_parameters()
+    yield from module.named_buffers()
+
+
+def _plain(tensor) -> torch.Tensor:
+    # subclasses (e.g. quantized gguf tensors) keep their python attributes on the module, only the data is stored
+    return tensor.detach().as_subclass(torch.Tensor)
+
+
+def weights_fingerprint(tensors: dict) -> str:
+    '''
+    Exact hash of the names, dtypes, shapes and data of the tensors.
+    A sampled hash is not enough: the file of other weights with the same sample would be reused.
+    '''
+    return get_hash_from_any(tensors, algorithm="blake2b", tree=True, mode="exact")
+
+
+def offload_to_disk(module: torch.nn.Module) -> Path:
+    '''
+    Move the weights of module to a memory-mapped file, returns its path
+    '''
+    tensors = {name: _plain(tensor) for name, tensor in _named_tensors(module)}
+    path = get_offload_dir() / f"{weights_fingerprint(tensors)}.bfmodel"
+    if path.exists():
+        logger.info(f'- Disk offload: weights unchanged, reusing {path}')
+    else:
+        os.makedirs(path.parent, exist_ok=True)
+        size = dump_entry(tensors, path, storage="tensor")
+        logger.info(f'- Disk offload: wrote {size / 1024 ** 2:.1f} MiB to {path}')
+    del tensors
+
+    mapped = load_entry(path, map_location="cpu")
+    for name, tensor in _named_tensors(module):
+        tensor.data = mapped[name]
+    _OFFLOADED[module] = path
+    return path
+
+
+def is_disk_offloaded(module) -> bool:
+    try:
+        return module in _OFFLOADED
+    except TypeError:
+        # not weak-referenceable, cannot have been offloaded
+        return False
+
+
+def offload_path(module):
+    return _OFFLOADED.get(module)
+
+
+def forget_disk_offload(module):
+    '''
+    To call once the weights of module are not backed by the file anymore (e.g. recalled to a device).
+    The file is kept to be reused by the next offload of the same weights.
+    '''
+    _OFFLOADED.pop(module, None)
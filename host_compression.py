@@ -0,0 +1,215 @@
+import zlib
+import weakref
+import logging
+import threading
+from fnmatch import fnmatch
+from functools import partial
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import torch
+from .disk_offload import _named_tensors, _plain
+from .cache_format import CODECS, COMPRESSION_CHUNK_SIZE, COMPRESSION_MAX_RATIO, _compress, _decompress, _get_codec_pool
+
+# Compression of the weights of a model offloaded to the host by OffloadModel, restored to their dtype by RecallModel.
+#   fp16, bf16: floating point tensors wider than 16 bits are downcast (lossy)
+#   int8: floating point tensors with 2 dimensions or more are quantized per output channel (dim 0), with a float32
+#         scale per channel (lossy)
+#   lossless: the bytes of each tensor are shuffled by significance (the exponent bytes of the values end up together)
+#         and compressed with zstd, lz4 or zlib, whichever is available first
+# Tensors matching one of the lossy_exclude patterns (e.g. norms, biases) are never compressed by a lossy mode.
+# While compressed, the parameters of the module hold the compact data (lossless: an empty tensor), the module cannot
+# be used before it is restored.
+
+HOST_COMPRESSION_MODES = ["none", "fp16", "bf16", "int8", "lossless"]
+LOSSY_MODES = ("fp16", "bf16", "int8")
+DEFAULT_LOSSY_EXCLUDE = "*norm*,*bias"
+LOSSLESS_CODEC = next((codec for codec in ("zstd", "lz4") if codec in CODECS), "zlib")
+_LOSSLESS_LEVEL = 1
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _StoredTensor:
+    mode: str
+    dtype: torch.dtype  # original dtype
+    shape: torch.Size
+    scale: Optional[torch.Tensor] = None  # int8: scale per output channel
+    chunks: Optional[List[bytes]] = None  # lossless: compressed chunks of the shuffled bytes
+    raw_size: int = 0
+    requires_grad: bool = False
+
+
+_COMPRESSED = weakref.WeakKeyDictionary()  # module -> {tensor name: _StoredTensor}
+_REPORTS = weakref.WeakKeyDictionary()  # module -> report of its last compression
+_LOCK = threading.Lock()
+
+
+def _nbytes(tensor: torch.Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+def _lossless_compress(data, level=_LOSSLESS_LEVEL) -> bytes:
+    if LOSSLESS_CODEC == "zlib":
+        return zlib.compress(data, level)
+    return _compress(data, LOSSLESS_CODEC, level)
+
+
+def _lossless_decompress(data, raw_size) -> bytes:
+    if LOSSLESS_CODEC == "zlib":
+        return zlib.decompress(data)
+    return _decompress(data, LOSSLESS_CODEC, raw_size)
+
+
+def _shuffled_bytes(tensor: torch.Tensor) -> torch.Tensor:
+    data = tensor.contiguous().reshape(-1).view(torch.uint8)
+    if tensor.element_size() > 1:
+        data = data.view(-1, tensor.element_size()).t().contiguous().reshape(-1)
+    return data
+
+
+def _unshuffled(data: torch.Tensor, dtype: torch.dtype, shape) -> torch.Tensor:
+    element_size = torch.empty(0, dtype=dtype).element_size()
+    if element_size > 1:
+        data = data.view(element_size, -1).t().contiguous().reshape(-1)
+    return data.view(dtype).reshape(shape)
+
+
+def _lossy_candidate(name: str, tensor: torch.Tensor, mode: str, lossy_exclude) -> bool:
+    if not tensor.is_floating_point() or any(fnmatch(name, pattern) for pattern in lossy_exclude):
+        return False
+    if mode == "int8":
+        return tensor.dim() >= 2 and tensor.element_size() > 1
+    # downcasting a 16 bits tensor saves nothing
+    return tensor.element_size() > 2
+
+
+def _quantize_int8(tensor: torch.Tensor):
+    flat = tensor.float().reshape(tensor.shape[0], -1)
+    scale = flat.abs().amax(dim=1, keepdim=True) / 127
+    scale[scale == 0] = 1
+    quantized = torch.round(flat / scale).clamp_(-127, 127).to(torch.int8)
+    return quantized.reshape(tensor.shape), scale
+
+
+def _restore(tensor: torch.Tensor, stored: _StoredTensor) -> torch.Tensor:
+    if stored.mode == "int8":
+        return (tensor.reshape(stored.shape[0], -1).float() * stored.scale).reshape(stored.shape).to(stored.dtype)
+    if stored.mode == "lossless":
+        pieces = list(_get_codec_pool().map(partial(_lossless_decompress, raw_size=COMPRESSION_CHUNK_SIZE), stored.chunks))
+        data = torch.frombuffer(bytearray(b"".join(pieces)), dtype=torch.uint8)
+        return _unshuffled(data, stored.dtype, stored.shape)
+    return tensor.to(stored.dtype)
+
+
+def _parse_patterns(lossy_exclude) -> List[str]:
+    if isinstance(lossy_exclude, str):
+        lossy_exclude = lossy_exclude.split(",")
+    return [pattern.strip() for pattern in lossy_exclude or [] if pattern.strip()]
+
+
+def compress_module(module: torch.nn.Module, mode: str, lossy_exclude=DEFAULT_LOSSY_EXCLUDE, prefixes=None,
+                    measure_error=False) -> dict:
+    '''
+    Compress the host (cpu) tensors of module, or of its submodules prefixes only.
+    Returns a report: bytes before and after, tensors compressed and, with measure_error, the round-trip error of the
+    lossy modes (max absolute and relative RMS error).
+    '''
+    if mode not in HOST_COMPRESSION_MODES:
+        raise ValueError(f"Unknown compression mode={mode}, expected one of {HOST_COMPRESSION_MODES}")
+    lossy_exclude = _parse_patterns(lossy_exclude)
+    report = {"mode": mode, "codec": LOSSLESS_CODEC if mode == "lossless" else None, "tensors": 0, "skipped": 0,
+              "bytes_before": 0, "bytes_after": 0}
+    squared_error = squared_norm = max_error = 0.0
+    if mode == "none":
+        return dict(report, saved_bytes=0)
+
+    with _LOCK:
+        stored_tensors = _COMPRESSED.setdefault(module, {})
+    for name, tensor in _named_tensors(module):
+        if name in stored_tensors or tensor.device.type != "cpu" or tensor.numel() == 0:
+            continue
+        if prefixes is not None and not any(name.startswith(prefix + ".") for prefix in prefixes):
+            continue
+        plain = _plain(tensor)
+        if mode == "lossless":
+            data = _shuffled_bytes(plain).numpy()
+            chunks = [data[i:i + COMPRESSION_CHUNK_SIZE] for i in range(0, len(data), COMPRESSION_CHUNK_SIZE)]
+            compressed = list(_get_codec_pool().map(_lossless_compress, chunks))
+            if sum(len(chunk) for chunk in compressed) > COMPRESSION_MAX_RATIO * _nbytes(plain):
+                # incompressible (e.g. already quantized weights)
+                report["skipped"] += 1
+                continue
+            stored = _StoredTensor(mode, plain.dtype, plain.shape, chunks=compressed, raw_size=_nbytes(plain))
+            compact = torch.empty(0, dtype=plain.dtype)
+            after = sum(len(chunk) for chunk in compressed)
+        elif _lossy_candidate(name, plain, mode, lossy_exclude):
+            if mode == "int8":
+                compact, scale = _quantize_int8(plain)
+                stored = _StoredTensor(mode, plain.dtype, plain.shape, scale=scale)
+                after = _nbytes(compact) + _nbytes(scale)
+            else:
+                compact = plain.to(torch.float16 if mode == "fp16" else torch.bfloat16)
+                stored = _StoredTensor(mode, plain.dtype, plain.shape)
+                after = _nbytes(compact)
+            if measure_error:
+                difference = (_restore(compact, stored).float() - plain.float())
+                squared_error += difference.square().sum().item()
+                squared_norm += plain.float().square().sum().item()
+                max_error = max(max_error, difference.abs().max().item())
+        else:
+            report["skipped"] += 1
+            continue
+        report["tensors"] += 1
+        report["bytes_before"] += _nbytes(plain)
+        report["bytes_after"] += after
+        stored_tensors[name] = stored
+        if tensor.requires_grad and not compact.is_floating_point():
+            # integer data cannot require gradients
+            stored.requires_grad = True
+            tensor.requires_grad_(False)
+        tensor.data = compact
+
+    report["saved_bytes"] = report["bytes_before"] - report["bytes_after"]
+    if measure_error and mode in LOSSY_MODES:
+        report["max_abs_error"] = max_error
+        report["rel_rms_error"] = (squared_error / squared_norm) ** 0.5 if squared_norm > 0 else 0.0
+    with _LOCK:
+        _REPORTS[module] = report
+    logger.info(f"- Host compression ({mode}): {report['tensors']} tensor(s), "
+                f"{report['bytes_before'] / 1024 ** 2:.1f} -> {report['bytes_after'] / 1024 ** 2:.1f} MiB")
+    return report
+
+
+def decompress_module(module: torch.nn.Module) -> int:
+    '''
+    Restore the compressed tensors of module to their original dtype (on the host), returns the number of tensors
+    '''
+    with _LOCK:
+        stored_tensors = _COMPRESSED.pop(module, {})
+    tensors = dict(_named_tensors(module))
+    for name, stored in stored_tensors.items():
+        tensor = tensors.get(name)
+        if tensor is not None:
+            tensor.data = _restore(_plain(tensor), stored)
+            if stored.requires_grad:
+                tensor.requires_grad_(True)
+    return len(stored_tensors)
+
+
+def is_compressed(module) -> bool:
+    try:
+        return bool(_COMPRESSED.get(module))
+    except TypeError:
+        # not weak-referenceable, cannot have been compressed
+        return False
+
+
+def compression_report(module) -> Dict:
+    '''
+    Report of the last compression of module, empty if it was never compressed
+    '''
+    try:
+        return dict(_REPORTS.get(module, {}))
+    except TypeError:
+        return {}
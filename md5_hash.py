@@ -1,15 +1,95 @@
-from .common import any_type
-import pickle
+import json
 import hashlib
-import torch
-from .common import _to_bytes
+import threading
+from collections import OrderedDict
+from .common import any_type
+from .common import HASH_ALGORITHMS, HASH_MODES, get_hash_from_any, get_hash_from_list_any
+
+# Options and hidden inputs shared by the hash nodes
+HASH_NODE_INPUTS = {
+    "algorithm": (HASH_ALGORITHMS, {"default": "md5", "tooltip": "md5 by default, blake2b/xxh3_128 are faster on large inputs. Changing it changes the hash."}),
+    "tree_hash": ("BOOLEAN", {"default": False, "tooltip": "Hash large tensors in chunks on all cores (also enabled globally by BETTER_FLOW_TREE_HASH=1). Changing it changes the hash."}),
+    # sampled+verify needs the data at lookup time, the hash nodes only output the hash
+    "mode": (HASH_MODES[:2], {"default": "exact", "tooltip": "exact: all the data is hashed. sampled: large tensors are identified by their dtype, shape and a fixed-size sample of their data, much faster but blind to changes outside the sample. sampled+verify is not offered: the output is only the hash, a Cache any node cannot verify a hit against it; connect the data itself to any_key of Cache any with key_mode=sampled+verify instead."}),
+}
+HASH_NODE_HIDDEN_INPUTS = {"unique_id": "UNIQUE_ID", "extra_pnginfo": "EXTRA_PNGINFO", "prompt": "PROMPT"}
+
+# Hashes output by the hash nodes, published for the cache warmer: keyed by the node id and the signature of the node
+# in its prompt (input_signature), the same node with the same signature in a queued prompt is expected to output the
+# same hash. The inputs hashed are links in the prompts queued from the UI, the hash cannot be computed at queue time.
+PUBLISHED_HASHES_MAX = 1024
+_PUBLISHED_HASHES = OrderedDict()  # (node id, signature) -> hash
+_PUBLISHED_HASHES_LOCK = threading.Lock()
+
+
+def _is_link(value) -> bool:
+    # inputs connected to another node are [source node id, output index] in the prompt
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+
+def input_signature(prompt: dict, node_id) -> str:
+    '''
+    Digest of the class and inputs of a node of the prompt and of all the nodes it depends on (ids excluded).
+    None if the node is not in the prompt.
+    '''
+    signatures = {}
+
+    def signature(node_id):
+        node_id = str(node_id)
+        if node_id not in signatures:
+            node = prompt.get(node_id)
+            if not isinstance(node, dict):
+                signatures[node_id] = None
+                return None
+            signatures[node_id] = "cycle"
+            inputs = {name: ["link", signature(value[0]), value[1]] if _is_link(value) else value
+                      for name, value in node.get("inputs", {}).items()}
+            description = json.dumps([node.get("class_type"), inputs], sort_keys=True, default=str)
+            signatures[node_id] = hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+        return signatures[node_id]
+
+    return signature(node_id) if isinstance(prompt, dict) else None
+
+
+def publish_hash(str_hash, unique_id, prompt):
+    signature = input_signature(prompt, unique_id)
+    if signature is None:
+        return
+    with _PUBLISHED_HASHES_LOCK:
+        _PUBLISHED_HASHES[(str(unique_id), signature)] = str_hash
+        _PUBLISHED_HASHES.move_to_end((str(unique_id), signature))
+        while len(_PUBLISHED_HASHES) > PUBLISHED_HASHES_MAX:
+            _PUBLISHED_HASHES.popitem(last=False)
+
+
+def published_hash(prompt: dict, node_id):
+    '''
+    Last hash output by the hash node node_id with the same signature as in prompt, None if it never ran so
+    '''
+    signature = input_signature(prompt, node_id)
+    with _PUBLISHED_HASHES_LOCK:
+        return _PUBLISHED_HASHES.get((str(node_id), signature))
+
+
+def _store_hash_in_workflow(str_hash, unique_id, extra_pnginfo):
+    # keep the hash as a property of the node in the saved workflow (its widgets_values are the hash options)
+    if not extra_pnginfo:
+        pass
+    elif (not isinstance(extra_pnginfo, dict) or "workflow" not in extra_pnginfo):
+        pass
+    else:
+        workflow = extra_pnginfo["workflow"]
+        node = next((x for x in workflow["nodes"] if str(x["id"]) == unique_id), None)
+        if node:
+            node.setdefault("properties", {})["last_hash"] = str_hash
+
 
 class AnyToHash:
     @classmethod
     def INPUT_TYPES(s):
-        return {"required": {"anything": (any_type, {}), },"optional": {}, 
-                "hidden": {"unique_id": "UNIQUE_ID", "extra_pnginfo": "EXTRA_PNGINFO",
-                           }}
+        return {"required": {"anything": (any_type, {}), },
+                "optional": dict(HASH_NODE_INPUTS),
+                "hidden": dict(HASH_NODE_HIDDEN_INPUTS)}
 
     RETURN_TYPES = (any_type,)
     RETURN_NAMES = ('string',)
@@ -17,29 +97,21 @@ class AnyToHash:
     FUNCTION = "to_md5_hash"
     CATEGORY = "workflow"
 
-    def to_md5_hash(self, anything, unique_id=None, extra_pnginfo=None, **kwargs):
+    def to_md5_hash(self, anything, algorithm="md5", tree_hash=False, mode="exact", unique_id=None, extra_pnginfo=None, prompt=None, **kwargs):
         if anything is None:
             raise ValueError('AnyToHash received a None input')
         str_hash = []
         try:
-            object_bytes = _to_bytes(anything)
-            # hash it with md5
-            md5_hash = hashlib.md5(object_bytes).hexdigest()
-            str_hash = str(md5_hash)
+            # stream the object into the digest (no intermediate copy of tensors)
+            str_hash = str(get_hash_from_any(anything, algorithm=algorithm, tree=tree_hash or None, mode=mode))
         except Exception as e:
             print("AnyToHash: -Warning- encountered could not hash the input, returned a str")
             str_hash = str(e)
+        else:
+            publish_hash(str_hash, unique_id, prompt)
                     
 
-        if not extra_pnginfo:
-            pass
-        elif (not isinstance(extra_pnginfo, dict) or "workflow" not in extra_pnginfo):
-            pass
-        else:
-            workflow = extra_pnginfo["workflow"]
-            node = next((x for x in workflow["nodes"] if str(x["id"]) == unique_id), None)
-            if node:
-                node["widgets_values"] = str_hash
+        _store_hash_in_workflow(str_hash, unique_id, extra_pnginfo)
         return (str_hash,)
 
 class AnyToHashMulti:
@@ -47,8 +119,8 @@ class AnyToHashMulti:
     def INPUT_TYPES(s):
         return {"required": {"anything1": (any_type, {}), 
                              "anything2": (any_type, {}), }, 
-                "hidden": {"unique_id": "UNIQUE_ID", "extra_pnginfo": "EXTRA_PNGINFO",
-                           }}
+                "optional": dict(HASH_NODE_INPUTS),
+                "hidden": dict(HASH_NODE_HIDDEN_INPUTS)}
 
     RETURN_TYPES = (any_type,)
     RETURN_NAMES = ('string',)
@@ -56,29 +128,78 @@ class AnyToHashMulti:
     FUNCTION = "to_md5_hash_mult"
     CATEGORY = "workflow"
 
-    def to_md5_hash_mult(self, anything1, anything2, unique_id=None, extra_pnginfo=None, **kwargs):
+    def to_md5_hash_mult(self, anything1, anything2, algorithm="md5", tree_hash=False, mode="exact", unique_id=None, extra_pnginfo=None, prompt=None, **kwargs):
         if anything1 is None or anything2 is None:
             raise ValueError('AnyToHash received a None input')
         str_hash = []
         try:
-            # serialize the key to bytes for hashing
-            object_bytes = pickle.dumps([_to_bytes(anything1), 
-                                         _to_bytes(anything2)], protocol=pickle.HIGHEST_PROTOCOL)
-            # hash it with md5
-            md5_hash = hashlib.md5(object_bytes).hexdigest()
-            str_hash = str(md5_hash)
+            # hash each input individually, then re-hash the two hashes
+            str_hash = str(get_hash_from_list_any([anything1, anything2], algorithm=algorithm, tree=tree_hash or None, mode=mode))
         except Exception as e:
             print("AnyToHash: -Warning- encountered could not hash the input, returned a str")
             str_hash = str(e)
+        else:
+            publish_hash(str_hash, unique_id, prompt)
                     
 
-        if not extra_pnginfo:
-            pass
-        elif (not isinstance(extra_pnginfo, dict) or "workflow" not in extra_pnginfo):
-            pass
+        _store_hash_in_workflow(str_hash, unique_id, extra_pnginfo)
+        return (str_hash,)
+
+class AnyToHashN:
+    """
+    Hash any number of inputs: each input is hashed independently (in parallel),
+    then the ordered digests are combined into one key.
+    Dynamically adds new inputs as they are connected.
+    """
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {}, 
+                "optional": {"anything1": (any_type, {}), **HASH_NODE_INPUTS},
+                "hidden": dict(HASH_NODE_HIDDEN_INPUTS)}
+
+    @classmethod
+    def INPUT_TYPES_WITH_NODE_ID(cls, node_id=None, extra_pnginfo=None):
+        """
+        Called when the node is displayed/updated in the UI, shows one more input than the connected ones.
+        """
+        inputs = cls.INPUT_TYPES()
+        num_inputs = 1
+        if extra_pnginfo is not None and "workflow" in extra_pnginfo:
+            for node in extra_pnginfo["workflow"].get("nodes", []):
+                if str(node.get("id")) == str(node_id):
+                    input_count = 0
+                    for inp in node.get("inputs", []):
+                        if inp.get("name", "").startswith("anything"):
+                            input_count += 1
+                            if inp.get("link") is not None:
+                                num_inputs = max(num_inputs, input_count + 1)
+                    break
+        for i in range(1, num_inputs + 1):
+            inputs["optional"][f"anything{i}"] = (any_type, {})
+        return inputs
+
+    RETURN_TYPES = (any_type,)
+    RETURN_NAMES = ('string',)
+    OUTPUT_NODE = True
+    FUNCTION = "to_hash_n"
+    CATEGORY = "workflow"
+
+    def to_hash_n(self, algorithm="md5", tree_hash=False, mode="exact", unique_id=None, extra_pnginfo=None, prompt=None, **kwargs):
+        # connected inputs, ordered by their number
+        names = sorted((k for k in kwargs if k.startswith("anything") and k[len("anything"):].isdigit()),
+                       key=lambda k: int(k[len("anything"):]))
+        values = [kwargs[k] for k in names if kwargs[k] is not None]
+        if len(values) == 0:
+            raise ValueError('AnyToHashN received no input')
+        str_hash = []
+        try:
+            str_hash = str(get_hash_from_list_any(values, algorithm=algorithm, tree=tree_hash or None, mode=mode))
+        except Exception as e:
+            print("AnyToHashN: -Warning- encountered could not hash the input, returned a str")
+            str_hash = str(e)
         else:
-            workflow = extra_pnginfo["workflow"]
-            node = next((x for x in workflow["nodes"] if str(x["id"]) == unique_id), None)
-            if node:
-                node["widgets_values"] = str_hash
+            publish_hash(str_hash, unique_id, prompt)
+
+        _store_hash_in_workflow(str_hash, unique_id, extra_pnginfo)
         return (str_hash,)
\ No newline at end of file
@@ -4,14 +4,22 @@ from typing import Tuple, List, Union
 from dataclasses import dataclass
 import torch
 import gc
+import sys
+import json
+import builtins
 import logging
-
-try:
-    from nunchaku import NunchakuFluxTransformer2dModel
-    NUNCHAKU_AVAILABLE = True
-except ImportError:
-    NUNCHAKU_AVAILABLE = False
-    NunchakuFluxTransformer2dModel = None
+import threading
+from functools import lru_cache, wraps
+from .disk_offload import DISK_DEVICE, offload_to_disk, is_disk_offloaded, forget_disk_offload
+from .staging_buffers import move_module, release_staging_buffers
+from .residency import RESIDENCY, EvictionPlan, module_nbytes, default_free_bytes
+from .patcher_registry import register_patcher, report_dangling_clones
+from .partial_offload import partial_offload, recall_partial, offloaded_blocks
+from .device_ledger import get_ledger
+from .residency import device_key
+from .host_compression import HOST_COMPRESSION_MODES, DEFAULT_LOSSY_EXCLUDE, compress_module, decompress_module, is_compressed
+from .prefetch import prefetch
+from .transfer_telemetry import transfer, timed, timed_move, get_transfer_summary, get_transfer_history, export_transfer_history
 
 logger = logging.getLogger(__name__)
 
@@ -28,33 +36,78 @@ class ModelInfo:
     device_target: Union[torch.device, int]
     device_offload: Union[torch.device, int]
     move_func: callable  # function to call to change the device
+    on_disk: bool = False  # weights memory-mapped from a disk offload file
+    device_bytes: dict = None  # bytes of weights per device (from the residency ledger), several devices if mixed
+    offloaded_blocks: dict = None  # blocks moved by a partial offload -> device they were moved from
+    compressed: bool = False  # host weights compressed by the offload, restored by the recall
+
+    def fully_on(self, device) -> bool:
+        """
+        True if all the weights are on device
+        """
+        if self.device_bytes:
+            return set(self.device_bytes) <= {device_key(device)}
+        return device_key(self.device_current) == device_key(device)
 
 
 any = AnyType("*")
 
-# Looking recursively for variable types to flag a non supported error
-UNSUPPORTED_CHK = []
-
-if NUNCHAKU_AVAILABLE:
-    UNSUPPORTED_CHK.append(
-        # each entry is a tuple describing what to check
-        (
-            ['model', 'diffusion_model', 'model'],  # variable names to check (first attribute model, then model.diffusion_model, then model.diffusion_model.model)
-            "NunchakuFluxTransformer2dModel",  # unsupported class name to match
-            "Nunchaku not supported (offloading directly managed in the binaries).\n"  #  error message 
-            "solution: 1) Ignore errors or disable offloading for this node. 2) "
-            "use the option to enable/disable automatic offloading directly the nunchaku loader."  # error resoltion message,
-        ),
-    )
-
-
-device_options = ["auto","cpu"]
-if torch.cuda.is_available():
-    for i in range(torch.cuda.device_count()):
-        # This creates user-friendly names like "cuda:0"
-        device_name = torch.cuda.get_device_name(i)
-        #device_options.append(f"cuda:{i} ({device_name})")  # People should know already their devices :)
-        device_options.append(f"{torch.device(i)}")
+_NUNCHAKU_CLASS = None
+
+
+def get_nunchaku_class():
+    """
+    NunchakuFluxTransformer2dModel if nunchaku is loaded, None otherwise.
+    Nunchaku is never imported from here: a nunchaku model can only exist once its loader imported it.
+    """
+    global _NUNCHAKU_CLASS
+    if _NUNCHAKU_CLASS is None and "nunchaku" in sys.modules:
+        try:
+            from nunchaku import NunchakuFluxTransformer2dModel
+            _NUNCHAKU_CLASS = NunchakuFluxTransformer2dModel
+        except ImportError:
+            pass
+    return _NUNCHAKU_CLASS
+
+
+def get_unsupported_checks() -> list:
+    """
+    Looking recursively for variable types to flag a non supported error
+    """
+    unsupported_chk = []
+    if get_nunchaku_class() is not None:
+        unsupported_chk.append(
+            # each entry is a tuple describing what to check
+            (
+                ['model', 'diffusion_model', 'model'],  # variable names to check (first attribute model, then model.diffusion_model, then model.diffusion_model.model)
+                "NunchakuFluxTransformer2dModel",  # unsupported class name to match
+                "Nunchaku not supported (offloading directly managed in the binaries).\n"  #  error message 
+                "solution: 1) Ignore errors or disable offloading for this node. 2) "
+                "use the option to enable/disable automatic offloading directly the nunchaku loader."  # error resoltion message,
+            ),
+        )
+    return unsupported_chk
+
+
+@lru_cache(maxsize=None)
+def get_device_options() -> tuple:
+    """
+    Devices to choose from, enumerated on first use (importing the package does not initialize cuda)
+    """
+    device_options = ["auto","cpu"]
+    if torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            # This creates user-friendly names like "cuda:0"
+            #device_options.append(f"cuda:{i} ({torch.cuda.get_device_name(i)})")  # People should know already their devices :)
+            device_options.append(f"{torch.device(i)}")
+    return tuple(device_options)
+
+
+def get_offload_device_options() -> list:
+    # disk: the weights are written to a file and memory-mapped, freeing host RAM
+    device_options = list(get_device_options())
+    return device_options[:2] + [DISK_DEVICE] + device_options[2:]
+
 
 class OffloadModel:
     @classmethod
@@ -62,9 +115,14 @@ class OffloadModel:
         return {
             "required": {"trigger_value": (any, )},
             "optional": {"model": (any, ),
-                         "device": (device_options, {"default": "auto", "label": "Load Device", "tooltip": "Select the device to offload the model to."}),
+                         "device": (get_offload_device_options(), {"default": "auto", "label": "Load Device", "tooltip": "Select the device to offload the model to. disk: the weights are written to a memory-mapped file in the temp folder, freeing host RAM."}),
                          "on_error": (["ignore", "raise"], {"default": "raise", "label": "On Error", "tooltip": "What to do on error: ignore or raise an exception."}),
-                         "enable": ("BOOLEAN", {"default": True, "label": "Enable Offload", "tooltip": "Enable offloading of the model to the offload device."})                         
+                         "enable": ("BOOLEAN", {"default": True, "label": "Enable Offload", "tooltip": "Enable offloading of the model to the offload device."}),
+                         "use_staging_buffers": ("BOOLEAN", {"default": False, "tooltip": "Offload into host buffers kept for this model (pinned if possible) and reused by every later offload, instead of allocating new ones. Their total size is capped by BETTER_FLOW_STAGING_BUFFER_MB."}),
+                         "target_free_mb": ("INT", {"default": 0, "min": 0, "max": 1 << 30, "tooltip": "Partial offload: only offload blocks of the model (e.g. transformer blocks, last ones first) until this much memory is free on its device. 0 = whole model."}),
+                         "fraction": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.05, "tooltip": "Partial offload: only offload this fraction of the model (by blocks, last ones first). 0 = whole model."}),
+                         "compression": (HOST_COMPRESSION_MODES, {"default": "none", "tooltip": "Compress the weights offloaded to cpu to save host RAM, Model recall restores their dtype. fp16/bf16: downcast, int8: per-channel quantization (lossy), lossless: byte-level compression. A compressed model must be recalled before use: ModelPatcher models are restored automatically when ComfyUI loads them, other models must go through Model recall."}),
+                         "lossy_exclude": ("STRING", {"default": DEFAULT_LOSSY_EXCLUDE, "tooltip": "Comma separated patterns of weight names that lossy compression modes leave untouched."}),
                          },
         }
     
@@ -79,6 +137,7 @@ class OffloadModel:
     def route(self, **kwargs):
         logging.info("Offload Model (node)")
         model_candidate = kwargs.get("model")
+        register_patchers(model_candidate)
         
         if not kwargs.get("enable", True):
             return (kwargs.get("trigger_value"), kwargs.get("model"),)
@@ -89,48 +148,11 @@ class OffloadModel:
 
         # get the device and function do move it between devices
         list_models = scan_for_models(top_model=model_candidate)
-        for model in list_models:
-            m_info: ModelInfo = get_model_info(model)
-            cls = m_info.classname
-            #preferred_device = m_info.device_target if m_info.device_target is not None else mm.get_torch_device()
-            
-            if kwargs.get("device", "auto") == "auto":
-                offload_device = mm.unet_offload_device() if m_info.device_offload is not None else mm.unet_offload_device()
-            else:
-                # Use the requested device from parameters
-                offload_device = torch.device(kwargs.get("device"))
-
-            if torch.device(m_info.device_current) != torch.device(offload_device):
-
-                if m_info.classname == "GGUFModelPatcher":
-                    logging.info(f'- For GGUFModelPatcher {cls}, offloading  will move all patches to the offload device {torch.device(offload_device)}')
-                    logger.info(f'- Changing the patch_on_device flag to False, overriding the default value from the gguf loader')
-                    model.eject_model()  # eject the unet model to move it
-                    model.unpatch_model()  # unpatch to avoid issues
-                    model.model.to(torch.device(offload_device))
-                else:
-
-                    logging.info(f'- Offload {cls}: move from {torch.device(m_info.device_current)}'
-                        f' to {torch.device(offload_device)}...')
-                    m_info.move_func(torch.device(offload_device))
-                    logging.info(f'- Offload {cls}: done')
-
-            # Validate the migration
-            m_info_post: ModelInfo = get_model_info(model)
-            if torch.device(m_info_post.device_current) == torch.device(offload_device):
-                logging.info(f'- Offload {cls}: validated')
-                logging.debug('- Freeing VRAM...')
-                gc.collect()
-                mm.cleanup_models_gc()
-                mm.soft_empty_cache()
-                logging.debug('- cleanup done')
-                # todo custom cleanup for known models? eg. flux transformer
-                # model_size = mm.module_size(self.transformer)
-                # do migration to offload device
-                # mm.free_memory(model_size, device)
-            else:
-                logging.error(f'- Error for {cls}: Could not validate offloading, '
-                      f'model is on {torch.device(m_info_post.device_current)} instead of {torch.device(offload_device)}')
+        with transfer("offload"):
+            for model in list_models:
+                offload_model(model, device=kwargs.get("device", "auto"), use_staging_buffers=kwargs.get("use_staging_buffers", False),
+                              target_free_bytes=kwargs.get("target_free_mb", 0) * 1024 * 1024, fraction=kwargs.get("fraction", 0.0),
+                              compression=kwargs.get("compression", "none"), lossy_exclude=kwargs.get("lossy_exclude", DEFAULT_LOSSY_EXCLUDE))
 
         return (kwargs.get("trigger_value"), kwargs.get("model"),)
     
@@ -141,9 +163,13 @@ class RecallModel:
         return {
             "required": {"trigger_value": (any, )}, # For passthrough
             "optional": {"model": (any, ),
-                         "device": (device_options, {"default": "auto", "label": "Load Device", "tooltip": "Select the device to recall the model to."}),
+                         "device": (list(get_device_options()), {"default": "auto", "label": "Load Device", "tooltip": "Select the device to recall the model to."}),
                          "on_error": (["ignore", "raise"], {"default": "raise", "label": "On Error", "tooltip": "What to do on error: ignore or raise an exception."}),
                          "enable": ("BOOLEAN", {"default": True, "label": "Enable Recall", "tooltip": "Enable recall of the model to the preferred device."}),
+                         "use_staging_buffers": ("BOOLEAN", {"default": False, "tooltip": "Recall with asynchronous copies from the host buffers of the model (see Model Offload)."}),
+                         "auto_evict": ("BOOLEAN", {"default": False, "tooltip": "Before the recall, offload the least recently used models (seen by the Offload/Recall nodes) from the device, just enough for this model to fit."}),
+                         "vram_budget_mb": ("INT", {"default": 0, "min": 0, "max": 1 << 30, "tooltip": "auto_evict: memory of the device usable by the models seen by the Offload/Recall nodes. 0 = the free memory of the device."}),
+                         "debug_leak_scan": ("BOOLEAN", {"default": False, "tooltip": "Scan the whole heap with the garbage collector for dangling GGUFModelPatcher clones and log their referrers (slow)."}),
                          
                          },
         }
@@ -158,9 +184,13 @@ class RecallModel:
 
     def route(self, **kwargs):
         logging.info("Recall Model (node)")
-        check_gc_for_dangling_clones(classname_to_check="GGUFModelPatcher")  # checking for dangling clones
-
         model_candidate = kwargs.get("model")
+        register_patchers(model_candidate)
+        if kwargs.get("debug_leak_scan", False):
+            check_gc_for_dangling_clones(classname_to_check="GGUFModelPatcher")  # checking for dangling clones
+        else:
+            report_dangling_clones(classname_to_check="GGUFModelPatcher")
+
         cls = model_candidate.__class__.__name__
         if not kwargs.get("enable", True):
             return (kwargs.get("trigger_value"), kwargs.get("model"),)
@@ -173,60 +203,425 @@ class RecallModel:
 
         # get the device and function do move it between devices
         list_models = scan_for_models(top_model=model_candidate)
-        if len(list_models) > 0:
-            logging.debug('- Freeing VRAM...')
-            mm.soft_empty_cache()
-            gc.collect()
-            logging.debug('- done')
-        for model in list_models:
-            m_info: ModelInfo = get_model_info(model)
-            
-            if kwargs.get("device", "auto") == "auto":
-                preferred_device = m_info.device_target if m_info.device_target is not None else mm.get_torch_device()
-            else:
-                # Use the requested device from parameters
-                preferred_device = torch.device(kwargs.get("device"))
-            #offload_device = mm.unet_offload_device() if m_info.device_offload is not None else mm.unet_offload_device()
-
-            if torch.device(m_info.device_current) != torch.device(preferred_device):
-                logging.info(f'- Recall {cls} from {torch.device(m_info.device_current)}'
-                    f' to {torch.device(preferred_device)}...')
-                if m_info.classname == "GGUFModelPatcher":
-                    logging.info(f'- Overriding GGUFModelPatcher''s default behavior')
-                    model.eject_model()  # eject the unet model to move it
-                    model.unpatch_model()  # unpatch to avoid issues
-                    model.model.to(torch.device(preferred_device))
-                    model.patch_model()  # reapply patches
-                if m_info.classname == "ModelPatcher":
-                    logging.info(f'- Overriding ModelPatcher''s default behavior')
-                    model.eject_model()  # eject the unet model to move it
-                    model.unpatch_model()  # unpatch to avoid issues
-                    model.model.to(torch.device(preferred_device))
-                    model.patch_model()  # reapply patches
-
+        with transfer("recall"):
+            targets = []
+            for model in list_models:
+                m_info: ModelInfo = get_model_info(model, sync=True)  # the model may have been moved since the last node
+                targets.append((model, m_info, get_recall_device(m_info, kwargs.get("device", "auto"))))
+            # builtins.any: any is the AnyType instance of this module
+            if builtins.any(not m_info.fully_on(preferred_device) or m_info.on_disk or m_info.compressed for _, m_info, preferred_device in targets):
+                logging.debug('- Freeing VRAM...')
+                with timed("soft_empty_cache"):
+                    mm.soft_empty_cache()
+                with timed("gc.collect"):
+                    gc.collect()
+                logging.debug('- done')
+            for model, m_info, preferred_device in targets:
+                #offload_device = mm.unet_offload_device() if m_info.device_offload is not None else mm.unet_offload_device()
+                if m_info.fully_on(preferred_device) and not m_info.on_disk and not m_info.compressed:
+                    # nothing to move nor to clean up
+                    logging.info(f'- Recall {cls}: already on {torch.device(preferred_device)}')
+                    RESIDENCY.track(model, module_nbytes(get_offload_module(model)), preferred_device, name=m_info.classname)
+                    continue
+
+                if m_info.compressed:
+                    restore_compressed(model)
+                    m_info = get_model_info(model, sync=True)
+
+                if m_info.offloaded_blocks:
+                    module = get_offload_module(model)
+                    with timed_move(cls, m_info.device_bytes, preferred_device) as move:
+                        names = recall_partial(module, preferred_device, use_staging_buffers=kwargs.get("use_staging_buffers", False))
+                        move["bytes"] = get_ledger(module).device_bytes().get(device_key(preferred_device), 0) - \
+                            m_info.device_bytes.get(device_key(preferred_device), 0)
+                    logging.info(f'- Recall {cls}: moved back {len(names)} partially offloaded block(s) to {torch.device(preferred_device)}')
+                    m_info = get_model_info(model)
+
+                if kwargs.get("auto_evict", False) and not m_info.fully_on(preferred_device):
+                    budget_mb = kwargs.get("vram_budget_mb", 0)
+                    RESIDENCY.set_budget(preferred_device, budget_mb * 1024 * 1024 if budget_mb > 0 else None)
+                    plan = plan_recall(model, preferred_device)
+                    evicted = RESIDENCY.apply(plan, evict_fn=offload_model)
+                    logging.info(f'- Recall {cls}: evicted {len(evicted)} model(s) {evicted} from {plan.device}')
+                    if not plan.fits:
+                        logging.warning(f'- Recall {cls}: {plan.required_bytes / 1024 ** 2:.1f} MiB needed on {plan.device}, '
+                                        f'it does not fit even after evicting all the other models')
+
+                if m_info.on_disk and m_info.fully_on(preferred_device):
+                    # the memory-mapped weights are already usable from the host, pages are read when used
+                    logging.info(f'- Recall {cls}: weights stay memory-mapped from disk on {torch.device(preferred_device)}')
+                    if m_info.classname in ("GGUFModelPatcher", "ModelPatcher"):
+                        with timed("patch_model"):
+                            model.patch_model()  # reapply the patches removed by the disk offload
+
+                if not m_info.fully_on(preferred_device):
+                    logging.info(f'- Recall {cls} from {m_info.device_bytes or torch.device(m_info.device_current)}'
+                        f' to {torch.device(preferred_device)}...')
+                    if m_info.classname == "GGUFModelPatcher":
+                        logging.info(f'- Overriding GGUFModelPatcher''s default behavior')
+                        with timed("eject_model"):
+                            model.eject_model()  # eject the unet model to move it
+                        with timed("unpatch_model"):
+                            model.unpatch_model()  # unpatch to avoid issues
+                        move_model(model, m_info, torch.device(preferred_device), kwargs.get("use_staging_buffers", False))
+                        with timed("patch_model"):
+                            model.patch_model()  # reapply patches
+                    if m_info.classname == "ModelPatcher":
+                        logging.info(f'- Overriding ModelPatcher''s default behavior')
+                        with timed("eject_model"):
+                            model.eject_model()  # eject the unet model to move it
+                        with timed("unpatch_model"):
+                            model.unpatch_model()  # unpatch to avoid issues
+                        move_model(model, m_info, torch.device(preferred_device), kwargs.get("use_staging_buffers", False))
+                        with timed("patch_model"):
+                            model.patch_model()  # reapply patches
+
+                    else:
+
+                        move_model(model, m_info, torch.device(preferred_device), kwargs.get("use_staging_buffers", False))
+                        logging.info(f'- Recalling {cls} done')
+
+                # Validate the migration
+                validated, m_info_post = verify_residency(model, preferred_device)
+                if validated:
+                    logging.info(f'- Recalling {cls} validated')
+                    if torch.device(preferred_device).type != "cpu":
+                        forget_disk_offload(get_offload_module(model))
+                    RESIDENCY.track(model, module_nbytes(get_offload_module(model)), preferred_device, name=m_info.classname)
                 else:
-
-                    m_info.move_func(torch.device(preferred_device))
-                    logging.info(f'- Recalling {cls} done')
-
-            # Validate the migration
-            m_info_post: ModelInfo = get_model_info(model)
-            if torch.device(m_info_post.device_current) == torch.device(preferred_device):
-                logging.info(f'- Recalling {cls} validated')
-            else:
-                logging.error(f'- Error for {cls}: Could not validate recall, '
-                      f'model is on {torch.device(m_info_post.device_current)} instead of {torch.device(preferred_device)}')
+                    logging.error(f'- Error for {cls}: Could not validate recall, '
+                          f'model is on {m_info_post.device_bytes or torch.device(m_info_post.device_current)} instead of {torch.device(preferred_device)}')
 
         return (kwargs.get("trigger_value"), kwargs.get("model"),)
    
        
 
+class PrefetchRecall:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return RecallModel.INPUT_TYPES()
+
+    @classmethod
+    def VALIDATE_INPUTS(s, **kwargs):
+        return True
+
+    RETURN_TYPES = (any, any)
+    RETURN_NAMES = ("trigger_passthrough", "model_handle")
+    OUTPUT_TOOLTIPS = ("trigger_value, unchanged", "Connect to the main input of a Wait / Wait xN node, which outputs the recalled model. Other nodes receive the handle, not the model.")
+    FUNCTION = "route"
+    CATEGORY = "workflow"
+
+    def route(self, **kwargs):
+        logging.info("Prefetch Recall Model (node)")
+        # the recall runs on the prefetch thread, Wait / WaitMulti output the model once it is done
+        handle = prefetch(lambda: RecallModel().route(**kwargs)[1],
+                          description=f"recall of {type(kwargs.get('model')).__name__}")
+        return (kwargs.get("trigger_value"), handle,)
+
+
+class TransferStats:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {},
+            "optional": {
+                "trigger_value": (any, ),
+                "node": (["all", "offload", "recall"], {"default": "all", "tooltip": "Statistics of the Model Offload or Model Recall nodes only."}),
+                "last": ("INT", {"default": 0, "min": 0, "max": 4096, "tooltip": "Also return the last records of the transfer history (0 = none)."}),
+                "export_path": ("STRING", {"default": "", "tooltip": "Write the whole transfer history to this JSONL file."}),
+            },
+        }
+
+    RETURN_TYPES = ("STRING", any,)
+    RETURN_NAMES = ("stats_json", "trigger_passthrough",)
+    FUNCTION = "get_stats"
+    CATEGORY = "workflow"
+
+    @classmethod
+    def IS_CHANGED(cls, *args, **kwargs):
+        return float("NaN")
+
+    def get_stats(self, trigger_value=None, node="all", last=0, export_path=""):
+        node = None if node == "all" else node
+        stats = {"summary": get_transfer_summary(node)}
+        if last > 0:
+            stats["history"] = get_transfer_history(node, last)
+        if export_path:
+            stats["exported"] = export_transfer_history(export_path)
+        return (json.dumps(stats, indent=2), trigger_value,)
+
+
+def get_offload_module(model):
+    """
+    The torch module holding the weights of a supported model
+    """
+    if type(model) == ModelPatcher or issubclass(type(model), ModelPatcher):
+        return model.model
+    return model
+
+
+def offload_model(model, device="auto", use_staging_buffers=False, target_free_bytes=0, fraction=0.0,
+                  compression="none", lossy_exclude=DEFAULT_LOSSY_EXCLUDE):
+    """
+    Move a model to its offload device (or the given one), returns the device it was moved to.
+    With target_free_bytes or fraction, only the blocks needed to reach them are moved (see partial_offload).
+    With compression, the weights moved to cpu are then compressed (see host_compression).
+    """
+    m_info: ModelInfo = get_model_info(model, sync=True)  # the model may have been moved since the last node
+    cls = m_info.classname
+    #preferred_device = m_info.device_target if m_info.device_target is not None else mm.get_torch_device()
+
+    if device == DISK_DEVICE:
+        offload_model_to_disk(model, m_info)
+        RESIDENCY.track(model, module_nbytes(get_offload_module(model)), "cpu", name=cls, used=False)
+        return DISK_DEVICE
+
+    if device == "auto":
+        offload_device = mm.unet_offload_device() if m_info.device_offload is not None else mm.unet_offload_device()
+    else:
+        # Use the requested device from parameters
+        offload_device = torch.device(device)
+
+    if target_free_bytes > 0 or fraction > 0:
+        names = offload_model_partially(model, m_info, offload_device, target_free_bytes, fraction, use_staging_buffers)
+        if names:
+            compress_offloaded(model, compression, lossy_exclude, prefixes=names)
+        return offload_device
+
+    if m_info.fully_on(offload_device):
+        # nothing to move nor to clean up
+        logging.info(f'- Offload {cls}: already on {torch.device(offload_device)}')
+        compress_offloaded(model, compression, lossy_exclude)
+        RESIDENCY.track(model, module_nbytes(get_offload_module(model)), offload_device, name=cls, used=False)
+        return offload_device
+
+    if m_info.classname == "GGUFModelPatcher":
+        logging.info(f'- For GGUFModelPatcher {cls}, offloading  will move all patches to the offload device {torch.device(offload_device)}')
+        logger.info(f'- Changing the patch_on_device flag to False, overriding the default value from the gguf loader')
+        with timed("eject_model"):
+            model.eject_model()  # eject the unet model to move it
+        with timed("unpatch_model"):
+            model.unpatch_model()  # unpatch to avoid issues
+        move_model(model, m_info, torch.device(offload_device), use_staging_buffers)
+    else:
+        logging.info(f'- Offload {cls}: move from {m_info.device_bytes or torch.device(m_info.device_current)}'
+                     f' to {torch.device(offload_device)}...')
+        move_model(model, m_info, torch.device(offload_device), use_staging_buffers)
+        logging.info(f'- Offload {cls}: done')
+
+    # Validate the migration
+    validated, m_info_post = verify_residency(model, offload_device)
+    if validated:
+        logging.info(f'- Offload {cls}: validated')
+        compress_offloaded(model, compression, lossy_exclude)
+        logging.debug('- Freeing VRAM...')
+        with timed("gc.collect"):
+            gc.collect()
+        with timed("cleanup_models_gc"):
+            mm.cleanup_models_gc()
+        with timed("soft_empty_cache"):
+            mm.soft_empty_cache()
+        logging.debug('- cleanup done')
+        # todo custom cleanup for known models? eg. flux transformer
+        # model_size = mm.module_size(self.transformer)
+        # do migration to offload device
+        # mm.free_memory(model_size, device)
+    else:
+        logging.error(f'- Error for {cls}: Could not validate offloading, '
+                      f'model is on {m_info_post.device_bytes or torch.device(m_info_post.device_current)} instead of {torch.device(offload_device)}')
+    RESIDENCY.track(model, module_nbytes(get_offload_module(model)), m_info_post.device_current, name=cls, used=False)
+    return offload_device
+
+
+def offload_model_partially(model, m_info: ModelInfo, offload_device, target_free_bytes=0, fraction=0.0, use_staging_buffers=False) -> List[str]:
+    """
+    Offload blocks of a model until target_free_bytes are free on its device, or fraction of it is offloaded,
+    returns the names of the blocks moved
+    """
+    cls = m_info.classname
+    module = get_offload_module(model)
+    if not isinstance(module, torch.nn.Module):
+        logging.error(f'- Error for {cls}: partial offload requires a torch module, got {type(module).__name__}')
+        return []
+    # the ledger (device_bytes) names the devices by device_key, e.g. "cuda:0" for a model on torch.device("cuda")
+    source = torch.device(device_key(m_info.device_current))
+    on_source = m_info.device_bytes.get(device_key(source), 0)
+    target_bytes = int(fraction * on_source)
+    if target_free_bytes > 0:
+        free = default_free_bytes(source)
+        target_bytes = max(target_bytes, target_free_bytes - (free or 0))
+    if target_bytes <= 0:
+        logging.info(f'- Offload {cls}: {target_free_bytes / 1024 ** 2:.1f} MiB already free on {source}, nothing to offload')
+        return []
+
+    with timed_move(cls, source, offload_device) as move:
+        names = partial_offload(module, source, offload_device, target_bytes, use_staging_buffers=use_staging_buffers)
+        move["bytes"] = on_source - get_ledger(module).device_bytes().get(device_key(source), 0)
+    _, m_info_post = verify_residency(model, offload_device)
+    moved_bytes = on_source - m_info_post.device_bytes.get(device_key(source), 0)
+    logging.info(f'- Offload {cls}: moved {len(names)} block(s), {moved_bytes / 1024 ** 2:.1f} MiB '
+                 f'from {source} to {torch.device(offload_device)} (target {target_bytes / 1024 ** 2:.1f} MiB)')
+    if moved_bytes < target_bytes:
+        logging.warning(f'- Offload {cls}: not enough blocks to offload to reach the target')
+    if names:
+        with timed("cleanup_models_gc"):
+            mm.cleanup_models_gc()
+        with timed("soft_empty_cache"):
+            mm.soft_empty_cache()
+    RESIDENCY.track(model, m_info_post.device_bytes.get(device_key(source), 0), source, name=cls, used=False)
+    return names
+
+
+def compress_offloaded(model, compression="none", lossy_exclude=DEFAULT_LOSSY_EXCLUDE, prefixes=None) -> dict:
+    """
+    Compress the host weights of an offloaded model (or of its blocks prefixes), see host_compression
+    """
+    module = get_offload_module(model)
+    if compression == "none" or not isinstance(module, torch.nn.Module):
+        return {}
+    with timed("compress"):
+        report = compress_module(module, compression, lossy_exclude, prefixes=prefixes)
+    if report["tensors"]:
+        # the staging buffers would keep the full precision copies allocated, partial offloads keep them per block
+        release_staging_buffers(module)
+        for name in prefixes if prefixes is not None else offloaded_blocks(module):
+            release_staging_buffers(module.get_submodule(name))
+        get_ledger(module).sync()
+        guard_compressed(model)
+        logging.info(f'- Offload {type(model).__name__}: compressed {report["tensors"]} tensor(s) ({compression}), '
+                     f'saved {report["saved_bytes"] / 1024 ** 2:.1f} MiB of host RAM')
+    return report
+
+
+# ModelPatcher methods through which ComfyUI loads a model on its own (outside Model recall)
+_LOAD_METHODS = ("patch_model", "load", "partially_load")
+_GUARD_LOCK = threading.Lock()
+
+
+def restore_compressed(model) -> int:
+    """
+    Restore the compressed weights of a model to their dtype (on the host), returns the number of tensors restored
+    """
+    module = get_offload_module(model)
+    count = 0
+    if isinstance(module, torch.nn.Module) and is_compressed(module):
+        with timed("decompress"):
+            count = decompress_module(module)
+        get_ledger(module).sync()
+        logging.info(f'- {type(model).__name__}: restored {count} compressed tensor(s) to their dtype')
+    return count
+
+
+def _guarded(method):
+    @wraps(method)
+    def guarded(self, *args, **kwargs):
+        # the module is shared by the clones of the patcher (e.g. made by LoRA loaders)
+        if is_compressed(get_offload_module(self)):
+            restore_compressed(self)
+        return method(self, *args, **kwargs)
+    guarded.restores_compressed = True
+    return guarded
+
+
+def guard_compressed(model) -> None:
+    """
+    Make ComfyUI restore the compressed weights of a ModelPatcher before loading it by any other path than Model recall.
+    The load methods of its classes are wrapped once: every patcher sharing a compressed module, clones included, restores
+    it first. Other models cannot be guarded, they must go through Model recall.
+    """
+    if not (type(model) == ModelPatcher or issubclass(type(model), ModelPatcher)):
+        return
+    with _GUARD_LOCK:
+        for cls in type(model).__mro__:
+            for name in _LOAD_METHODS:
+                method = cls.__dict__.get(name)
+                if callable(method) and not getattr(method, "restores_compressed", False):
+                    setattr(cls, name, _guarded(method))
+
+
+def plan_recall(model, device="auto") -> EvictionPlan:
+    """
+    Dry run of auto_evict: the models to offload for model to fit on the device
+    """
+    if device == "auto":
+        device = get_recall_device(get_model_info(model), device)
+    return RESIDENCY.plan(model, module_nbytes(get_offload_module(model)), device)
+
+
+def move_model(model, m_info: ModelInfo, device, use_staging_buffers=False) -> None:
+    """
+    Move a model to a device with its move function, or through the staging buffers of its torch module
+    """
+    module = get_offload_module(model)
+    nbytes = sum(m_info.device_bytes.values()) - m_info.device_bytes.get(device_key(device), 0)
+    with timed_move(m_info.classname, m_info.device_bytes or m_info.device_current, device, nbytes):
+        if use_staging_buffers and isinstance(module, torch.nn.Module):
+            move_module(module, device)
+        else:
+            m_info.move_func(device)
+    if isinstance(module, torch.nn.Module):
+        get_ledger(module).record_move(device)
+
+
+def verify_residency(model, device) -> Tuple[bool, ModelInfo]:
+    """
+    Compare the bytes per device recorded by the moves to the actual ones,
+    returns True if the model is fully on device, and its updated info
+    """
+    module = get_offload_module(model)
+    with timed("verify"):
+        if isinstance(module, torch.nn.Module):
+            for ledger_device, (recorded, actual) in get_ledger(module).verify().items():
+                logging.warning(f'- {type(model).__name__}: {actual / 1024 ** 2:.1f} MiB on {ledger_device}, '
+                                f'{recorded / 1024 ** 2:.1f} MiB expected after the move')
+        m_info_post: ModelInfo = get_model_info(model)
+    return m_info_post.fully_on(device), m_info_post
+
+
+def get_recall_device(m_info: ModelInfo, device="auto"):
+    if device == "auto":
+        return m_info.device_target if m_info.device_target is not None else mm.get_torch_device()
+    # Use the requested device from parameters
+    return torch.device(device)
+
+
+def offload_model_to_disk(model, m_info: ModelInfo) -> None:
+    """
+    Offload the weights of a model to a memory-mapped file (see disk_offload)
+    """
+    cls = m_info.classname
+    if type(model) == ModelPatcher or issubclass(type(model), ModelPatcher):
+        # the unpatched weights are stored, patches are reapplied on recall
+        with timed("eject_model"):
+            model.eject_model()
+        with timed("unpatch_model"):
+            model.unpatch_model()
+    module = get_offload_module(model)
+    if not isinstance(module, torch.nn.Module):
+        logging.error(f'- Error for {cls}: disk offload requires a torch module, got {type(module).__name__}')
+        return
+
+    logging.info(f'- Offload {cls}: move from {torch.device(m_info.device_current)} to {DISK_DEVICE}...')
+    with timed_move(cls, m_info.device_bytes or m_info.device_current, DISK_DEVICE, module_nbytes(module)):
+        path = offload_to_disk(module)
+    if get_model_info(model).on_disk:
+        logging.info(f'- Offload {cls}: validated, weights memory-mapped from {path}')
+        with timed("gc.collect"):
+            gc.collect()
+        with timed("cleanup_models_gc"):
+            mm.cleanup_models_gc()
+        with timed("soft_empty_cache"):
+            mm.soft_empty_cache()
+    else:
+        logging.error(f'- Error for {cls}: Could not validate offloading to {DISK_DEVICE}')
+
+
 def is_supported(model_candidate, on_error: str = "raise") -> Tuple[bool, str]:
     """
     Return true if the model is known to be unsupported/problematic
     """
     # Eclude unsupported models first
-    for nested_obj, class_name, err_msg in UNSUPPORTED_CHK:
+    for nested_obj, class_name, err_msg in get_unsupported_checks():
         # Check for unsupported models
         if get_nested_class_name(obj=model_candidate, path=nested_obj) == class_name:
             err_str = f"Unsupported {model_candidate.__class__.__name__} model.\n {err_msg}"
@@ -251,7 +646,7 @@ def is_supported(model_candidate, on_error: str = "raise") -> Tuple[bool, str]:
     elif hasattr(model_candidate, 'device') and hasattr(model_candidate, 'to'):
         logging.info(f"- Model of type {model_candidate.__class__.__name__} supported (contains 'model.device' and 'model.to()')")
         return True, ''  
-    elif NUNCHAKU_AVAILABLE and issubclass(type(model_candidate), NunchakuFluxTransformer2dModel):
+    elif get_nunchaku_class() is not None and issubclass(type(model_candidate), get_nunchaku_class()):
         logging.info(f"- model of type {model_candidate.__class__.__name__}, a subclass of ModelPatcher, it might not be supported for Offload/recall")
         return True, ''  
     
@@ -279,6 +674,15 @@ def scan_for_models(top_model: object) -> List[object]:
         return []
     
 
+def register_patchers(model_candidate) -> None:
+    """
+    Track the model patchers seen by the nodes (weak references) for the dangling clones report
+    """
+    for model in scan_for_models(top_model=model_candidate):
+        if type(model) == ModelPatcher or issubclass(type(model), ModelPatcher):
+            register_patcher(model)
+
+
 def get_nested_class_name(obj, path):
     for attr in path:
         obj = getattr(obj, attr, None)
@@ -287,25 +691,31 @@ def get_nested_class_name(obj, path):
     return getattr(obj.__class__, '__name__', None)
 
 
-def get_model_info(model) -> ModelInfo:
+def get_model_info(model, sync=False) -> ModelInfo:
     """
     Get info about the model and its devices
     Args:
         model: The model to check.
+        sync: rescan the devices of all the weights instead of relying on the residency ledger
     Returns:
-        ModelInfo: info summary about the devices
+        ModelInfo: info summary about the devices (device_current: device holding most of the weights)
 
     """
     
     if type(model) == ModelPatcher or issubclass(type(model), ModelPatcher):
         # model patcher
+        ledger = get_ledger(model.model, sync=sync)
         mp_info = ModelInfo(classname=type(model).__name__,
-                       device_current=next(model.model.parameters()).device,
+                       device_current=ledger.main_device() or next(model.model.parameters()).device,
                        device_target=model.load_device,
                        device_offload=model.offload_device if hasattr(model, 'offload_device') else None,
-                       move_func=model.model.to)
+                       move_func=model.model.to,
+                       on_disk=is_disk_offloaded(model.model),
+                       device_bytes=ledger.device_bytes(),
+                       offloaded_blocks=offloaded_blocks(model.model),
+                       compressed=is_compressed(model.model))
         return mp_info
-    elif NUNCHAKU_AVAILABLE and type(model) == NunchakuFluxTransformer2dModel:
+    elif get_nunchaku_class() is not None and type(model) == get_nunchaku_class():
         # model patcher
         mp_info = ModelInfo(classname=type(model).__name__,
                        device_current=next(model.model.parameters()).device,
@@ -318,7 +728,11 @@ def get_model_info(model) -> ModelInfo:
                        device_current=model.device,
                        device_target=None,
                        device_offload=model.offload_device if hasattr(model, 'offload_device') else None,
-                       move_func=model.to)
+                       move_func=model.to,
+                       on_disk=is_disk_offloaded(model),
+                       device_bytes=get_ledger(model, sync=sync).device_bytes() if isinstance(model, torch.nn.Module) else {},
+                       offloaded_blocks=offloaded_blocks(model),
+                       compressed=is_compressed(model))
         return m_info
     
 
@@ -326,6 +740,7 @@ def check_gc_for_dangling_clones(classname_to_check = "GGUFModelPatcher") -> Non
     """
     Check for dangling clones in the garbage collector.
     This is useful to identify models that may not have been properly offloaded.
+    Walks the whole heap, only run on demand (RecallModel debug_leak_scan), see patcher_registry otherwise.
     """
     # --- START DEBUGGING CODE ---
     logging.info(f"Checking garbage collector for dangling clones of type {classname_to_check}...")
@@ -0,0 +1,100 @@
+import weakref
+import logging
+from typing import Dict, List
+import torch
+from .staging_buffers import move_module
+from .device_ledger import get_ledger
+from .residency import device_key
+
+# Partial offload: only some blocks of a model are moved to the offload device, enough to free a number of bytes.
+# Candidate blocks are the children of the outermost ModuleLists of the model (e.g. the transformer blocks), or of the
+# model itself if it has none, taken from the last one backwards so that the first blocks of the forward pass stay on
+# the device.
+# The blocks moved are remembered per module so that a recall brings back exactly those.
+
+logger = logging.getLogger(__name__)
+
+_OFFLOADED_BLOCKS = weakref.WeakKeyDictionary()  # module -> {block name: device it was moved from}
+
+
+def _nbytes(module: torch.nn.Module, device=None) -> int:
+    # devices are compared by device_key: torch.device("cuda") != torch.device("cuda:0"), the device of the tensors
+    device = device_key(device) if device is not None else None
+    total = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        if device is None or device_key(tensor.device) == device:
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def offload_blocks(module: torch.nn.Module) -> List[str]:
+    '''
+    Names of the candidate blocks of a module, in forward order: children of ModuleLists not nested in another one
+    '''
+    blocks = []
+    lists = []
+    for name, child in module.named_modules():
+        if isinstance(child, torch.nn.ModuleList) and not any(name.startswith(prefix + ".") for prefix in lists):
+            lists.append(name)
+            blocks.extend(f"{name}.{index}" if name else index for index, _ in child.named_children())
+    if not blocks:
+        blocks = [name for name, _ in module.named_children()]
+    return blocks
+
+
+def plan_partial_offload(module: torch.nn.Module, device, target_bytes: int) -> List[str]:
+    '''
+    Blocks to move off device to free at least target_bytes, last blocks first
+    '''
+    planned = []
+    freed = 0
+    for name in reversed(offload_blocks(module)):
+        if freed >= target_bytes:
+            break
+        nbytes = _nbytes(module.get_submodule(name), device)
+        if nbytes == 0:
+            # already offloaded or without weights
+            continue
+        planned.append(name)
+        freed += nbytes
+    return planned
+
+
+def partial_offload(module: torch.nn.Module, source, offload_device, target_bytes: int, use_staging_buffers=False) -> List[str]:
+    '''
+    Move blocks of module from source to offload_device until target_bytes are freed on source.
+    Returns the names of the blocks moved.
+    '''
+    if device_key(source) == device_key(offload_device):
+        return []
+    source = torch.device(device_key(source))
+    offload_device = torch.device(offload_device)
+    moved = _OFFLOADED_BLOCKS.setdefault(module, {})
+    names = plan_partial_offload(module, source, target_bytes)
+    for name in names:
+        move_module(module.get_submodule(name), offload_device, use_staging_buffers=use_staging_buffers)
+        get_ledger(module).record_move(offload_device, prefix=name)
+        moved.setdefault(name, str(source))
+    return names
+
+
+def offloaded_blocks(module) -> Dict[str, str]:
+    '''
+    Blocks of module moved by a partial offload, with the device they were moved from
+    '''
+    try:
+        return dict(_OFFLOADED_BLOCKS.get(module, {}))
+    except TypeError:
+        return {}
+
+
+def recall_partial(module: torch.nn.Module, device=None, use_staging_buffers=False) -> List[str]:
+    '''
+    Move back the blocks of a partial offload, to device or to the device they came from
+    '''
+    moved = _OFFLOADED_BLOCKS.pop(module, {})
+    for name, source in moved.items():
+        block_device = torch.device(device if device is not None else source)
+        move_module(module.get_submodule(name), block_device, use_staging_buffers=use_staging_buffers)
+        get_ledger(module).record_move(block_device, prefix=name)
+    return list(moved)
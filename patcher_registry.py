@@ -0,0 +1,77 @@
+import time
+import weakref
+import logging
+import threading
+from collections import defaultdict
+
+# Registry of the model patchers (ModelPatcher, GGUFModelPatcher, ...) seen by the offload/recall nodes.
+# Patchers are held by weak references and dropped by a finalizer when garbage collected, so that reporting the live
+# ones costs O(live patchers) instead of a scan of the whole heap (see check_gc_for_dangling_clones for the latter).
+
+logger = logging.getLogger(__name__)
+
+
+class PatcherRegistry:
+    def __init__(self):
+        self._patchers = {}  # id(patcher) -> (weak reference, class name, registration time)
+        self._lock = threading.RLock()  # the finalizer (_unregister) can run during a collection inside register
+
+    def register(self, patcher):
+        key = id(patcher)
+        with self._lock:
+            entry = self._patchers.get(key)
+            if entry is not None and entry[0]() is patcher:
+                return
+            try:
+                ref = weakref.ref(patcher)
+            except TypeError:
+                # not weak-referenceable, it cannot be tracked without keeping it alive
+                return
+            self._patchers[key] = (ref, type(patcher).__name__, time.time())
+        weakref.finalize(patcher, self._unregister, key, ref)
+
+    def _unregister(self, key, ref):
+        with self._lock:
+            entry = self._patchers.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._patchers[key]
+
+    def live(self, classname=None) -> list:
+        with self._lock:
+            entries = list(self._patchers.values())
+        patchers = [ref() for ref, name, _ in entries if classname is None or name == classname]
+        return [patcher for patcher in patchers if patcher is not None]
+
+    def leak_report(self, classname=None) -> dict:
+        '''
+        Live patchers per class, and the groups of patchers sharing the same model (clones)
+        '''
+        by_class = defaultdict(int)
+        by_model = defaultdict(list)
+        for patcher in self.live(classname):
+            by_class[type(patcher).__name__] += 1
+            model = getattr(patcher, "model", None)
+            if model is not None:
+                by_model[id(model)].append(patcher)
+        clones = [[f"{type(p).__name__}@{id(p):x}" for p in group] for group in by_model.values() if len(group) > 1]
+        return {"live": dict(by_class), "clones": clones}
+
+
+PATCHER_REGISTRY = PatcherRegistry()
+
+
+def register_patcher(patcher):
+    PATCHER_REGISTRY.register(patcher)
+
+
+def report_dangling_clones(classname_to_check="GGUFModelPatcher") -> dict:
+    '''
+    Log the live patchers of a class seen by the offload nodes, warns if there are several
+    '''
+    report = PATCHER_REGISTRY.leak_report(classname_to_check)
+    count = report["live"].get(classname_to_check, 0)
+    logger.info(f"Found {count} live {classname_to_check} instances seen by the offload/recall nodes.")
+    if count > 1:
+        logger.warning(f"Potential leak! Expected 1 {classname_to_check}, found {count}. "
+                       f"Clones sharing a model: {report['clones']}. Enable debug_leak_scan to list their referrers.")
+    return report
@@ -0,0 +1,65 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# Background prefetch: PrefetchRecall and PrefetchCache start a recall or a cache read on a thread as soon as their
+# inputs are known and output a PrefetchHandle instead of the value. Wait / WaitMulti block on a handle only when they
+# execute, meanwhile the nodes of independent branches (e.g. text encoding) run.
+PREFETCH_THREADS = int(os.environ.get("BETTER_FLOW_PREFETCH_THREADS", "2"))
+
+logger = logging.getLogger(__name__)
+
+_PREFETCH_POOL = None
+_PREFETCH_POOL_LOCK = threading.Lock()
+
+
+def _get_prefetch_pool() -> ThreadPoolExecutor:
+    global _PREFETCH_POOL
+    with _PREFETCH_POOL_LOCK:
+        if _PREFETCH_POOL is None:
+            _PREFETCH_POOL = ThreadPoolExecutor(max_workers=max(1, PREFETCH_THREADS), thread_name_prefix="prefetch")
+    return _PREFETCH_POOL
+
+
+class PrefetchHandle:
+    '''
+    Value computed in the background, result() blocks until it is available (and raises its error, if any)
+    '''
+
+    def __init__(self, future: Future, description: str):
+        self._future = future
+        self.description = description
+        self.submitted = time.perf_counter()
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def result(self, timeout=None):
+        if not self._future.done():
+            start = time.perf_counter()
+            logger.info(f"- Prefetch: waiting for {self.description}...")
+            value = self._future.result(timeout)
+            logger.info(f"- Prefetch: {self.description} ready after waiting {time.perf_counter() - start:.3f} s")
+            return value
+        return self._future.result()
+
+    def __repr__(self):
+        return f"PrefetchHandle({self.description}, {'done' if self.done() else 'pending'})"
+
+
+def prefetch(fn, *args, description: str = None, **kwargs) -> PrefetchHandle:
+    '''
+    Run fn(*args, **kwargs) on the prefetch pool
+    '''
+    return PrefetchHandle(_get_prefetch_pool().submit(fn, *args, **kwargs), description or getattr(fn, "__name__", "prefetch"))
+
+
+def resolve(value):
+    '''
+    The value of a PrefetchHandle (waiting for it), any other value unchanged
+    '''
+    if isinstance(value, PrefetchHandle):
+        return value.result()
+    return value
@@ -0,0 +1,150 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+import torch
+import numpy as np
+
+# Process-wide in-memory tier in front of the CacheAny files.
+# The budget can be set with the environment variable BETTER_FLOW_RAM_CACHE_MB (0 disables the tier)
+RAM_CACHE_BUDGET_MB = int(os.environ.get("BETTER_FLOW_RAM_CACHE_MB", "2048"))
+
+
+def estimate_size(obj, _seen=None) -> int:
+    '''
+    Estimate the memory held by obj in bytes.
+    Tensors and numpy arrays are accounted from their data size, containers are walked recursively.
+    '''
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.numel()
+    elif isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(k, _seen) + estimate_size(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum(estimate_size(item, _seen) for item in obj)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        return sys.getsizeof(obj) + estimate_size(vars(obj), _seen)
+    return sys.getsizeof(obj)
+
+
+def host_copy(obj, _memo=None):
+    '''
+    Copy of obj whose tensors and numpy arrays are independent host (cpu) copies. Containers are copied, other
+    objects are shared. Values of the RAM tier are stored and returned as such copies, so that a node modifying a value
+    in place does not change the cached one, and device tensors are held in host memory.
+    '''
+    if _memo is None:
+        _memo = {}
+    if id(obj) in _memo:
+        return _memo[id(obj)]
+    if isinstance(obj, torch.Tensor):
+        copy = obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, np.ndarray):
+        copy = obj.copy()
+    elif isinstance(obj, dict):
+        copy = {host_copy(k, _memo): host_copy(v, _memo) for k, v in obj.items()}
+        if type(obj) is not dict:
+            try:
+                copy = type(obj)(copy)
+            except TypeError:
+                pass
+    elif isinstance(obj, list):
+        copy = [host_copy(item, _memo) for item in obj]
+    elif isinstance(obj, tuple):
+        items = [host_copy(item, _memo) for item in obj]
+        copy = type(obj)(*items) if hasattr(obj, "_fields") else tuple(items)
+    else:
+        return obj
+    _memo[id(obj)] = copy
+    return copy
+
+
+class RamCache:
+    '''
+    LRU cache of objects with a byte budget.
+    Keys are the cache file paths (cache_name+hash), the files on disk stay the persistent backing store.
+    Values are stored and returned as host copies (see host_copy).
+    '''
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Returns (True, copy of the value) on a hit, (False, None) otherwise
+        '''
+        key = str(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            self._entries.move_to_end(key)
+        return True, host_copy(entry[0])
+
+    def put(self, key, value, nbytes=None) -> bool:
+        '''
+        Store a value, evicting the least recently used entries to stay within the budget.
+        Returns False if the value does not fit in the budget.
+        '''
+        key = str(key)
+        if nbytes is None:
+            # size of the host copy: device tensors are counted as they will be copied to the host
+            nbytes = estimate_size(value)
+        if nbytes > self.budget_bytes:
+            self.discard(key)
+            return False
+        value = host_copy(value)
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, nbytes)
+            self.used_bytes += nbytes
+            self._evict()
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._pop(str(key))
+
+    def set_budget(self, budget_bytes: int):
+        with self._lock:
+            self.budget_bytes = budget_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.used_bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return str(key) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.used_bytes -= entry[1]
+
+    def _evict(self):
+        while self.used_bytes > self.budget_bytes and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.used_bytes -= nbytes
+
+
+RAM_CACHE = RamCache(budget_bytes=RAM_CACHE_BUDGET_MB * 1024 * 1024)
+
+
+def set_ram_cache_budget(budget_mb: int):
+    RAM_CACHE.set_budget(int(budget_mb) * 1024 * 1024)
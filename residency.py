@@ -0,0 +1,192 @@
+import time
+import weakref
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+import torch
+
+# Residency of the models passing through OffloadModel / RecallModel: size, device and last use of each model.
+# Before a model is recalled to a device, the least recently used models on that device are planned for eviction
+# until the recalled model fits in the budget of the device (or its free memory when no budget is set).
+# Budgets and free memory can be given explicitly, the manager then runs without any device (e.g. on CPU).
+
+logger = logging.getLogger(__name__)
+
+
+def device_key(device) -> str:
+    '''
+    Name of a device with its index ("cuda" -> "cuda:0"), as reported by the tensors on it
+    '''
+    device = torch.device(device)
+    if device.index is None and device.type not in ("cpu", "meta"):
+        index = torch.cuda.current_device() if device.type == "cuda" and torch.cuda.is_available() else 0
+        device = torch.device(device.type, index)
+    return str(device)
+
+
+def default_free_bytes(device: str) -> Optional[int]:
+    '''
+    Free memory of a cuda device, None (unlimited) for other devices
+    '''
+    device = torch.device(device)
+    if device.type == "cuda" and torch.cuda.is_available():
+        return torch.cuda.mem_get_info(device)[0]
+    return None
+
+
+@dataclass
+class ResidentModel:
+    name: str
+    nbytes: int
+    device: str
+    last_use: float
+    ref: weakref.ref = field(repr=False)
+
+    def as_dict(self) -> dict:
+        return {"name": self.name, "nbytes": self.nbytes, "device": self.device, "last_use": self.last_use}
+
+
+@dataclass
+class EvictionPlan:
+    device: str
+    required_bytes: int  # bytes of the requested model that are not on the device yet
+    free_bytes: Optional[int]  # before eviction, None if unlimited
+    evict: List[ResidentModel]  # least recently used first
+    fits: bool  # True if the requested model fits once the planned models are evicted
+
+    def as_dict(self) -> dict:
+        return {"device": self.device, "required_bytes": self.required_bytes, "free_bytes": self.free_bytes,
+                "evict": [resident.as_dict() for resident in self.evict], "fits": self.fits}
+
+
+class ResidencyManager:
+    '''
+    Tracks the models seen by the offload/recall nodes and plans least recently used evictions.
+    budgets: bytes usable by the tracked models on each device (e.g. {"cuda:0": 8 << 30})
+    free_bytes_fn: free memory of a device without budget, None meaning unlimited
+    '''
+
+    def __init__(self, budgets: Dict[str, int] = None, free_bytes_fn: Callable = default_free_bytes, clock=time.monotonic):
+        self.budgets = {device_key(device): nbytes for device, nbytes in (budgets or {}).items()}
+        self.free_bytes_fn = free_bytes_fn
+        self.clock = clock
+        self._models = {}  # id(model) -> ResidentModel
+        self._lock = threading.RLock()
+
+    def set_budget(self, device, nbytes: Optional[int]):
+        with self._lock:
+            if nbytes is None:
+                self.budgets.pop(device_key(device), None)
+            else:
+                self.budgets[device_key(device)] = nbytes
+
+    def track(self, model, nbytes: int, device, name: str = None, used=True):
+        '''
+        Record that model (nbytes) is on device, used=False keeps its last use (e.g. when it is offloaded)
+        '''
+        with self._lock:
+            key = id(model)
+            previous = self._models.get(key)
+            if previous is not None and previous.ref() is not model:
+                previous = None
+            last_use = self.clock() if used or previous is None else previous.last_use
+            self._models[key] = ResidentModel(name=name or type(model).__name__, nbytes=nbytes,
+                                              device=device_key(device), last_use=last_use,
+                                              ref=weakref.ref(model, lambda ref, key=key: self._discard(key, ref)))
+
+    def update_device(self, model, device):
+        # the model moved without being used (e.g. evicted)
+        with self._lock:
+            resident = self._models.get(id(model))
+            if resident is not None:
+                resident.device = device_key(device)
+
+    def forget(self, model):
+        with self._lock:
+            self._models.pop(id(model), None)
+
+    def _discard(self, key, ref):
+        # the model was garbage collected, unless its id was reused by a newer model
+        with self._lock:
+            resident = self._models.get(key)
+            if resident is not None and resident.ref is ref:
+                del self._models[key]
+
+    def residents(self, device=None) -> List[ResidentModel]:
+        with self._lock:
+            residents = [r for r in self._models.values() if r.ref() is not None]
+        if device is not None:
+            residents = [r for r in residents if r.device == device_key(device)]
+        return sorted(residents, key=lambda r: r.last_use)
+
+    def used_bytes(self, device) -> int:
+        return sum(r.nbytes for r in self.residents(device))
+
+    def free_bytes(self, device, exclude=None) -> Optional[int]:
+        '''
+        Free bytes of a device for the tracked models, None if unlimited
+        '''
+        device = device_key(device)
+        budget = self.budgets.get(device)
+        if budget is None:
+            return self.free_bytes_fn(device) if self.free_bytes_fn is not None else None
+        used = sum(r.nbytes for r in self.residents(device) if exclude is None or r.ref() is not exclude)
+        return budget - used
+
+    def plan(self, model, nbytes: int, device) -> EvictionPlan:
+        '''
+        Dry run: the models to evict from device, least recently used first, for model (nbytes) to fit
+        '''
+        device = device_key(device)
+        with self._lock:
+            current = self._models.get(id(model))
+            required = 0 if current is not None and current.device == device else nbytes
+            free = self.free_bytes(device, exclude=model)
+            evict = []
+            if free is not None:
+                available = free
+                for resident in self.residents(device):
+                    if available >= required:
+                        break
+                    if resident.ref() is model:
+                        continue
+                    evict.append(resident)
+                    available += resident.nbytes
+                fits = available >= required
+            else:
+                fits = True
+            return EvictionPlan(device=device, required_bytes=required, free_bytes=free, evict=evict, fits=fits)
+
+    def apply(self, plan: EvictionPlan, evict_fn: Callable) -> List[str]:
+        '''
+        Evict the models of a plan with evict_fn(model) -> device it was moved to, returns their names
+        '''
+        evicted = []
+        for resident in plan.evict:
+            model = resident.ref()
+            if model is None:
+                continue
+            logger.info(f'- Residency: evicting {resident.name} ({resident.nbytes / 1024 ** 2:.1f} MiB) from {plan.device}')
+            new_device = evict_fn(model)
+            if new_device is not None:
+                self.update_device(model, new_device)
+            evicted.append(resident.name)
+        return evicted
+
+    def summary(self) -> dict:
+        residents = self.residents()
+        devices = sorted({r.device for r in residents} | set(self.budgets))
+        return {device: {"budget_bytes": self.budgets.get(device), "used_bytes": self.used_bytes(device),
+                         "models": [r.as_dict() for r in residents if r.device == device]}
+                for device in devices}
+
+
+RESIDENCY = ResidencyManager()
+
+
+def module_nbytes(module) -> int:
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    return sum(t.numel() * t.element_size() for t in module.parameters()) + \
+        sum(t.numel() * t.element_size() for t in module.buffers())
@@ -0,0 +1,118 @@
+import os
+import weakref
+import logging
+import threading
+import torch
+from .disk_offload import _named_tensors
+from .residency import device_key
+
+# Persistent host buffers for the models cycled between a device and the host by OffloadModel / RecallModel.
+# Offloading copies each parameter and buffer into a host buffer kept for its module (pinned when cuda is available),
+# recalling copies it back to the device and keeps the host buffer for the next offload:
+# after the first cycle, offloading the same model allocates no host memory.
+# The total size of the buffers is capped by BETTER_FLOW_STAGING_BUFFER_MB, tensors over the cap are moved normally.
+STAGING_BUFFER_BUDGET_MB = int(os.environ.get("BETTER_FLOW_STAGING_BUFFER_MB", "8192"))
+
+logger = logging.getLogger(__name__)
+
+
+class _ModuleBuffers:
+    def __init__(self):
+        self.buffers = {}  # name -> host tensor
+        self.nbytes = 0
+
+
+class StagingBufferPool:
+    '''
+    Host buffers of each module, keyed by the name, shape and dtype of its tensors.
+    Buffers are dropped with their module or by release().
+    '''
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._modules = weakref.WeakKeyDictionary()  # module -> _ModuleBuffers
+        self._lock = threading.Lock()
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(module_buffers.nbytes for module_buffers in self._modules.values())
+
+    def get(self, module, name, like: torch.Tensor):
+        '''
+        Host buffer for the tensor name of module, allocated on first use. None if it would exceed the budget.
+        '''
+        with self._lock:
+            module_buffers = self._modules.setdefault(module, _ModuleBuffers())
+            buffer = module_buffers.buffers.get(name)
+            if buffer is not None and buffer.shape == like.shape and buffer.dtype == like.dtype:
+                return buffer
+            if buffer is not None:
+                # the tensor changed shape or dtype, its buffer is replaced
+                del module_buffers.buffers[name]
+                module_buffers.nbytes -= buffer.numel() * buffer.element_size()
+            nbytes = like.numel() * like.element_size()
+            total = sum(other.nbytes for other in self._modules.values())
+            if total + nbytes > self.budget_bytes:
+                return None
+            buffer = torch.empty(like.shape, dtype=like.dtype, pin_memory=torch.cuda.is_available())
+            module_buffers.buffers[name] = buffer
+            module_buffers.nbytes += nbytes
+            return buffer
+
+    def release(self, module=None) -> int:
+        '''
+        Drop the buffers of module (all modules if None), returns the number of bytes released.
+        Buffers holding the weights of an offloaded module are freed when it is recalled.
+        '''
+        with self._lock:
+            if module is None:
+                released = sum(module_buffers.nbytes for module_buffers in self._modules.values())
+                self._modules.clear()
+                return released
+            module_buffers = self._modules.pop(module, None)
+            return module_buffers.nbytes if module_buffers is not None else 0
+
+    def set_budget(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+
+
+STAGING_BUFFERS = StagingBufferPool(STAGING_BUFFER_BUDGET_MB * 1024 * 1024)
+
+
+def release_staging_buffers(module=None) -> int:
+    return STAGING_BUFFERS.release(module)
+
+
+def set_staging_buffer_budget(mb: int):
+    STAGING_BUFFERS.set_budget(mb * 1024 * 1024)
+
+
+def move_module(module: torch.nn.Module, device, use_staging_buffers=True) -> None:
+    '''
+    Move the parameters and buffers of module to device.
+    With staging buffers, device tensors moved to the host are copied into the persistent buffers of the module.
+    '''
+    device = torch.device(device)
+    if not use_staging_buffers:
+        module.to(device)
+        return
+
+    target = device_key(device)
+    copied_to_host = False
+    for name, tensor in _named_tensors(module):
+        if device_key(tensor.device) == target:
+            continue
+        if device.type == "cpu":
+            buffer = STAGING_BUFFERS.get(module, name, tensor)
+            if buffer is None:
+                tensor.data = tensor.data.to(device)
+            else:
+                buffer.copy_(tensor.data, non_blocking=buffer.is_pinned())
+                tensor.data = buffer
+                copied_to_host = True
+        else:
+            # the host buffer stays in the pool for the next offload
+            tensor.data = tensor.data.to(device, non_blocking=True)
+    if copied_to_host and torch.cuda.is_available():
+        # the asynchronous copies must complete before the host buffers are read
+        torch.cuda.synchronize()
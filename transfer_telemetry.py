@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import List
+import torch
+
+# Telemetry of the Offload/Recall nodes: one record per node execution, with the wall time of each step of the cycle
+# (eject_model, unpatch_model, move, patch_model, gc.collect, cleanup_models_gc, soft_empty_cache, ...) and each model
+# moved (bytes, seconds, GB/s). Records are kept in a rolling history, optionally appended to a JSONL file
+# (BETTER_FLOW_TRANSFER_LOG) as they complete.
+# Moves of models evicted by a recall belong to the record of that recall.
+
+logger = logging.getLogger(__name__)
+
+TRANSFER_HISTORY_SIZE = int(os.environ.get("BETTER_FLOW_TRANSFER_HISTORY", "256"))
+TRANSFER_LOG_PATH = os.environ.get("BETTER_FLOW_TRANSFER_LOG", "")
+
+
+class TransferRecord:
+    def __init__(self, node: str):
+        self.node = node
+        self.timestamp = time.time()
+        self.wall_s = 0.0
+        self.steps = defaultdict(float)  # step -> seconds
+        self.moves = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] += time.perf_counter() - start
+
+    def add_move(self, model: str, source, target, nbytes: int, seconds: float):
+        self.moves.append({"model": model, "source": str(source), "target": str(target), "bytes": nbytes,
+                           "seconds": seconds, "gbps": _gbps(nbytes, seconds)})
+
+    def close(self):
+        self.wall_s = time.perf_counter() - self._start
+
+    def as_dict(self) -> dict:
+        nbytes = sum(move["bytes"] for move in self.moves)
+        move_s = sum(move["seconds"] for move in self.moves)
+        return {"node": self.node, "timestamp": self.timestamp, "wall_s": self.wall_s, "steps": dict(self.steps),
+                "moves": list(self.moves), "bytes": nbytes, "gbps": _gbps(nbytes, move_s)}
+
+
+def _gbps(nbytes: int, seconds: float) -> float:
+    return nbytes / seconds / 1e9 if seconds > 0 else 0.0
+
+
+def _synchronize(*devices):
+    # copies to or from a cuda device are asynchronous, wait for them to time the transfer itself
+    if any(str(device).startswith("cuda") for device in devices) and torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+class TransferTelemetry:
+    def __init__(self, history_size: int = TRANSFER_HISTORY_SIZE, log_path: str = TRANSFER_LOG_PATH):
+        self._history = deque(maxlen=history_size)
+        self._lock = threading.Lock()
+        self._active = threading.local()
+        self.log_path = log_path
+
+    @property
+    def active(self):
+        return getattr(self._active, "record", None)
+
+    @contextmanager
+    def transfer(self, node: str):
+        '''
+        Record the enclosed node execution, nested transfers (e.g. evictions) are merged into the outer one
+        '''
+        if self.active is not None:
+            yield self.active
+            return
+        record = TransferRecord(node)
+        self._active.record = record
+        try:
+            yield record
+        finally:
+            self._active.record = None
+            record.close()
+            self._add(record.as_dict())
+
+    def _add(self, record: dict):
+        with self._lock:
+            self._history.append(record)
+        if self.log_path:
+            try:
+                with open(self.log_path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                logger.warning(f"Could not append the transfer record to {self.log_path}: {e}")
+        logger.debug(f"Transfer {record['node']}: {record['wall_s']:.3f} s, {record['bytes'] / 1024 ** 2:.1f} MiB "
+                     f"at {record['gbps']:.2f} GB/s, steps {record['steps']}")
+
+    def history(self, node: str = None, last: int = None) -> List[dict]:
+        with self._lock:
+            records = [record for record in self._history if node is None or record["node"] == node]
+        return records[-last:] if last else records
+
+    def summary(self, node: str = None) -> dict:
+        '''
+        Per node: executions, bytes moved, effective GB/s and the time of each step, the dominant one first
+        '''
+        summary = {}
+        by_node = defaultdict(list)
+        for record in self.history(node):
+            by_node[record["node"]].append(record)
+        for name, records in by_node.items():
+            wall_s = sum(record["wall_s"] for record in records)
+            steps = defaultdict(lambda: {"count": 0, "total_s": 0.0, "max_s": 0.0})
+            for record in records:
+                for step, seconds in record["steps"].items():
+                    steps[step]["count"] += 1
+                    steps[step]["total_s"] += seconds
+                    steps[step]["max_s"] = max(steps[step]["max_s"], seconds)
+            for timing in steps.values():
+                timing["share"] = timing["total_s"] / wall_s if wall_s > 0 else 0.0
+            moves = [move for record in records for move in record["moves"]]
+            nbytes = sum(move["bytes"] for move in moves)
+            summary[name] = {"count": len(records), "wall_s": wall_s, "bytes": nbytes, "moves": len(moves),
+                             "gbps": _gbps(nbytes, sum(move["seconds"] for move in moves)),
+                             "steps": dict(sorted(steps.items(), key=lambda item: -item[1]["total_s"]))}
+        return summary
+
+    def export_jsonl(self, path) -> int:
+        '''
+        Write the history to path, one record per line, returns the number of records
+        '''
+        records = self.history()
+        with open(path, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        return len(records)
+
+    def reset(self):
+        with self._lock:
+            self._history.clear()
+
+
+TRANSFER_TELEMETRY = TransferTelemetry()
+
+
+def transfer(node: str):
+    return TRANSFER_TELEMETRY.transfer(node)
+
+
+@contextmanager
+def timed(step: str):
+    '''
+    Time the enclosed block as step of the active transfer, if any
+    '''
+    record = TRANSFER_TELEMETRY.active
+    if record is None:
+        yield
+        return
+    with record.step(step):
+        yield
+
+
+@contextmanager
+def timed_move(model: str, source, target, nbytes: int = 0):
+    '''
+    Time the enclosed move as the "move" step of the active transfer, and record its throughput.
+    Yields a dict whose "bytes" (nbytes) can be updated when the bytes moved are only known afterwards.
+    '''
+    move = {"bytes": nbytes}
+    source = "+".join(source) if isinstance(source, dict) else str(source)  # bytes per device of a mixed model
+    record = TRANSFER_TELEMETRY.active
+    if record is None:
+        yield move
+        return
+    start = time.perf_counter()
+    with record.step("move"):
+        yield move
+        _synchronize(source, target)
+    record.add_move(model, source, target, move["bytes"], time.perf_counter() - start)
+
+
+def get_transfer_summary(node: str = None) -> dict:
+    return TRANSFER_TELEMETRY.summary(node)
+
+
+def get_transfer_history(node: str = None, last: int = None) -> List[dict]:
+    return TRANSFER_TELEMETRY.history(node, last)
+
+
+def export_transfer_history(path) -> int:
+    return TRANSFER_TELEMETRY.export_jsonl(path)
+
+
+def reset_transfer_telemetry():
+    TRANSFER_TELEMETRY.reset()
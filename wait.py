@@ -1,4 +1,5 @@
-from .common import any_type, c_Y, c_B, c_G, c_0, CACHE_DIR
+from .common import any_type, c_Y, c_B, c_G, c_0
+from .prefetch import resolve
 
 class Wait:
     """
@@ -27,7 +28,10 @@ class Wait:
     def forward(self, main, trigger1=None, trigger2=None, trigger3=None):
         # All triggers are evaluated due to forceInput=True (if needed upstream),
         # but we return only the 'main' input as the meaningful output.
-        return (main,)
+        # Prefetch handles (PrefetchRecall, PrefetchCache) are waited for here, main is replaced by its value.
+        for trigger in (trigger1, trigger2, trigger3):
+            resolve(trigger)
+        return (resolve(main),)
 
     @staticmethod
     def check_lazy_status(main=None, trigger1=None, trigger2=None, trigger3=None):
@@ -112,7 +116,11 @@ class WaitMulti:
     def forward(self, main, **kwargs):
         # All triggers are evaluated due to forceInput=True (if needed upstream),
         # but we return only the 'main' input as the meaningful output.
-        return (main,)
+        # Prefetch handles (PrefetchRecall, PrefetchCache) are waited for here, main is replaced by its value.
+        for key, value in kwargs.items():
+            if key.startswith("trigger"):
+                resolve(value)
+        return (resolve(main),)
 
     @staticmethod
     def check_lazy_status(main=None, **kwargs):